@@ -8,14 +8,54 @@ Analog signal from sensors to digital signal.
 
 from .lpgbt_controller import lpgbt_chip
 from ..utils.Configure_from_DB import etl_asic_config_from_db
+from ..utils.metrics import REGISTRY, timed
 from dataclasses import dataclass
 from .etroc_registers import PeriReg, PixReg, validate_is_pixel
+from .lpgbt_retry import RetryPolicy, RetryExhausted, classify, i2c_policy
+from .lpgbt_i2c import i2c_scheduler
+from .lpgbt_gpio import gpio_bank
 import time
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import partial
-from collections.abc import Callable
+from collections.abc import Callable, Coroutine
 import numpy as np
 from collections import UserList
 
+I2C_TRANSACTIONS = REGISTRY.counter("etl_i2c_transactions_total", "ETROC I2C transactions through the lpGBT I2C master")
+I2C_ERRORS = REGISTRY.counter("etl_i2c_errors_total", "ETROC I2C transactions that raised an error")
+I2C_LATENCY = REGISTRY.histogram("etl_i2c_transaction_seconds", "ETROC I2C transaction latency")
+SCAN_PIXELS_DONE = REGISTRY.gauge("etl_threshold_scan_pixels_done", "Pixels finished in the running threshold scan")
+SCAN_PIXELS_TOTAL = REGISTRY.gauge("etl_threshold_scan_pixels", "Pixels in the running threshold scan")
+
+def run_sync(coro: Coroutine):
+    """
+    Runs a coroutine to completion from synchronous code. If an event loop is already
+    running in this thread (e.g. Jupyter) the coroutine is run on its own loop in a helper thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+async def hard_reset_async(etrocs: list["etroc_chip"], duration: float = 0.05):
+    """
+    Pulses the reset lines of several ETROCs together, one PIOOUT write per lpGBT and edge
+    """
+    by_lpgbt = {}
+    for etroc in etrocs:
+        by_lpgbt.setdefault(id(etroc.lpgbt), []).append(etroc)
+    async def pulse(chips):
+        bank = gpio_bank(chips[0].lpgbt)
+        await bank.sequence_async([({e.reset_pin: 0 for e in chips}, duration), ({e.reset_pin: 1 for e in chips}, 0)],
+                                  run_blocking=chips[0]._run_blocking)
+    await asyncio.gather(*(pulse(chips) for chips in by_lpgbt.values()))
+
+def hard_reset(etrocs: list["etroc_chip"], duration: float = 0.05):
+    run_sync(hard_reset_async(etrocs, duration))
+
 @dataclass
 class Pixel:
     row: int 
@@ -36,48 +76,65 @@ class Pixel:
         register: ETROC pixel register name(str) or pixel register number(int)
         """
         return self.etroc.read(register, row=self.row, col=self.col)
+
+    async def write_async(self, register:str|PixReg|PeriReg, value: int):
+        await self.etroc.write_async(register, value, row=self.row, col=self.col)
+
+    async def read_async(self, register:str|PixReg|PeriReg) -> int:
+        return await self.etroc.read_async(register, row=self.row, col=self.col)
     
     def auto_threshold_scan(self, timeout = 5):
-        print("Checking Scan done", self.read(PixReg.ScanDone))
-        self.write(PixReg.CLKEn_THCal, 1)
-        self.write(PixReg.Bypass_THCal, 0)
-        self.write(PixReg.BufEn_THCal, 1)
-        self.write(PixReg.RSTn_THCal, 0) # Check with Murtaza: Needed?
-        self.write(PixReg.RSTn_THCal, 1) # Check with Murtaza: Needed?
-        print("ScanDone before rising edge", self.read(PixReg.ScanDone))
-        self.write(PixReg.ScanStart_THCal, 1)
-        self.write(PixReg.ScanStart_THCal, 0)
+        return run_sync(self.auto_threshold_scan_async(timeout=timeout))
+
+    async def auto_threshold_scan_async(self, timeout = 5):
+        """
+        Runs the in-pixel threshold calibration, the ScanDone polling waits on the event loop
+        so scans of pixels on other ETROCs can run in the meantime
+        """
+        print("Checking Scan done", await self.read_async(PixReg.ScanDone))
+        try:
+            return await self._auto_threshold_scan_async(timeout)
+        finally:
+            # always leave the pixel out of calibration, also when a read failed
+            await self.write_async(PixReg.Bypass_THCal, 1)
+            # self.write('DAC', min(baseline+noise_width, 1023))
+
+            # From Murtaza: DAC/TH_offset to the maximum, turn off cal clk and buffer
+            await self.write_async(PixReg.DAC, 1023)
+            await self.write_async(PixReg.TH_offset, 63 )
+            await self.write_async(PixReg.CLKEn_THCal, 0)
+            await self.write_async(PixReg.BufEn_THCal, 0)
+
+    async def _auto_threshold_scan_async(self, timeout):
+        await self.write_async(PixReg.CLKEn_THCal, 1)
+        await self.write_async(PixReg.Bypass_THCal, 0)
+        await self.write_async(PixReg.BufEn_THCal, 1)
+        await self.write_async(PixReg.RSTn_THCal, 0) # Check with Murtaza: Needed?
+        await self.write_async(PixReg.RSTn_THCal, 1) # Check with Murtaza: Needed?
+        print("ScanDone before rising edge", await self.read_async(PixReg.ScanDone))
+        await self.write_async(PixReg.ScanStart_THCal, 1)
+        await self.write_async(PixReg.ScanStart_THCal, 0)
         
         done = False
         start_time = time.time()
         timed_out = False
         c = 0
         while not done:
-            done = True
-            try:
-                c+=1
-                done = self.read(PixReg.ScanDone)
-                print("ScanDone Status: ", done)
-            except:
-                print("ScanDone read failed.")
-            # time.sleep(0.01) # Murtaza: Increase (before 0.001)
-            time.sleep(0.1) # Murtaza: Increase (before 0.001)
+            # transient I2C errors are retried by the ETROC's retry policy, an exhausted
+            # retry is raised so the pixel is not reported with a stale baseline
+            c+=1
+            done = await self.read_async(PixReg.ScanDone)
+            print("ScanDone Status: ", done)
+            # await asyncio.sleep(0.01) # Murtaza: Increase (before 0.001)
+            await asyncio.sleep(0.1) # Murtaza: Increase (before 0.001)
             if time.time() - start_time > timeout:
                 print(f"Auto threshold scan timed out for pixel {self.row=}, {self.col=}")
                 timed_out = True
                 break
 
-        noise_width = self.read(PixReg.NW)
-        baseline = self.read(PixReg.BL)
-        #time.sleep(0.1)
-        self.write(PixReg.Bypass_THCal, 1)
-        # self.write('DAC', min(baseline+noise_width, 1023))
-
-        # From Murtaza: DAC/TH_offset to the maximum, turn off cal clk and buffer
-        self.write(PixReg.DAC, 1023)
-        self.write(PixReg.TH_offset, 63 )
-        self.write(PixReg.CLKEn_THCal, 0)
-        self.write(PixReg.BufEn_THCal, 0)
+        noise_width = await self.read_async(PixReg.NW)
+        baseline = await self.read_async(PixReg.BL)
+        #await asyncio.sleep(0.1)
 
         return baseline, noise_width
 
@@ -97,6 +154,10 @@ class PixMatrix(UserList):
         etroc = self.pixels[0][0].etroc
         etroc.write(register, value, broadcast=True)
 
+    async def write_async(self, register:str|PixReg|PeriReg, value:int) -> None:
+        etroc = self.pixels[0][0].etroc
+        await etroc.write_async(register, value, broadcast=True)
+
 # ---------------------------------------------------------------
 # Main ETROC Chip Class
 # ---------------------------------------------------------------
@@ -108,24 +169,41 @@ class etroc_chip:
     pixels: PixMatrix[list[Pixel]]
 
 
-    def __init__(self, lpgbt: lpgbt_chip, address_i2c: int):
+    def __init__(self, lpgbt: lpgbt_chip, address_i2c: int, configure: bool = True, retry_policy: RetryPolicy | None = None,
+                 i2c_master: int = 1, reset_pin: str | int = "RESET1"):
         """
         Checks connectivity then writes initial configuration of ETROC 
+
+        configure: set False to skip the initial reset/configuration, e.g. to configure
+                   many chips concurrently with `await asyncio.gather(*(e.initialize_async() for e in etrocs))`
+        retry_policy: retries of failed I2C transactions, by default i2c_policy for the chip's I2C master
+        i2c_master: lpGBT I2C master (0-2) the chip is wired to, chips on different masters
+                    are accessed in parallel by the async methods
+        reset_pin: lpGBT GPIO (name or number) driving the chip's hard reset
         """
         self.lpgbt = lpgbt
         self._connected = False
         self. addr_i2c = address_i2c
+        self.i2c_master = i2c_master
+        self.reset_pin = reset_pin
+        self.retry_policy = retry_policy or i2c_policy(lpgbt, master_id=i2c_master)
+        chip = hex(address_i2c)
+        scheduler = i2c_scheduler(lpgbt)
         self.i2c_write = partial(
-            self.lpgbt.i2c_master_write,
-            master_id=1,          
+            self.retry_policy.wrap(
+                timed(scheduler.i2c_write, I2C_TRANSACTIONS, I2C_LATENCY, I2C_ERRORS, chip=chip, op="write"),
+                op="i2c_write"),
+            master_id=i2c_master,          
             slave_address=address_i2c,  
             reg_address_width=2,      
             timeout=10                    
         )
 
         self.i2c_read = partial(
-            lpgbt.i2c_master_read,
-            master_id = 1, 
+            self.retry_policy.wrap(
+                timed(scheduler.i2c_read, I2C_TRANSACTIONS, I2C_LATENCY, I2C_ERRORS, chip=chip, op="read"),
+                op="i2c_read"),
+            master_id = i2c_master, 
             slave_address = self.addr_i2c, 
             read_len = 1,
             reg_address_width = 2,
@@ -143,9 +221,29 @@ class etroc_chip:
         self.DAC_step = 400/2**10
         self._vref = False
 
-        self.reset(hard = True)
-        self.vref = True
-        self.config()
+        if configure:
+            self.initialize()
+
+    def initialize(self):
+        run_sync(self.initialize_async())
+
+    async def initialize_async(self):
+        """
+        Hard reset, VREF power up and initial configuration
+        """
+        await self.reset_async(hard = True)
+        await self.write_async(PeriReg.VRefGen_PD, True)
+        self._vref = True
+        await self.config_async()
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        """
+        Queues a blocking lpGBT call on the scheduler worker of this ETROC's I2C master
+        """
+        return i2c_scheduler(self.lpgbt).submit(self.i2c_master, func, *args, **kwargs)
+
+    async def _run_blocking(self, func: Callable, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
 
 
     @property
@@ -162,19 +260,24 @@ class etroc_chip:
         """
         Issues Hard or Soft Reset to ETROC chip
         """
+        run_sync(self.reset_async(hard=hard))
+
+    async def reset_async(self, hard=False):
         if hard:
-            self.lpgbt.write_gpio_output("RESET1",0)
-            time.sleep(0.05)
-            self.lpgbt.write_gpio_output("RESET1",1)
+            await gpio_bank(self.lpgbt).sequence_async(
+                [({self.reset_pin: 0}, 0.05), ({self.reset_pin: 1}, 0)], run_blocking=self._run_blocking)
         else:
-            self.write("asyResetGlobalReadout", 0)
-            time.sleep(0.05)
-            self.write("asyResetGlobalReadout", 1)
+            await self.write_async("asyResetGlobalReadout", 0)
+            await asyncio.sleep(0.05)
+            await self.write_async("asyResetGlobalReadout", 1)
 
     def reset_fast_command(self):
-        self.write(PeriReg.asyResetFastcommand,0)
-        time.sleep(0.1)
-        self.write(PeriReg.asyResetFastcommand,1)
+        run_sync(self.reset_fast_command_async())
+
+    async def reset_fast_command_async(self):
+        await self.write_async(PeriReg.asyResetFastcommand,0)
+        await asyncio.sleep(0.1)
+        await self.write_async(PeriReg.asyResetFastcommand,1)
 
     @property
     def vref(self):
@@ -196,45 +299,48 @@ class etroc_chip:
         """
         Writes Initial ETL Default Configuration for ETROC registers
         """
-        if not self.connected:
+        run_sync(self.config_async())
+
+    async def config_async(self):
+        if not await self._run_blocking(lambda: self.connected):
             raise ConnectionError(f"ETROC addr: {hex(self.addr_i2c)} Not Connected")
 
-        self.reset()
-        self.write(PeriReg.singlePort, 0)         # use both ports
-        self.write(PeriReg.mergeTriggerData, 1)   # merge trigger and data
-        self.write(PeriReg.disScrambler, 1)       # disable scrambler
-        self.write(PeriReg.serRateRight, 0)       # right port 320Mbps rate
-        self.write(PeriReg.serRateLeft, 0)        # left port 320Mbps rate
+        await self.reset_async()
+        await self.write_async(PeriReg.singlePort, 0)         # use both ports
+        await self.write_async(PeriReg.mergeTriggerData, 1)   # merge trigger and data
+        await self.write_async(PeriReg.disScrambler, 1)       # disable scrambler
+        await self.write_async(PeriReg.serRateRight, 0)       # right port 320Mbps rate
+        await self.write_async(PeriReg.serRateLeft, 0)        # left port 320Mbps rate
 
         # TODO: Write Chip ID to EFUSE
 
         # configuration as per discussion with ETROC2 developers
         # -> values from Tamalero ETROC.py
-        self.write(PeriReg.onChipL1AConf, 0) 
-        self.write(PeriReg.PLL_ENABLEPLL, 1)
-        self.write(PeriReg.chargeInjectionDelay, 0xa)
-        self.pixels.write(PixReg.L1Adelay, 0x01f5)
-        self.pixels.write(PixReg.disTrigPath, 1)
-        self.pixels.write(PixReg.QInjEn, 0)
+        await self.write_async(PeriReg.onChipL1AConf, 0) 
+        await self.write_async(PeriReg.PLL_ENABLEPLL, 1)
+        await self.write_async(PeriReg.chargeInjectionDelay, 0xa)
+        await self.pixels.write_async(PixReg.L1Adelay, 0x01f5)
+        await self.pixels.write_async(PixReg.disTrigPath, 1)
+        await self.pixels.write_async(PixReg.QInjEn, 0)
 
         # opening TOA / TOT / Cal windows
-        self.pixels.write(PixReg.upperTOA, 0x3ff)
-        self.pixels.write(PixReg.lowerTOA, 0)
-        self.pixels.write(PixReg.upperTOT, 0x1ff)
-        self.pixels.write(PixReg.lowerTOT, 0)
-        self.pixels.write(PixReg.upperCal, 0x3ff)
-        self.pixels.write(PixReg.lowerCal, 0)
+        await self.pixels.write_async(PixReg.upperTOA, 0x3ff)
+        await self.pixels.write_async(PixReg.lowerTOA, 0)
+        await self.pixels.write_async(PixReg.upperTOT, 0x1ff)
+        await self.pixels.write_async(PixReg.lowerTOT, 0)
+        await self.pixels.write_async(PixReg.upperCal, 0x3ff)
+        await self.pixels.write_async(PixReg.lowerCal, 0)
 
         # Configuring the trigger stream
-        self.pixels.write(PixReg.upperTOATrig, 0x3ff)
-        self.pixels.write(PixReg.lowerTOATrig, 0)
-        self.pixels.write(PixReg.upperTOTTrig, 0x1ff)
-        self.pixels.write(PixReg.lowerTOTTrig, 0)
-        self.pixels.write(PixReg.upperCalTrig, 0x3ff)
-        self.pixels.write(PixReg.lowerCalTrig, 0)
-
-        self.reset()
-        self.reset_fast_command()
+        await self.pixels.write_async(PixReg.upperTOATrig, 0x3ff)
+        await self.pixels.write_async(PixReg.lowerTOATrig, 0)
+        await self.pixels.write_async(PixReg.upperTOTTrig, 0x1ff)
+        await self.pixels.write_async(PixReg.lowerTOTTrig, 0)
+        await self.pixels.write_async(PixReg.upperCalTrig, 0x3ff)
+        await self.pixels.write_async(PixReg.lowerCalTrig, 0)
+
+        await self.reset_async()
+        await self.reset_fast_command_async()
    
 
     def write(self, register: str|PeriReg|PixReg, value:int, row:int|None=None, col:int|None=None, broadcast:bool=False):
@@ -283,35 +389,67 @@ class etroc_chip:
             print(f"READ {register.name}: {adr=}, value={values[-1]}, all_vals={values}")
         return register.merge_values(values)
 
+    async def write_async(self, register: str|PeriReg|PixReg, value:int, row:int|None=None, col:int|None=None, broadcast:bool=False):
+        """
+        Same as write, the read-modify-write runs in the lpGBT executor
+        """
+        await self._run_blocking(self.write, register, value, row=row, col=col, broadcast=broadcast)
+
+    async def read_async(self, register: str|PeriReg|PixReg, row:int|None=None, col:int|None=None) -> int:
+        """
+        Same as read, the I2C reads run in the lpGBT executor
+        """
+        return await self._run_blocking(self.read, register, row=row, col=col)
+
     def run_threshold_scan(self):
         """
         Preform threshold scan on full ETROC chip (all pixels)
         """
-        self.pixels.write(PixReg.IBSel, 0)
-        self.pixels.write(PixReg.workMode, 0)
+        return run_sync(self.run_threshold_scan_async())
+
+    async def run_threshold_scan_async(self):
+        """
+        Same as run_threshold_scan, scans of ETROCs on different I2C masters can run together:
+        `await asyncio.gather(*(e.run_threshold_scan_async() for e in etrocs))`
+        """
+        await self.pixels.write_async(PixReg.IBSel, 0)
+        await self.pixels.write_async(PixReg.workMode, 0)
 
-        self.pixels.write(PixReg.Bypass_THCal, 1)
-        self.pixels.write(PixReg.disDataReadout, 1)
-        self.pixels.write(PixReg.disTrigPath, 1)
-        self.pixels.write(PixReg.enable_TDC, 0)
-        self.pixels.write(PixReg.DAC, 1023)
-        self.pixels.write(PixReg.TH_offset, 63)
+        await self.pixels.write_async(PixReg.Bypass_THCal, 1)
+        await self.pixels.write_async(PixReg.disDataReadout, 1)
+        await self.pixels.write_async(PixReg.disTrigPath, 1)
+        await self.pixels.write_async(PixReg.enable_TDC, 0)
+        await self.pixels.write_async(PixReg.DAC, 1023)
+        await self.pixels.write_async(PixReg.TH_offset, 63)
 
         baselines = np.empty([16, 16])
         noisewidths = np.empty([16, 16])
 
-        for row in range(16):
-            for col in range(16):
-                print(f"Threshold scan on pixel: {row=},{col=}")
-                pix = self.pixels[row][col]
-                bl, nw = pix.auto_threshold_scan()
-                baselines[row][col], noisewidths[row][col] = bl, nw
-                print(f"{bl=}, {nw=}")
-                print("--------------")
-
-        self.pixels.write(PixReg.disDataReadout, 0)
-        self.pixels.write(PixReg.disTrigPath, 0)
-        self.pixels.write(PixReg.enable_TDC, 1)
+        chip = hex(self.addr_i2c)
+        SCAN_PIXELS_TOTAL.set(16*16, chip=chip)
+        SCAN_PIXELS_DONE.set(0, chip=chip)
+        try:
+            for row in range(16):
+                for col in range(16):
+                    print(f"Threshold scan on pixel: {row=},{col=}")
+                    pix = self.pixels[row][col]
+                    try:
+                        bl, nw = await pix.auto_threshold_scan_async()
+                    except Exception as error:
+                        # one pixel with a failing I2C link (exhausted retries, a timeout, NACK or
+                        # link error) does not stop the scan, anything else is a bug and is raised
+                        if not isinstance(error, RetryExhausted) and classify(error) is None:
+                            raise
+                        print(f"Threshold scan failed on pixel {row=},{col=}: {error!r}")
+                        bl, nw = np.nan, np.nan
+                    baselines[row][col], noisewidths[row][col] = bl, nw
+                    SCAN_PIXELS_DONE.inc(chip=chip)
+                    print(f"{bl=}, {nw=}")
+                    print("--------------")
+        finally:
+            await self.pixels.write_async(PixReg.disDataReadout, 0)
+            await self.pixels.write_async(PixReg.disTrigPath, 0)
+            await self.pixels.write_async(PixReg.enable_TDC, 1)
         
         print("FINAL BASELINES")
         print(baselines)
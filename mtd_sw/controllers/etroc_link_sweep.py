@@ -0,0 +1,257 @@
+"""
+Description:
+Uplink margin scan of an ETROC. For every channel pairing (both ports or single port),
+serializer rate and driver amplitude the chip is held in link reset with the fixed test
+pattern enabled (linkResetTestPattern/linkResetFixedPattern), the back-end counts bit
+errors on each port, and the results are collected into an error map per link with a
+recommended working point.
+
+Error counting is pluggable: anything with a
+count(etroc, link, point, duration) -> (bit errors, bits checked) method. ReplayErrorCounter
+is a stand-in that compares captured frames against the expected pattern.
+
+Points measured error free before (kept per chip in a JSON cache) are not measured again.
+
+sweep = UplinkSweep(etroc, counter)
+results = sweep.run()
+sweep.apply(results)
+"""
+try:
+    from .etroc_controller import etroc_chip
+except ModuleNotFoundError:
+    etroc_chip = object     # only for annotations, the sweep needs no more than read/write
+from .etroc_registers import PeriReg
+from collections.abc import Callable
+from dataclasses import dataclass
+import itertools
+import json
+import os
+import numpy as np
+
+SER_RATES = {0: 320, 1: 640, 2: 1280}       # serRate register value -> Mbps
+AMPLITUDES = tuple(range(8))                 # TX_AmplSel, 3 bits
+PAIRINGS = {"dual": 0, "single": 1}          # channel pairing -> singlePort
+LINKS = {
+    "left":  (PeriReg.serRateLeft, PeriReg.LTx_AmplSel),
+    "right": (PeriReg.serRateRight, PeriReg.RTx_AmplSel),
+}
+FIXED_PATTERN = 0x3C5C_A5C3
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".etl_mtd_daq", "etroc_uplink_sweeps.json")
+
+
+@dataclass(frozen=True)
+class SweepPoint:
+    pairing: str
+    ser_rate: int
+    amplitude: int
+
+
+@dataclass
+class LinkSweepResult:
+    """
+    errors/bits: indexed [pairing, ser_rate, amplitude] in the order of the axes,
+                 bits is 0 where nothing was received
+    """
+    link: str
+    pairings: tuple[str, ...]
+    ser_rates: tuple[int, ...]
+    amplitudes: tuple[int, ...]
+    errors: np.ndarray
+    bits: np.ndarray
+
+    @property
+    def ber(self) -> np.ndarray:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.bits > 0, self.errors/self.bits, np.nan)
+
+    def error_map(self, pairing: str = "dual") -> np.ndarray:
+        """
+        2D bit error rate map [ser_rate, amplitude] of one pairing
+        """
+        return self.ber[self.pairings.index(pairing)]
+
+    def working_point(self) -> SweepPoint | None:
+        """
+        Highest error-free serializer rate, dual port preferred, with the amplitude in the
+        middle of the widest error-free amplitude range (the most margin on both sides)
+        """
+        good = (self.bits > 0) & (self.errors == 0)
+        best = None
+        for i_pairing, i_rate in itertools.product(range(len(self.pairings)), range(len(self.ser_rates))):
+            row = good[i_pairing, i_rate]
+            if not row.any():
+                continue
+            # widest run of error-free amplitudes
+            edges = np.diff(np.concatenate(([0], row.astype(np.int8), [0])))
+            starts, stops = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+            widest = int(np.argmax(stops - starts))
+            width = int(stops[widest] - starts[widest])
+            key = (SER_RATES[self.ser_rates[i_rate]], -i_pairing, width)
+            if best is None or key > best[0]:
+                amplitude = self.amplitudes[(starts[widest] + stops[widest] - 1)//2]
+                best = (key, SweepPoint(self.pairings[i_pairing], self.ser_rates[i_rate], amplitude))
+        return best[1] if best else None
+
+
+def pattern_bit_errors(frames: np.ndarray, pattern: int = FIXED_PATTERN, width: int = 32) -> tuple[int, int]:
+    """
+    Bit errors of captured words against the expected pattern, (errors, bits checked)
+    """
+    frames = np.asarray(frames, dtype=np.uint64)
+    diff = (frames ^ np.uint64(pattern)) & np.uint64((1 << width) - 1)
+    if hasattr(np, "bitwise_count"):
+        errors = int(np.bitwise_count(diff).sum())
+    else:
+        errors = int(np.unpackbits(diff.view(np.uint8)).sum())
+    return errors, width*len(frames)
+
+
+class ReplayErrorCounter:
+    """
+    Stand-in for the back-end error counter: frames(link, point) returns the words captured
+    for that setting (e.g. loaded from files recorded at the test stand), which are compared
+    against the fixed pattern
+    """
+    def __init__(self, frames: Callable[[str, SweepPoint], np.ndarray], pattern: int = FIXED_PATTERN):
+        self.frames = frames
+        self.pattern = pattern
+
+    def count(self, etroc: etroc_chip, link: str, point: SweepPoint, duration: float) -> tuple[int, int]:
+        captured = self.frames(link, point)
+        if captured is None or len(captured) == 0:
+            return 0, 0
+        return pattern_bit_errors(captured, self.pattern)
+
+
+class UplinkSweep:
+    def __init__(self, etroc: etroc_chip, counter, pairings=tuple(PAIRINGS), ser_rates=tuple(SER_RATES),
+                 amplitudes=AMPLITUDES, links=tuple(LINKS), duration: float = 0.1,
+                 pattern: int = FIXED_PATTERN, board: str = "default", cache_path: str | None = DEFAULT_CACHE):
+        """
+        board: name of the readout board, together with the I2C master and address it
+               identifies the chip in the known-good cache
+        """
+        self.etroc = etroc
+        self.board = board
+        self.counter = counter
+        self.pairings = tuple(pairings)
+        self.ser_rates = tuple(ser_rates)
+        self.amplitudes = tuple(amplitudes)
+        self.links = tuple(links)
+        self.duration = duration
+        self.pattern = pattern
+        self.cache_path = cache_path
+        self._written: dict[PeriReg, int] = {}
+
+    @property
+    def chip_key(self) -> str:
+        return f"{self.board}/{self.etroc.i2c_master}/{hex(self.etroc.addr_i2c)}"
+
+    def _load_cache(self) -> dict:
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_cache(self, known_good: dict):
+        if self.cache_path is None:
+            return
+        entries = self._load_cache()
+        entries[self.chip_key] = known_good
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        tmp_path = f"{self.cache_path}.tmp{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f, indent=2)
+        os.replace(tmp_path, self.cache_path)
+
+    def _write(self, register: PeriReg, value: int):
+        # only registers that change between points are written
+        if self._written.get(register) != value:
+            self.etroc.write(register, value)
+            self._written[register] = value
+
+    def _settings(self) -> list[PeriReg]:
+        """
+        Registers the sweep changes, read before and restored after it
+        """
+        registers = [PeriReg.singlePort, PeriReg.linkResetTestPattern, PeriReg.linkResetFixedPattern]
+        for link in self.links:
+            registers += LINKS[link]
+        return registers
+
+    def _set_point(self, point: SweepPoint):
+        self._write(PeriReg.singlePort, PAIRINGS[point.pairing])
+        for link in self.links:
+            rate_reg, ampl_reg = LINKS[link]
+            self._write(rate_reg, point.ser_rate)
+            self._write(ampl_reg, point.amplitude)
+
+    def run(self, skip_known_good: bool = True) -> dict[str, LinkSweepResult]:
+        """
+        Measures every point and returns one LinkSweepResult per link. The chip is left
+        in the state it was in before, apply() moves it to the working point.
+        """
+        shape = (len(self.pairings), len(self.ser_rates), len(self.amplitudes))
+        results = {link: LinkSweepResult(link, self.pairings, self.ser_rates, self.amplitudes,
+                                         np.zeros(shape, dtype=np.int64), np.zeros(shape, dtype=np.int64))
+                   for link in self.links}
+        cached = self._load_cache().get(self.chip_key, {}) if skip_known_good else {}
+        known_good = {link: dict(points) for link, points in cached.items()}
+
+        self._written.clear()
+        previous = {register: self.etroc.read(register) for register in self._settings()}
+        self._write(PeriReg.linkResetTestPattern, 1)    # fixed pattern instead of PRBS
+        self._write(PeriReg.linkResetFixedPattern, self.pattern)
+        skipped = 0
+        try:
+            for index in itertools.product(*(range(n) for n in shape)):
+                point = SweepPoint(self.pairings[index[0]], self.ser_rates[index[1]], self.amplitudes[index[2]])
+                key = f"{point.pairing}/{point.ser_rate}/{point.amplitude}"
+                todo = [link for link in self.links if key not in known_good.get(link, {})]
+                for link in self.links:
+                    if link not in todo:
+                        results[link].bits[index] = known_good[link][key]
+                if not todo:
+                    skipped += 1
+                    continue
+
+                self._set_point(point)
+                self._write(PeriReg.asyLinkReset, 0)    # hold in link reset: the chip sends the pattern
+                try:
+                    for link in todo:
+                        errors, bits = self.counter.count(self.etroc, link, point, self.duration)
+                        results[link].errors[index], results[link].bits[index] = errors, bits
+                        if bits > 0 and errors == 0:
+                            known_good.setdefault(link, {})[key] = bits
+                finally:
+                    self._write(PeriReg.asyLinkReset, 1)
+        finally:
+            self._save_cache(known_good)
+            # back to the rate, amplitude and pattern the chip had before the sweep
+            for register, value in previous.items():
+                self._write(register, value)
+        print(f"Uplink sweep of ETROC {hex(self.etroc.addr_i2c)}: {np.prod(shape)} points, {skipped} known good skipped")
+        return results
+
+    def apply(self, results: dict[str, LinkSweepResult]) -> dict[str, SweepPoint | None]:
+        """
+        Writes the recommended working point of every link. Both links share singlePort,
+        so the pairing of the first link with a working point is used.
+        """
+        points = {link: result.working_point() for link, result in results.items()}
+        pairing = next((p.pairing for p in points.values() if p is not None), None)
+        if pairing is not None:
+            self.etroc.write(PeriReg.singlePort, PAIRINGS[pairing])
+        for link, point in points.items():
+            if point is None:
+                print(f"No error free setting found for the {link} link")
+                continue
+            rate_reg, ampl_reg = LINKS[link]
+            self.etroc.write(rate_reg, point.ser_rate)
+            self.etroc.write(ampl_reg, point.amplitude)
+            print(f"{link} link: {SER_RATES[point.ser_rate]} Mbps, amplitude {point.amplitude}, {point.pairing} port")
+        self.etroc.write(PeriReg.linkResetTestPattern, 0)
+        return points
@@ -0,0 +1,527 @@
+"""
+Description:
+Pixel-matrix scans of an ETROC driven through I2C and fast commands.
+
+Charge injection: for every group of pixels with QInjEn set, the injected charge (QSel),
+threshold DAC and injection delay (chargeInjectionDelay) are stepped, every point is
+pulsed a number of times (charge injection followed by an L1A) and the hit efficiency and
+TOA/TOT/CAL of every pixel are collected into arrays indexed [qsel, dac, delay, row, col].
+
+Fast commands are pluggable: anything with an
+inject(etroc, count, point) -> DecodedFrames method. SimulatedInjection is a local model of
+the pixel front-end producing ETROC2 frames, to develop analysis without a test stand.
+
+Register writes are kept low: parameters common to all pixels are broadcast and only
+written when they change, the points are visited so that only one parameter changes
+between them, with the most expensive change (the pixel group) the least frequent, and
+the per-pixel QInjEn bits are only written where they differ from the chip (or replaced
+by one broadcast write when that is cheaper).
+
+Noise scan: all pixels are set to their operating threshold, the occupancy is measured
+(from triggered data, the ACC counters or a simulation) and pixels above a noise limit are
+masked with disDataReadout/disTrigPath, repeating until the chip is quiet. Only pixels
+whose mask changes are written.
+
+scan = ChargeInjectionScan(etroc, SimulatedInjection(), qsels=range(0, 32, 4), dacs=range(500, 700, 10))
+result = scan.run()
+result.efficiency[:, :, 0, 5, 5]     # s-curves of pixel (5, 5)
+
+thresholds = noise_thresholds(*etroc.run_threshold_scan())
+masked = NoiseScan(etroc, TriggeredOccupancy(back_end), thresholds, noise_limit=1e-3).run().masked
+"""
+try:
+    from .etroc_controller import etroc_chip
+except ModuleNotFoundError:
+    etroc_chip = object     # only for annotations, the scans need no more than read/write
+from .etroc_registers import PeriReg, PixReg
+from ..daq.etroc_decoder import DecodedFrames, decode, encode_header, encode_hit, encode_trailer
+from dataclasses import dataclass
+import math
+import time
+import numpy as np
+
+N_ROWS = 16
+N_COLS = 16
+SELF_TEST_RANDOM = 0b10      # workMode: self-test with random data at selfTestOccupancy
+SCAN_HIT_DTYPE = np.dtype([
+    ("qsel",  np.uint8),     # indices into the scan axes
+    ("dac",   np.uint16),
+    ("delay", np.uint8),
+    ("row",   np.uint8),
+    ("col",   np.uint8),
+    ("toa",   np.uint16),
+    ("tot",   np.uint16),
+    ("cal",   np.uint16),
+])
+
+
+def charge_fc(qsel: int | np.ndarray):
+    """
+    Injected charge of a QSel setting, 1 fC steps starting at 1 fC
+    """
+    return np.asarray(qsel) + 1
+
+
+class PixelRegister:
+    """
+    Shadow of a pixel register (e.g. DAC) of all 256 pixels. apply() writes new values
+    with the fewest etroc.write calls: only the pixels that differ, or one broadcast of
+    the most common value followed by the pixels that differ from it.
+    """
+    dtype = np.int64
+
+    def __init__(self, etroc: etroc_chip, register: PixReg, state: np.ndarray | None = None):
+        """
+        state: current values on the chip if known, unknown by default (the first apply
+               then starts with a broadcast)
+        """
+        self.etroc = etroc
+        self.register = register
+        self.state = None if state is None else np.asarray(state, dtype=self.dtype).copy()
+        self.writes = 0
+
+    @staticmethod
+    def _most_common(new: np.ndarray) -> tuple[int, int]:
+        values, counts = np.unique(new, return_counts=True)
+        return values[np.argmax(counts)], int(counts.max())
+
+    def cost(self, new: np.ndarray) -> int:
+        new = np.asarray(new, dtype=self.dtype)
+        broadcast = 1 + new.size - self._most_common(new)[1]
+        if self.state is None:
+            return broadcast
+        return min(int((self.state != new).sum()), broadcast)
+
+    def apply(self, new: np.ndarray) -> int:
+        """
+        Writes the values (16x16) to the chip, returns the number of writes
+        """
+        new = np.asarray(new, dtype=self.dtype)
+        if self.state is None or int((self.state != new).sum()) > self.cost(new):
+            common = self._most_common(new)[0]
+            self.etroc.write(self.register, int(common), broadcast=True)
+            self.state = np.full(new.shape, common)
+            writes = 1
+        else:
+            writes = 0
+        for row, col in zip(*np.nonzero(self.state != new)):
+            self.etroc.write(self.register, int(new[row, col]), row=int(row), col=int(col))
+            writes += 1
+        self.state = new.copy()
+        self.writes += writes
+        return writes
+
+
+class PixelMask(PixelRegister):
+    """
+    PixelRegister of a one-bit register (e.g. QInjEn, disDataReadout)
+    """
+    dtype = bool
+
+
+def pixel_groups(n_groups: int) -> list[np.ndarray]:
+    """
+    Splits the matrix into n_groups disjoint groups along diagonals, so pixels injected
+    together are spread over the rows and columns rather than neighbours
+    """
+    rows, cols = np.indices((N_ROWS, N_COLS))
+    label = (cols + 3*rows) % n_groups
+    return [label == group for group in range(n_groups)]
+
+
+def order_groups(groups: list[np.ndarray], mask: PixelMask) -> list[np.ndarray]:
+    """
+    Orders (possibly overlapping) groups so that every change costs the fewest writes,
+    greedily picking the cheapest next group
+    """
+    remaining = list(groups)
+    ordered = []
+    shadow = PixelMask(mask.etroc, mask.register, mask.state)
+    while remaining:
+        shadow.state = remaining.pop(int(np.argmin([shadow.cost(group) for group in remaining])))
+        ordered.append(shadow.state)
+    return ordered
+
+
+def serpentine(shape: tuple[int, ...]) -> list[tuple[int, ...]]:
+    """
+    All indices of a grid, ordered so that consecutive points differ in one axis only: the
+    inner axes run back and forth instead of jumping back to their start
+    """
+    if not shape:
+        return [()]
+    inner = serpentine(shape[1:])
+    return [(i,) + rest for i in range(shape[0]) for rest in (inner if i % 2 == 0 else inner[::-1])]
+
+
+@dataclass
+class InjectionPoint:
+    qsel: int
+    dac: int
+    delay: int
+    pixels: np.ndarray      # 16x16 bool, pixels with QInjEn set
+
+
+@dataclass
+class InjectionScanResult:
+    """
+    Per-pixel arrays indexed [qsel, dac, delay, row, col], NaN where a pixel was not
+    injected (or, for the timing arrays, had no hit)
+    """
+    qsels: tuple[int, ...]
+    dacs: tuple[int, ...]
+    delays: tuple[int, ...]
+    pulses: int
+    efficiency: np.ndarray
+    toa_mean: np.ndarray
+    toa_rms: np.ndarray
+    tot_mean: np.ndarray
+    cal_mean: np.ndarray
+    hits: np.ndarray | None = None      # SCAN_HIT_DTYPE if kept
+    writes: int = 0
+
+    @property
+    def charges(self) -> np.ndarray:
+        return charge_fc(np.array(self.qsels))
+
+
+class SimulatedInjection:
+    """
+    Local stand-in for the fast command back end. A pixel fires when its baseline plus the
+    injected signal (plus noise) is above the threshold DAC, TOA follows the injection
+    delay with a time walk falling with the charge and TOT grows with the charge.
+    """
+    def __init__(self, baseline: np.ndarray | float = 500, noise: float = 1.5, gain: float = 8.0,
+                 toa_offset: float = 150, toa_per_delay: float = 44, walk: float = 300,
+                 toa_jitter: float = 2.0, chip_id: int = 0, seed: int | None = None):
+        """
+        baseline: per-pixel baseline in DAC counts (16x16 or one value for all)
+        gain: signal in DAC counts per fC
+        walk: TOA walk in TOA counts at 1 fC, falling as 1/charge
+        """
+        self.rng = np.random.default_rng(seed)
+        self.baseline = np.broadcast_to(np.asarray(baseline, dtype=float), (N_ROWS, N_COLS))
+        self.noise = noise
+        self.gain = gain
+        self.toa_offset = toa_offset
+        self.toa_per_delay = toa_per_delay
+        self.walk = walk
+        self.toa_jitter = toa_jitter
+        self.chip_id = chip_id
+        self.l1counter = 0
+
+    def inject(self, etroc, count: int, point: InjectionPoint) -> DecodedFrames:
+        rows, cols = np.nonzero(point.pixels)
+        charge = float(charge_fc(point.qsel))
+        signal = self.baseline[rows, cols] + self.gain*charge
+        amplitude = signal[None, :] + self.noise*self.rng.standard_normal((count, len(rows)))
+        trigger, pixel = np.nonzero(amplitude > point.dac)
+
+        n = len(trigger)
+        toa = (self.toa_offset + self.toa_per_delay*point.delay + self.walk/charge
+               + self.toa_jitter*self.rng.standard_normal(n))
+        tot = 20 + 40*np.log(charge) + self.rng.standard_normal(n)
+        cal = 200 + self.rng.integers(-2, 3, n)
+        hit_words = encode_hit(rows[pixel].astype(np.int64), cols[pixel].astype(np.int64),
+                               np.clip(toa, 0, 1023).astype(np.int64), np.clip(tot, 0, 511).astype(np.int64),
+                               cal.astype(np.int64))
+
+        # header, hits and trailer of every trigger, placed without a Python loop
+        hits_per_trigger = np.bincount(trigger, minlength=count)
+        hits_before = np.concatenate(([0], np.cumsum(hits_per_trigger)[:-1]))
+        start = np.arange(count)*2 + hits_before
+        frames = np.empty(2*count + n, dtype=np.uint64)
+        l1counter = (self.l1counter + np.arange(count)) & 0xff
+        frames[start] = encode_header(l1counter.astype(np.int64), 0)
+        frames[start + 1 + hits_per_trigger] = encode_trailer(self.chip_id, hits_per_trigger.astype(np.int64))
+        frames[start[trigger] + 1 + np.arange(n) - hits_before[trigger]] = hit_words
+        self.l1counter = (self.l1counter + count) & 0xff
+        return decode(frames)
+
+
+class ChargeInjectionScan:
+    def __init__(self, etroc: etroc_chip, backend, qsels=range(32), dacs=range(0, 1024, 16), delays=(0xa,),
+                 groups: list[np.ndarray] | None = None, pulses: int = 100, keep_hits: bool = False,
+                 thresholds: np.ndarray | None = None):
+        """
+        backend: fast command back end, e.g. SimulatedInjection
+        groups: 16x16 bool masks of pixels injected together, pixel_groups(16) by default
+        keep_hits: also return every hit, e.g. for the time-walk calibration
+        thresholds: 16x16 operating DACs written back after the scan (e.g. noise_thresholds),
+                    otherwise the DAC is left at its maximum like after run_threshold_scan
+        """
+        self.etroc = etroc
+        self.backend = backend
+        self.qsels = tuple(qsels)
+        self.dacs = tuple(dacs)
+        self.delays = tuple(delays)
+        self.groups = groups if groups is not None else pixel_groups(16)
+        self.pulses = pulses
+        self.keep_hits = keep_hits
+        self.thresholds = thresholds
+        self.qinj = PixelMask(etroc, PixReg.QInjEn)
+        self._written: dict[PixReg | PeriReg, int] = {}
+        self._writes = 0
+
+    @property
+    def writes(self) -> int:
+        return self._writes + self.qinj.writes
+
+    def _write(self, register: PixReg | PeriReg, value: int):
+        # parameters shared by all pixels are broadcast, and only written when they change.
+        # _written is the chip state only while run() owns the chip: nothing else may write
+        # these registers during a scan (it is cleared when a scan starts)
+        if self._written.get(register) != value:
+            if isinstance(register, PixReg):
+                self.etroc.write(register, value, broadcast=True)
+            else:
+                self.etroc.write(register, value)
+            self._written[register] = value
+            self._writes += 1
+
+    def _restore(self, previous: dict[PixReg | PeriReg, int]):
+        """
+        Puts back the settings the scan stepped through: thresholds (or the DAC maximum),
+        QSel, injection delay, the charge injection reset and the threshold source
+        """
+        if self.thresholds is not None:
+            last = self._written.get(PixReg.DAC)
+            dac = PixelRegister(self.etroc, PixReg.DAC, None if last is None else np.full((N_ROWS, N_COLS), last))
+            self._writes += dac.apply(self.thresholds)
+            self._written.pop(PixReg.DAC, None)
+        else:
+            self._write(PixReg.DAC, 1023)
+        for register, value in previous.items():
+            self._write(register, value)
+
+    def run(self) -> InjectionScanResult:
+        shape = (len(self.qsels), len(self.dacs), len(self.delays), N_ROWS, N_COLS)
+        sums = {name: np.zeros(shape) for name in ("hits", "toa", "toa2", "tot", "cal")}
+        injected = np.zeros(shape[-2:], dtype=bool)
+        kept = []
+        self._written.clear()
+
+        # the broadcast pixel settings are taken as uniform, pixel (0, 0) stands for all
+        previous = {register: self.etroc.read(register, row=0, col=0) for register in (PixReg.Bypass_THCal, PixReg.QSel)}
+        for register in (PeriReg.chargeInjectionDelay, PeriReg.asyResetChargeInj):
+            previous[register] = self.etroc.read(register)
+        self._write(PixReg.Bypass_THCal, 1)          # threshold from the DAC register
+        self._write(PeriReg.asyResetChargeInj, 1)    # release the charge injection reset
+        # axes from the most to the least expensive change: DAC (two registers), QSel, then
+        # the delay in the periphery
+        points = serpentine((len(self.dacs), len(self.qsels), len(self.delays)))
+        try:
+            for i_group, group in enumerate(order_groups(self.groups, self.qinj)):
+                self.qinj.apply(group)
+                injected |= group
+                for i_dac, i_q, i_delay in (points if i_group % 2 == 0 else points[::-1]):
+                    dac, qsel, delay = self.dacs[i_dac], self.qsels[i_q], self.delays[i_delay]
+                    self._write(PixReg.DAC, dac)
+                    self._write(PixReg.QSel, qsel)
+                    self._write(PeriReg.chargeInjectionDelay, delay)
+                    hits = self.backend.inject(self.etroc, self.pulses, InjectionPoint(qsel, dac, delay, group)).hits
+                    hits = hits[group[hits["row"], hits["col"]]]
+                    pixel = hits["row"].astype(np.int64)*N_COLS + hits["col"]
+                    toa = hits["toa"].astype(float)
+                    point = (i_q, i_dac, i_delay)
+                    for name, weights in (("hits", None), ("toa", toa), ("toa2", toa*toa),
+                                          ("tot", hits["tot"]), ("cal", hits["cal"])):
+                        sums[name][point] += np.bincount(pixel, weights, minlength=N_ROWS*N_COLS).reshape(N_ROWS, N_COLS)
+                    if self.keep_hits:
+                        scan_hits = np.empty(len(hits), dtype=SCAN_HIT_DTYPE)
+                        scan_hits["qsel"], scan_hits["dac"], scan_hits["delay"] = point
+                        for name in ("row", "col", "toa", "tot", "cal"):
+                            scan_hits[name] = hits[name]
+                        kept.append(scan_hits)
+        finally:
+            self.qinj.apply(np.zeros((N_ROWS, N_COLS), dtype=bool))
+            self._restore(previous)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            n = np.where(injected, sums["hits"], np.nan)
+            toa_mean = sums["toa"]/n
+            result = InjectionScanResult(
+                self.qsels, self.dacs, self.delays, self.pulses,
+                efficiency=n/self.pulses,
+                toa_mean=toa_mean,
+                toa_rms=np.sqrt(np.maximum(sums["toa2"]/n - toa_mean**2, 0)),
+                tot_mean=sums["tot"]/n,
+                cal_mean=sums["cal"]/n,
+                hits=np.concatenate(kept) if self.keep_hits else None,
+                writes=self.writes)
+        print(f"Charge injection scan of ETROC {hex(self.etroc.addr_i2c)}: {np.prod(shape[:3])*len(self.groups)} points, "
+              f"{result.writes} register writes")
+        return result
+
+
+@dataclass
+class NoiseState:
+    thresholds: np.ndarray  # 16x16 DAC thresholds
+    masked: np.ndarray      # 16x16 bool, pixels with readout disabled
+
+
+class TriggeredOccupancy:
+    """
+    Occupancy from data: back_end.acquire(etroc, triggers) -> DecodedFrames sends random
+    triggers (or reads self-triggered data) and returns the decoded stream.
+    Occupancy is in hits per trigger.
+    """
+    def __init__(self, back_end, triggers: int = 10000):
+        self.back_end = back_end
+        self.triggers = triggers
+
+    def measure(self, etroc, state: NoiseState) -> np.ndarray:
+        hits = self.back_end.acquire(etroc, self.triggers).hits
+        pixel = hits["row"].astype(np.int64)*N_COLS + hits["col"]
+        return np.bincount(pixel, minlength=N_ROWS*N_COLS).reshape(N_ROWS, N_COLS)/self.triggers
+
+
+class AccOccupancy:
+    """
+    Occupancy from the pixels' ACC counters (16 bits), read before and after a counting
+    window with the threshold calibration clock running. Occupancy is in counts per second.
+    Costs 512 I2C reads per measurement.
+    """
+    def __init__(self, window: float = 1.0):
+        self.window = window
+
+    def _read(self, etroc) -> np.ndarray:
+        return np.array([[etroc.read(PixReg.ACC, row=row, col=col) for col in range(N_COLS)] for row in range(N_ROWS)])
+
+    def measure(self, etroc, state: NoiseState) -> np.ndarray:
+        etroc.write(PixReg.CLKEn_THCal, 1, broadcast=True)
+        try:
+            before = self._read(etroc)
+            time.sleep(self.window)
+            after = self._read(etroc)
+        finally:
+            etroc.write(PixReg.CLKEn_THCal, 0, broadcast=True)
+        return ((after - before) % (1 << 16))/self.window
+
+
+class SimulatedNoise:
+    """
+    Local stand-in for an occupancy measurement: Gaussian noise around the baseline crossing
+    the threshold, plus hot pixels with a fixed extra occupancy. Masked pixels send nothing.
+    """
+    def __init__(self, baseline: np.ndarray | float = 500, noise: np.ndarray | float = 1.5,
+                 hot: np.ndarray | None = None, triggers: int = 10000, seed: int | None = None):
+        """
+        hot: 16x16 extra occupancy per trigger (e.g. 0.2 for a few pixels)
+        """
+        self.rng = np.random.default_rng(seed)
+        self.baseline = np.broadcast_to(np.asarray(baseline, dtype=float), (N_ROWS, N_COLS))
+        self.noise = np.broadcast_to(np.asarray(noise, dtype=float), (N_ROWS, N_COLS))
+        self.hot = np.zeros((N_ROWS, N_COLS)) if hot is None else np.asarray(hot, dtype=float)
+        self.triggers = triggers
+
+    def measure(self, etroc, state: NoiseState) -> np.ndarray:
+        z = (state.thresholds - self.baseline)/(self.noise*np.sqrt(2))
+        probability = np.minimum(0.5*np.vectorize(math.erfc)(z) + self.hot, 1)
+        probability[state.masked] = 0
+        return self.rng.binomial(self.triggers, probability)/self.triggers
+
+
+@dataclass
+class NoiseScanResult:
+    occupancy: np.ndarray   # [iteration, row, col], in the unit of the occupancy source
+    masked: np.ndarray      # 16x16 bool, pixels masked at the end
+    newly_masked: np.ndarray    # 16x16 bool, pixels masked by this scan
+    quiet: bool             # no unmasked pixel above the limit at the last iteration
+    writes: int = 0
+
+    @property
+    def iterations(self) -> int:
+        return len(self.occupancy)
+
+
+class NoiseScan:
+    def __init__(self, etroc: etroc_chip, source, thresholds: np.ndarray | int, noise_limit: float,
+                 masked: np.ndarray | None = None, mask_registers=(PixReg.disDataReadout, PixReg.disTrigPath),
+                 max_per_iteration: int = 16, max_iterations: int = 10, max_masked: int = 64,
+                 self_test_occupancy: int | None = None):
+        """
+        source: occupancy source, TriggeredOccupancy, AccOccupancy or SimulatedNoise
+        thresholds: operating threshold DAC of every pixel (16x16, or one value), e.g.
+                    noise_thresholds(baselines, noisewidths) from a threshold scan
+        noise_limit: occupancy above which a pixel is masked, in the unit of the source
+        masked: pixels already masked (e.g. from a previous run), kept masked
+        max_per_iteration: noisiest pixels masked per iteration, masking a few at a time
+                           avoids masking pixels that were only noisy through their neighbours
+        max_masked: the scan stops rather than masking more pixels than this
+        self_test_occupancy: run with the pixels in self-test mode at this selfTestOccupancy,
+                             to check the readout and the masking without sensor noise
+        """
+        self.etroc = etroc
+        self.source = source
+        self.thresholds = np.broadcast_to(np.asarray(thresholds, dtype=np.int64), (N_ROWS, N_COLS))
+        self.noise_limit = noise_limit
+        self.masked = np.zeros((N_ROWS, N_COLS), dtype=bool) if masked is None else np.asarray(masked, dtype=bool).copy()
+        self.max_per_iteration = max_per_iteration
+        self.max_iterations = max_iterations
+        self.max_masked = max_masked
+        self.self_test_occupancy = self_test_occupancy
+        self.dac = PixelRegister(etroc, PixReg.DAC)
+        self.masks = [PixelMask(etroc, register) for register in mask_registers]
+        self._writes = 0
+
+    @property
+    def writes(self) -> int:
+        return self._writes + self.dac.writes + sum(mask.writes for mask in self.masks)
+
+    def _broadcast(self, register: PixReg, value: int):
+        self.etroc.write(register, value, broadcast=True)
+        self._writes += 1
+
+    def _apply_masks(self):
+        # only the pixels whose mask bit changed are written
+        for mask in self.masks:
+            mask.apply(self.masked)
+
+    def run(self) -> NoiseScanResult:
+        initially_masked = self.masked.copy()
+        self._broadcast(PixReg.Bypass_THCal, 1)     # threshold from the DAC register
+        self.dac.apply(self.thresholds)
+        if self.self_test_occupancy is not None:
+            self._broadcast(PixReg.selfTestOccupancy, self.self_test_occupancy)
+            self._broadcast(PixReg.workMode, SELF_TEST_RANDOM)
+
+        occupancies = []
+        quiet = False
+        try:
+            for iteration in range(self.max_iterations):
+                self._apply_masks()
+                occupancy = self.source.measure(self.etroc, NoiseState(self.thresholds, self.masked))
+                occupancies.append(occupancy)
+                noisy = (occupancy > self.noise_limit) & ~self.masked
+                if not noisy.any():
+                    quiet = True
+                    break
+                # the noisiest first, their neighbours may calm down once they are masked
+                candidates = np.flatnonzero(noisy)
+                candidates = candidates[np.argsort(occupancy.reshape(-1)[candidates])[::-1][:self.max_per_iteration]]
+                if self.masked.sum() + len(candidates) > self.max_masked:
+                    print(f"Noise scan of ETROC {hex(self.etroc.addr_i2c)}: more than {self.max_masked} noisy pixels, "
+                          "stopping (threshold too low?)")
+                    break
+                self.masked.reshape(-1)[candidates] = True
+                print(f"Noise scan iteration {iteration}: masking {len(candidates)} pixels, {int(self.masked.sum())} masked")
+        finally:
+            # the pixels masked at the last iteration have not been written yet
+            self._apply_masks()
+            if self.self_test_occupancy is not None:
+                self._broadcast(PixReg.workMode, 0)
+
+        if not quiet:
+            print(f"Noise scan of ETROC {hex(self.etroc.addr_i2c)} did not reach a quiet chip")
+        return NoiseScanResult(np.array(occupancies), self.masked.copy(), self.masked & ~initially_masked,
+                               quiet, self.writes)
+
+
+def noise_thresholds(baselines: np.ndarray, noisewidths: np.ndarray, n_sigma: float = 4, floor: int = 0) -> np.ndarray:
+    """
+    Operating thresholds from the results of etroc_chip.run_threshold_scan, the baseline
+    plus n_sigma noise widths (pixels the scan failed on get the DAC maximum)
+    """
+    thresholds = np.asarray(baselines, dtype=float) + n_sigma*np.maximum(np.asarray(noisewidths, dtype=float), floor)
+    return np.nan_to_num(np.clip(np.round(thresholds), 0, 1023), nan=1023).astype(np.int64)
@@ -0,0 +1,231 @@
+"""
+Description:
+Gain/offset calibration of the lpGBT ADC. Calibrations are persisted per lpGBT (keyed by
+the fused CHIPID) together with the time and lpGBT temperature at which they were
+measured, so they can be reused across sessions and re-measured in the background once
+they get too old or the board temperature has drifted.
+"""
+from .lpgbt_controller import lpgbt_chip
+from .lpgbt_i2c import ic_lock
+from ..utils.metrics import REGISTRY
+from dataclasses import dataclass, asdict
+import json
+import os
+import threading
+import time
+
+# lpGBT v1 register map / ADC inputs
+CHIPID_ADDR = 0x000          # CHIPID0..3, fused chip identifier
+ADC_OFFSET_INPUT = 0xf       # VREF/2, reads the ADC offset
+ADC_GAIN_INPUT = 0xC
+ADC_TEMPERATURE_INPUT = 0xe  # internal temperature sensor
+
+CALIBRATION_AGE = REGISTRY.gauge("etl_lpgbt_adc_calibration_age_seconds", "Age of the lpGBT ADC calibration in use")
+CALIBRATION_GAIN = REGISTRY.gauge("etl_lpgbt_adc_gain", "lpGBT ADC gain in use")
+CALIBRATION_OFFSET = REGISTRY.gauge("etl_lpgbt_adc_offset", "lpGBT ADC offset in use")
+
+DEFAULT_STORE = os.path.join(os.path.expanduser("~"), ".etl_mtd_daq", "lpgbt_adc_calibration.json")
+
+
+class AdcCalibrationError(RuntimeError):
+    pass
+
+
+@dataclass
+class AdcCalibration:
+    """
+    chip_id: fused CHIPID of the lpGBT the calibration belongs to
+    gain: ADC gain, nominal 1.85
+    offset: ADC reading of VREF/2, nominal 512
+    timestamp: unix time of the measurement
+    temperature: raw ADC reading of the lpGBT temperature sensor during the measurement
+    """
+    chip_id: str
+    gain: float
+    offset: float
+    timestamp: float
+    temperature: float
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.timestamp
+
+
+def chip_identity(lpgbt: lpgbt_chip) -> str:
+    """
+    Reads the fused CHIPID of the lpGBT
+    """
+    chip_id = 0
+    for i in range(4):
+        chip_id |= lpgbt.read_reg(CHIPID_ADDR + i) << (8*i)
+    return f"{chip_id:08x}"
+
+
+def read_temperature(lpgbt: lpgbt_chip) -> float:
+    """
+    Raw ADC reading of the internal lpGBT temperature sensor
+    """
+    return lpgbt.read_adc(ADC_TEMPERATURE_INPUT)
+
+
+def measure_adc_calibration(lpgbt: lpgbt_chip, chip_id: str) -> AdcCalibration:
+    '''
+    Calculates the offset and gain of the lpGBT ADCs
+    '''
+    offset = lpgbt.read_adc(ADC_OFFSET_INPUT)
+
+    intial_val = lpgbt.read_reg(lpgbt.Reg['ADCMON'])
+    mask = ~(1 << 4)
+    lpgbt.write_reg(lpgbt.Reg['ADCMON'], intial_val & mask)
+
+    # ADC = (Vdiff/Vref)*Gain*512 + Offset
+    gain = 2*abs(lpgbt.read_adc(ADC_GAIN_INPUT)-offset)/512
+    print(f"Calibrated lpgbt  ADC. Gain: {gain} / Offset: {offset}")
+
+    lpgbt.write_reg(lpgbt.Reg['ADCMON'], intial_val)
+    if gain < 1.65 or gain > 2 or offset < 490 or offset > 530:
+        raise AdcCalibrationError("ADC Calibration Failed!")
+
+    return AdcCalibration(
+        chip_id     = chip_id,
+        gain        = gain,
+        offset      = offset,
+        timestamp   = time.time(),
+        temperature = read_temperature(lpgbt))
+
+
+class AdcCalibrationStore:
+    """
+    JSON file holding the last calibration of every lpGBT, keyed by chip identity
+    """
+    def __init__(self, path: str = DEFAULT_STORE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load_all(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def get(self, chip_id: str) -> AdcCalibration | None:
+        with self._lock:
+            entry = self._load_all().get(chip_id)
+        return AdcCalibration(**entry) if entry else None
+
+    def put(self, calibration: AdcCalibration):
+        with self._lock:
+            calibrations = self._load_all()
+            calibrations[calibration.chip_id] = asdict(calibration)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(calibrations, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+class AdcCalibrator:
+    """
+    Keeps a valid ADC calibration available for one lpGBT.
+
+    load_or_calibrate() uses the stored calibration if there is one, otherwise the ADC is
+    calibrated right away. A stored calibration older than `max_age` seconds, or one whose
+    temperature differs by more than `max_temperature_drift` ADC counts from the current
+    reading, is still used but re-measured in a background thread.
+
+    All users of the lpGBT ADC should hold `lock` while selecting inputs and reading. It is
+    the lpGBT's IC lock (ic_lock), so ADC reads, including the background recalibration,
+    never overlap the I2C scheduler or any other access to the IC link.
+    """
+    def __init__(self, lpgbt: lpgbt_chip, store: AdcCalibrationStore | None = None,
+                 max_age: float = 24*3600, max_temperature_drift: float = 10, check_interval: float = 60):
+        self.lpgbt = lpgbt
+        self.store = store or AdcCalibrationStore()
+        self.max_age = max_age
+        self.max_temperature_drift = max_temperature_drift
+        self.check_interval = check_interval
+        self.lock = ic_lock(lpgbt)
+        self.calibration: AdcCalibration | None = None
+        self._chip_id: str | None = None
+        self._last_check = 0.0
+        self._thread: threading.Thread | None = None
+
+    @property
+    def chip_id(self) -> str:
+        if self._chip_id is None:
+            with self.lock:
+                self._chip_id = chip_identity(self.lpgbt)
+        return self._chip_id
+
+    @property
+    def calibrated(self) -> bool:
+        return self.calibration is not None
+
+    def _use(self, calibration: AdcCalibration):
+        self.calibration = calibration
+        CALIBRATION_AGE.set_function(lambda: self.calibration.age, chip_id=calibration.chip_id)
+        CALIBRATION_GAIN.set(calibration.gain, chip_id=calibration.chip_id)
+        CALIBRATION_OFFSET.set(calibration.offset, chip_id=calibration.chip_id)
+
+    def load_or_calibrate(self) -> AdcCalibration:
+        calibration = self.store.get(self.chip_id)
+        if calibration is None:
+            return self.calibrate()
+        self._use(calibration)
+        print(f"Loaded lpgbt ADC calibration for chip {self.chip_id}, age {self.calibration.age/3600:.1f} h")
+        self.check(force=True)
+        return self.calibration
+
+    @property
+    def gain(self) -> float:
+        return self.calibration.gain
+
+    @property
+    def offset(self) -> float:
+        return self.calibration.offset
+
+    @property
+    def recalibrating(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def calibrate(self) -> AdcCalibration:
+        """
+        Measures the calibration now and persists it
+        """
+        with self.lock:
+            calibration = measure_adc_calibration(self.lpgbt, self.chip_id)
+        self._use(calibration)
+        self.store.put(calibration)
+        return calibration
+
+    def is_stale(self, temperature: float | None = None) -> bool:
+        if self.calibration.age > self.max_age:
+            return True
+        if temperature is not None and abs(temperature - self.calibration.temperature) > self.max_temperature_drift:
+            return True
+        return False
+
+    def check(self, force: bool = False):
+        """
+        Cheap to call before every read: at most every `check_interval` seconds the lpGBT
+        temperature is read and a background recalibration is started if the calibration is stale
+        """
+        if self.calibration is None:
+            return
+        now = time.time()
+        if not force and now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        with self.lock:
+            temperature = read_temperature(self.lpgbt)
+        if self.is_stale(temperature) and not self.recalibrating:
+            print(f"lpgbt ADC calibration for chip {self.chip_id} is stale, recalibrating in background")
+            self._thread = threading.Thread(target=self._background_calibrate, name="lpgbt-adc-calibration", daemon=True)
+            self._thread.start()
+
+    def _background_calibrate(self):
+        try:
+            self.calibrate()
+        except Exception as error:
+            print(f"Background lpgbt ADC calibration failed, keeping previous values: {error}")
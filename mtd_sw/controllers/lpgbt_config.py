@@ -0,0 +1,250 @@
+"""
+Description:
+lpGBT register configuration images. A CSV configuration (register name, hex value) is
+parsed once into an address -> value image, compared against a block readback of the
+chip, and only the registers that differ are written, grouped into contiguous IC block
+writes (icWriteBlock through lpgbt.write_regs).
+
+The whole register space can be read back with a few dozen block reads (read_all),
+decoded into named fields and verified against an expected image (verify).
+"""
+from .lpgbt_controller import lpgbt_chip
+from dataclasses import dataclass
+import csv
+import os
+import numpy as np
+
+N_REGISTERS = 0x200     # lpGBT v1 register space, 0x000-0x1ff
+LAST_REGISTER = 0x1d7   # ROM register, the last one implemented
+ROM_VALUE = 0xa6
+MAX_BLOCK = 16          # registers per IC block transaction
+
+MISMATCH_DTYPE = np.dtype([
+    ("address",  np.uint16),
+    ("register", "U32"),
+    ("expected", np.uint8),
+    ("actual",   np.uint8),
+    ("fields",   "U128"),   # names of the fields whose bits differ
+])
+
+
+@dataclass
+class RegisterImage:
+    """
+    values: register contents indexed by address
+    defined: which addresses the image sets
+    """
+    values: np.ndarray
+    defined: np.ndarray
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(N_REGISTERS, dtype=np.uint8), np.zeros(N_REGISTERS, dtype=bool))
+
+    @property
+    def addresses(self) -> np.ndarray:
+        return np.flatnonzero(self.defined)
+
+    def __len__(self) -> int:
+        return int(self.defined.sum())
+
+    def set(self, address: int, value: int):
+        self.values[address] = value
+        self.defined[address] = True
+
+    def items(self):
+        return zip(self.addresses.tolist(), self.values[self.defined].tolist())
+
+
+_csv_cache: dict[tuple, RegisterImage] = {}
+
+
+def load_csv_image(path: str, reg_map: dict) -> RegisterImage:
+    """
+    Parses a Tamalero style lpGBT configuration CSV (header row, then register,value rows).
+    N/A values and POWERUP registers are skipped, the latter are handled by config_done.
+    The parsed image is cached until the file changes.
+    """
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key in _csv_cache:
+        return _csv_cache[key]
+
+    image = RegisterImage.empty()
+    with open(path, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader)  # skip the header row
+        for register, value in reader:
+            if value == 'N/A' or "POWERUP" in register.upper():
+                continue
+            image.set(reg_map[register], int(value, 16))
+    _csv_cache[key] = image
+    return image
+
+
+def contiguous_blocks(addresses, max_block: int = MAX_BLOCK, max_gap: int = 0) -> list[tuple[int, int]]:
+    """
+    Groups sorted addresses into (start, length) runs of at most max_block registers.
+    Runs separated by up to max_gap addresses are joined (the gap is written too).
+    """
+    blocks = []
+    for address in np.asarray(addresses).tolist():
+        if blocks:
+            start, length = blocks[-1]
+            if address - (start + length) <= max_gap and address - start < max_block:
+                blocks[-1] = (start, address - start + 1)
+                continue
+        blocks.append((address, 1))
+    return blocks
+
+
+def read_image(lpgbt: lpgbt_chip, addresses, max_block: int = MAX_BLOCK) -> RegisterImage:
+    """
+    Reads the given addresses back with block reads, gaps of a few registers are read
+    along with their neighbours since one longer read is cheaper than two transactions
+    """
+    image = RegisterImage.empty()
+    for start, length in contiguous_blocks(addresses, max_block=max_block, max_gap=max_block):
+        image.values[start:start + length] = lpgbt.read_regs(start, length)
+        image.defined[start:start + length] = True
+    return image
+
+
+def diff_images(expected: RegisterImage, actual: RegisterImage) -> np.ndarray:
+    """
+    Addresses defined in expected whose value differs in actual (or that actual does not cover)
+    """
+    differs = expected.defined & (~actual.defined | (expected.values != actual.values))
+    return np.flatnonzero(differs)
+
+
+def write_image(lpgbt: lpgbt_chip, image: RegisterImage, verify_first: bool = True,
+                max_block: int = MAX_BLOCK, max_gap: int = 0, current: RegisterImage | None = None) -> int:
+    """
+    Writes an image to the lpGBT with block writes. With verify_first the chip is read back
+    and only differing registers are written. With max_gap > 0, gaps of up to max_gap
+    registers between differing ones are rewritten with their current value to save
+    transactions, but only if every gap register is in the image: registers outside it may
+    be command or reset registers where a write has side effects.
+
+    Returns the number of write transactions issued.
+    """
+    if verify_first:
+        if current is None:
+            current = read_image(lpgbt, image.addresses, max_block=max_block)
+        to_write = diff_images(image, current)
+        target = RegisterImage(np.where(image.defined, image.values, current.values), image.defined)
+    else:
+        to_write = image.addresses
+        target = image
+        max_gap = 0
+
+    transactions = 0
+    for start, length in contiguous_blocks(to_write, max_block=max_block, max_gap=max_gap):
+        if target.defined[start:start + length].all():
+            lpgbt.write_regs(start, target.values[start:start + length].tolist())
+            transactions += 1
+            continue
+        # a gap register is not in the image, write the differing runs on their own
+        inside = to_write[(to_write >= start) & (to_write < start + length)]
+        for sub_start, sub_length in contiguous_blocks(inside, max_block=max_block):
+            lpgbt.write_regs(sub_start, target.values[sub_start:sub_start + sub_length].tolist())
+            transactions += 1
+    return transactions
+
+
+def apply_csv_config(lpgbt: lpgbt_chip, path: str = 'tamalero_lpgbt_config.csv', verify_first: bool = True) -> int:
+    """
+    Writes a CSV configuration to the lpGBT, only touching registers that differ
+    """
+    image = load_csv_image(path, lpgbt.Reg)
+    transactions = write_image(lpgbt, image, verify_first=verify_first)
+    print(f"lpGBT configuration {path}: {len(image)} registers, {transactions} write transactions")
+    return transactions
+
+
+def read_all(lpgbt: lpgbt_chip, max_block: int = MAX_BLOCK) -> RegisterImage:
+    """
+    Reads the full lpGBT register map (0x000 up to the ROM register) with block reads
+    """
+    return read_image(lpgbt, np.arange(LAST_REGISTER + 1), max_block=max_block)
+
+
+_field_tables: dict[int, dict] = {}
+
+
+def field_table(lpgbt: lpgbt_chip) -> dict:
+    """
+    Named bit fields of every register, taken from the register classes of the lpGBT
+    control library (e.g. lpgbt.CHIPCONFIG.HIGHSPEEDDATAOUTINVERT.bit_mask). Built once per
+    lpGBT class as arrays: address, bit_mask, offset, register and field names.
+    """
+    key = id(type(lpgbt))
+    if key in _field_tables:
+        return _field_tables[key]
+
+    addresses, masks, registers, fields = [], [], [], []
+    reverse = {address: name for name, address in lpgbt.Reg.items()}
+    for address, register in sorted(reverse.items()):
+        register_cls = getattr(lpgbt, register, None)
+        named = [(name, getattr(field, "bit_mask")) for name, field in vars(register_cls).items()
+                 if hasattr(field, "bit_mask")] if register_cls is not None else []
+        for name, mask in named or [(register, 0xff)]:
+            addresses.append(address)
+            masks.append(mask)
+            registers.append(register)
+            fields.append(name)
+
+    masks = np.array(masks, dtype=np.uint8)
+    table = {
+        "address":  np.array(addresses, dtype=np.uint16),
+        "bit_mask": masks,
+        "offset":   np.array([(m & -m).bit_length() - 1 if m else 0 for m in masks.tolist()], dtype=np.uint8),
+        "register": np.array(registers),
+        "field":    np.array(fields),
+    }
+    _field_tables[key] = table
+    return table
+
+
+def decode_fields(lpgbt: lpgbt_chip, image: RegisterImage) -> dict[str, int]:
+    """
+    Values of all named fields ("REGISTER.FIELD") covered by an image
+    """
+    table = field_table(lpgbt)
+    covered = image.defined[table["address"]]
+    values = (image.values[table["address"]] & table["bit_mask"]) >> table["offset"]
+    names = np.where(table["field"] == table["register"], table["register"],
+                     np.char.add(np.char.add(table["register"], "."), table["field"]))
+    return dict(zip(names[covered].tolist(), values[covered].tolist()))
+
+
+def verify(lpgbt: lpgbt_chip, expected: RegisterImage, actual: RegisterImage | None = None) -> np.ndarray:
+    """
+    Compares the chip (or a previous readback) against an expected image and returns a
+    MISMATCH_DTYPE table, empty if everything matches. Only expected registers are read.
+    """
+    if actual is None:
+        actual = read_image(lpgbt, expected.addresses)
+    addresses = diff_images(expected, actual)
+
+    table = field_table(lpgbt)
+    differs = expected.values[table["address"]] ^ actual.values[table["address"]]
+    bad_field = (differs & table["bit_mask"]) != 0
+    reverse = {address: name for name, address in lpgbt.Reg.items()}
+
+    mismatches = np.zeros(len(addresses), dtype=MISMATCH_DTYPE)
+    mismatches["address"] = addresses
+    mismatches["register"] = [reverse.get(int(a), hex(a)) for a in addresses]
+    mismatches["expected"] = expected.values[addresses]
+    mismatches["actual"] = actual.values[addresses]
+    mismatches["fields"] = [",".join(table["field"][bad_field & (table["address"] == a)].tolist()) for a in addresses]
+    return mismatches
+
+
+def print_mismatches(mismatches: np.ndarray):
+    if len(mismatches) == 0:
+        print("lpGBT registers match the expected configuration")
+        return
+    print("{:<8}{:<24}{:<10}{:<10}{}".format("Addr", "Register", "Expected", "Actual", "Fields"))
+    for m in mismatches:
+        print(f"{int(m['address']):#05x}   {m['register']:<24}{int(m['expected']):#04x}      {int(m['actual']):#04x}      {m['fields']}")
@@ -0,0 +1,186 @@
+"""
+Description:
+GPIO bank of an lpGBT with the PIODIR/PIOOUT registers mirrored in memory. Several pins
+are changed with a single register write per bank (H: pins 8-15, L: pins 0-7, both in
+one block write), so e.g. the reset lines of all ETROCs on a module toggle together.
+Pins are addressed by number or by their name in the lpGBT configuration (RESET1, MUXCNT1, ...).
+
+bank = gpio_bank(lpgbt)
+bank.set_pins({"RESET1": 0, "RESET2": 0})
+bank.pulse({"RESET1": 0, "RESET2": 0}, 0.05)
+"""
+from .lpgbt_controller import lpgbt_chip
+from .lpgbt_i2c import ic_lock
+import asyncio
+import threading
+import time
+
+N_PINS = 16
+
+
+class GpioBank:
+    def __init__(self, lpgbt: lpgbt_chip, pin_names: dict[str, int] | None = None):
+        """
+        pin_names: name -> pin number, taken from the lpGBT configuration if not given.
+                   Names without a pin number are written one by one with write_gpio_output.
+        """
+        self.lpgbt = lpgbt
+        self.pin_names = pin_names if pin_names is not None else self._config_pin_names()
+        self._out: int | None = None
+        self._dir: int | None = None
+        # the lpGBT's IC lock: guards the mirror and serializes the register accesses with
+        # the I2C scheduler threads
+        self.lock = ic_lock(lpgbt)
+
+    def _config_pin_names(self) -> dict[str, int]:
+        try:
+            return {gpio["register"]: int(gpio["pin"]) for gpio in self.lpgbt.config["configurations"]["GPIO"]}
+        except (AttributeError, KeyError, TypeError):
+            return {}
+
+    def pin(self, pin: int | str) -> int | None:
+        if isinstance(pin, int):
+            if not 0 <= pin < N_PINS:
+                raise ValueError(f"lpGBT GPIO pin {pin} out of range")
+            return pin
+        return self.pin_names.get(pin)
+
+    def _load(self):
+        # PIODIRH, PIODIRL, PIOOUTH, PIOOUTL are contiguous: one block read
+        dir_h, dir_l, out_h, out_l = self.lpgbt.read_regs(self.lpgbt.Reg['PIODIRH'], 4)
+        self._dir = (dir_h << 8) | dir_l
+        self._out = (out_h << 8) | out_l
+
+    @property
+    def out(self) -> int:
+        with self.lock:
+            if self._out is None:
+                self._load()
+            return self._out
+
+    @property
+    def direction(self) -> int:
+        with self.lock:
+            if self._dir is None:
+                self._load()
+            return self._dir
+
+    def invalidate(self):
+        """
+        Call when the GPIO registers were changed behind the back of this class
+        """
+        with self.lock:
+            self._out = None
+            self._dir = None
+
+    def _write_word(self, high_reg: str, old: int, new: int):
+        changed = old ^ new
+        high, low = (new >> 8) & 0xff, new & 0xff
+        if changed & 0xff00 and changed & 0x00ff:
+            self.lpgbt.write_regs(self.lpgbt.Reg[high_reg], [high, low])
+        elif changed & 0xff00:
+            self.lpgbt.write_reg(self.lpgbt.Reg[high_reg], high)
+        elif changed & 0x00ff:
+            self.lpgbt.write_reg(self.lpgbt.Reg[high_reg[:-1] + "L"], low)
+
+    @staticmethod
+    def _apply(word: int, pins: dict[int, int]) -> int:
+        for pin, value in pins.items():
+            word = (word & ~(1 << pin)) | ((1 if value else 0) << pin)
+        return word
+
+    def _split(self, pins: dict) -> tuple[dict[int, int], dict[str, int]]:
+        numbered, named = {}, {}
+        for pin, value in pins.items():
+            number = self.pin(pin)
+            if number is None:
+                named[pin] = value
+            else:
+                numbered[number] = value
+        return numbered, named
+
+    def set_pins(self, pins: dict[int | str, int]):
+        """
+        Sets the outputs of several pins, writing only the PIOOUT registers that change
+        """
+        numbered, named = self._split(pins)
+        with self.lock:
+            if numbered:
+                old = self.out
+                new = self._apply(old, numbered)
+                self._write_word('PIOOUTH', old, new)
+                self._out = new
+            if named:
+                for name, value in named.items():
+                    self.lpgbt.write_gpio_output(name, value)
+                # the pin numbers of these are unknown, re-read PIOOUT before the next write
+                self._out = None
+
+    def set_pin(self, pin: int | str, value: int):
+        self.set_pins({pin: value})
+
+    def get_pin(self, pin: int | str) -> int:
+        """
+        Output value last written to a pin (from the mirror, no lpGBT access)
+        """
+        number = self.pin(pin)
+        if number is None:
+            raise KeyError(f"GPIO pin {pin} not found in the lpGBT configuration")
+        return (self.out >> number) & 0x1
+
+    def set_direction(self, pins: dict[int | str, int]):
+        """
+        1 makes a pin an output, 0 an input
+        """
+        numbered, named = self._split(pins)
+        if named:
+            raise KeyError(f"GPIO pins {list(named)} not found in the lpGBT configuration")
+        with self.lock:
+            old = self.direction
+            new = self._apply(old, numbered)
+            self._write_word('PIODIRH', old, new)
+            self._dir = new
+
+    def sequence(self, steps: list[tuple[dict[int | str, int], float]]):
+        """
+        Runs (pins, wait) steps: sets the pins of a step, then waits before the next one
+        """
+        for pins, wait in steps:
+            self.set_pins(pins)
+            if wait:
+                time.sleep(wait)
+
+    def pulse(self, pins: dict[int | str, int], duration: float):
+        """
+        Drives pins to the given values for `duration` seconds, then back to their previous values
+        """
+        previous = {pin: self.get_pin(pin) if self.pin(pin) is not None else 1 - value for pin, value in pins.items()}
+        self.sequence([(pins, duration), (previous, 0)])
+
+    async def sequence_async(self, steps: list[tuple[dict[int | str, int], float]], run_blocking=None):
+        """
+        Same as sequence, waiting on the event loop. run_blocking(func, *args) can route the
+        register writes to an executor (e.g. etroc_chip._run_blocking)
+        """
+        for pins, wait in steps:
+            if run_blocking is not None:
+                await run_blocking(self.set_pins, pins)
+            else:
+                self.set_pins(pins)
+            if wait:
+                await asyncio.sleep(wait)
+
+
+_banks_lock = threading.Lock()
+
+
+def gpio_bank(lpgbt: lpgbt_chip) -> GpioBank:
+    """
+    The GPIO bank shared by every controller using this lpGBT, kept on the chip object so
+    it goes away with it
+    """
+    with _banks_lock:
+        bank = getattr(lpgbt, "_gpio_bank", None)
+        if bank is None:
+            bank = lpgbt._gpio_bank = GpioBank(lpgbt)
+        return bank
@@ -0,0 +1,248 @@
+"""
+Description:
+Transaction scheduler for the three I2C masters of an lpGBT. Each master has its own
+queue and worker thread, so transactions on different masters are in flight together
+while the ones on the same master stay in order. Results come back as futures.
+
+scheduler = i2c_scheduler(lpgbt)
+future = scheduler.read(master_id=2, slave_address=0x60, reg_address=0x0)
+scheduler.write(master_id=0, slave_address=0x61, reg_address=0x4, data=0x1)
+future.result()
+
+The lpGBT software (and uHAL below it) is not thread-safe, so every access to the IC link
+holds the lpGBT's IC lock (ic_lock). A transaction is split into phases: loading and
+starting it on its master, polling the master status, and reading back the data. Only the
+register accesses of each phase hold the IC lock, the waits between polls do not, so while
+one master clocks its bytes on the I2C bus the others are loaded or polled.
+Anything else touching the IC link from another thread must hold ic_lock(lpgbt) too (the
+GPIO bank, the ADC calibrator and the mux64 reads, and the link prober do).
+"""
+from .lpgbt_controller import lpgbt_chip
+from ..utils.metrics import REGISTRY
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+import threading
+import time
+
+I2C_MASTERS = (0, 1, 2)
+MAX_BYTES = 16
+
+# lpGBT I2C master commands (I2CMxCMD)
+CMD_WRITE_CRA = 0x0
+CMD_W_MULTI_4BYTE0 = 0x8
+CMD_WRITE_MULTI = 0xC
+CMD_READ_MULTI = 0xD
+# I2CMxSTATUS bits
+STATUS_SUCCESS = 0x04
+STATUS_LEVEERR = 0x08
+STATUS_NOACK = 0x40
+NBYTES_MASK = 0x7C          # control register bits 6:2
+POLL_INTERVAL = 0.0002
+
+_attach_lock = threading.RLock()     # guards attaching the IC lock and the scheduler to a chip
+
+I2C_QUEUE_DEPTH = REGISTRY.gauge("etl_i2c_queue_depth", "Transactions waiting in the queue of an lpGBT I2C master")
+
+
+class I2CTransactionError(RuntimeError):
+    pass
+
+
+def ic_lock(lpgbt: lpgbt_chip) -> threading.RLock:
+    """
+    Lock serializing the accesses to the IC link of an lpGBT, kept on the chip object
+    """
+    lock = getattr(lpgbt, "_ic_lock", None)
+    if lock is None:
+        with _attach_lock:
+            lock = getattr(lpgbt, "_ic_lock", None)
+            if lock is None:
+                lock = lpgbt._ic_lock = threading.RLock()
+    return lock
+
+
+class I2CScheduler:
+    def __init__(self, lpgbt: lpgbt_chip, masters: tuple[int, ...] = I2C_MASTERS, serialize_ic: bool = True,
+                 split_phase: bool = True, poll_interval: float = POLL_INTERVAL):
+        """
+        serialize_ic: hold ic_lock for every IC access, only for backends that are thread-safe
+                      can this be turned off
+        split_phase: run transactions as register-level phases so masters overlap. Without it
+                     (or if the lpGBT register map has no I2C master registers) every
+                     i2c_master_read/write holds the IC lock from start to end.
+        """
+        self.lpgbt = lpgbt
+        self.masters = tuple(masters)
+        self.poll_interval = poll_interval
+        self._ic_lock = ic_lock(lpgbt) if serialize_ic else nullcontext()
+        self._master_locks = {master: threading.Lock() for master in self.masters}
+        self.split_phase = split_phase and self._has_master_registers()
+        if split_phase and not self.split_phase:
+            print("lpGBT register map has no I2C master registers, I2C transactions are not split")
+        self._executors = {
+            master: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"lpgbt-{id(lpgbt):x}-i2cm{master}")
+            for master in self.masters}
+        self._queued = {master: 0 for master in self.masters}
+        self._queued_lock = threading.Lock()
+        self._labels = {master: {"lpgbt": f"{id(lpgbt):x}", "master": master} for master in self.masters}
+        queued = self._queued
+        for master in self.masters:
+            I2C_QUEUE_DEPTH.set_function(partial(queued.get, master, 0), **self._labels[master])
+
+    def _has_master_registers(self) -> bool:
+        names = [f"I2CM{master}{reg}" for master in self.masters
+                 for reg in ("CMD", "ADDRESS", "DATA0", "CTRL", "STATUS", "READ0")]
+        try:
+            return all(name in self.lpgbt.Reg for name in names)
+        except (AttributeError, TypeError):
+            return False
+
+    def _reg(self, master_id: int, name: str) -> int:
+        return self.lpgbt.Reg[f"I2CM{master_id}{name}"]
+
+    def executor(self, master_id: int) -> ThreadPoolExecutor:
+        if master_id not in self._executors:
+            raise ValueError(f"lpGBT I2C master {master_id} not handled by this scheduler ({list(self._executors)})")
+        return self._executors[master_id]
+
+    # ---- transaction phases, each IC access holds the IC lock ----
+    def _start(self, master_id: int, command: int, slave_address: int, nbytes: int, data: list[int] = ()):
+        with self._ic_lock:
+            # keep the frequency/SCL drive of the control register, set the byte count
+            control = self.lpgbt.read_reg(self._reg(master_id, "CTRL"))
+            self.lpgbt.write_regs(self._reg(master_id, "DATA0"), [(control & ~NBYTES_MASK) | (nbytes << 2), 0, 0, 0])
+            self.lpgbt.write_reg(self._reg(master_id, "CMD"), CMD_WRITE_CRA)
+            for i in range(0, len(data), 4):
+                chunk = list(data[i:i + 4])
+                self.lpgbt.write_regs(self._reg(master_id, "DATA0"), chunk + [0]*(4 - len(chunk)))
+                self.lpgbt.write_reg(self._reg(master_id, "CMD"), CMD_W_MULTI_4BYTE0 + i//4)
+            self.lpgbt.write_reg(self._reg(master_id, "ADDRESS"), slave_address)
+            self.lpgbt.write_reg(self._reg(master_id, "CMD"), command)
+
+    def _await(self, master_id: int, slave_address: int, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._ic_lock:
+                status = self.lpgbt.read_reg(self._reg(master_id, "STATUS"))
+            if status & STATUS_SUCCESS:
+                return
+            if status & STATUS_NOACK:
+                raise I2CTransactionError(f"I2C master {master_id}: slave {hex(slave_address)} NACK")
+            if status & STATUS_LEVEERR:
+                raise I2CTransactionError(f"I2C master {master_id}: SDA low at the start of the transaction (LEVEERR)")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"I2C master {master_id}: transaction with {hex(slave_address)} timed out")
+            time.sleep(self.poll_interval)
+
+    def _read_data(self, master_id: int, read_len: int) -> list[int]:
+        # byte i of a multi-byte read is in I2CMxREAD(15 - i)
+        last = self._reg(master_id, "READ0") + MAX_BYTES - 1
+        with self._ic_lock:
+            values = self.lpgbt.read_regs(last - read_len + 1, read_len)
+        return list(values)[::-1]
+
+    @staticmethod
+    def _address_bytes(reg_address: int, reg_address_width: int) -> list[int]:
+        return [(reg_address >> (8*i)) & 0xff for i in range(reg_address_width)]
+
+    def i2c_write(self, master_id: int, slave_address: int, reg_address_width: int, reg_address: int, data,
+                  timeout: float = 0.1, addr_10bit: bool = False):
+        """
+        Blocking register write, same arguments as lpgbt_chip.i2c_master_write
+        """
+        with self._master_locks[master_id]:
+            if not self.split_phase or addr_10bit:
+                with self._ic_lock:
+                    return self.lpgbt.i2c_master_write(master_id=master_id, slave_address=slave_address,
+                                                       reg_address_width=reg_address_width, reg_address=reg_address,
+                                                       data=data, timeout=timeout, addr_10bit=addr_10bit)
+            payload = self._address_bytes(reg_address, reg_address_width) + ([data] if isinstance(data, int) else list(data))
+            if len(payload) > MAX_BYTES:
+                raise ValueError(f"I2C write of {len(payload)} bytes, at most {MAX_BYTES} including the address")
+            self._start(master_id, CMD_WRITE_MULTI, slave_address, len(payload), payload)
+            self._await(master_id, slave_address, timeout)
+
+    def i2c_read(self, master_id: int, slave_address: int, read_len: int, reg_address_width: int, reg_address: int,
+                 timeout: float = 0.1, addr_10bit: bool = False) -> list[int]:
+        """
+        Blocking register read, same arguments as lpgbt_chip.i2c_master_read
+        """
+        with self._master_locks[master_id]:
+            if not self.split_phase or addr_10bit:
+                with self._ic_lock:
+                    return self.lpgbt.i2c_master_read(master_id=master_id, slave_address=slave_address,
+                                                      read_len=read_len, reg_address_width=reg_address_width,
+                                                      reg_address=reg_address, timeout=timeout, addr_10bit=addr_10bit)
+            if read_len + reg_address_width > MAX_BYTES:
+                raise ValueError(f"I2C read of {read_len} bytes, at most {MAX_BYTES - reg_address_width}")
+            address = self._address_bytes(reg_address, reg_address_width)
+            self._start(master_id, CMD_WRITE_MULTI, slave_address, len(address), address)
+            self._await(master_id, slave_address, timeout)
+            self._start(master_id, CMD_READ_MULTI, slave_address, read_len)
+            self._await(master_id, slave_address, timeout)
+            return self._read_data(master_id, read_len)
+
+    # ---- queued execution ----
+    def _dequeued(self, master_id: int, function: Callable, *args, **kwargs):
+        with self._queued_lock:
+            self._queued[master_id] -= 1
+        return function(*args, **kwargs)
+
+    def submit(self, master_id: int, function: Callable, *args, **kwargs) -> Future:
+        """
+        Queues a blocking call (e.g. an ETROC read-modify-write) on the worker of an I2C master.
+        The call itself must take the IC lock for IC accesses (i2c_read/i2c_write do).
+        """
+        executor = self.executor(master_id)
+        with self._queued_lock:
+            self._queued[master_id] += 1
+        try:
+            return executor.submit(self._dequeued, master_id, function, *args, **kwargs)
+        except BaseException:
+            with self._queued_lock:
+                self._queued[master_id] -= 1
+            raise
+
+    def write(self, master_id: int, slave_address: int, reg_address: int, data, reg_address_width: int = 2,
+              timeout: float = 10) -> Future:
+        return self.submit(master_id, partial(self.i2c_write, master_id=master_id, slave_address=slave_address,
+                           reg_address_width=reg_address_width, reg_address=reg_address, data=data, timeout=timeout))
+
+    def read(self, master_id: int, slave_address: int, reg_address: int, read_len: int = 1,
+             reg_address_width: int = 2, timeout: float = 10) -> Future:
+        return self.submit(master_id, partial(self.i2c_read, master_id=master_id, slave_address=slave_address,
+                           read_len=read_len, reg_address_width=reg_address_width, reg_address=reg_address,
+                           timeout=timeout))
+
+    def shutdown(self, wait: bool = True):
+        for executor in self._executors.values():
+            executor.shutdown(wait=wait)
+        for labels in self._labels.values():
+            I2C_QUEUE_DEPTH.remove(**labels)
+
+
+def i2c_scheduler(lpgbt: lpgbt_chip) -> I2CScheduler:
+    """
+    The scheduler shared by everything that talks to this lpGBT's I2C masters, kept on the
+    chip object so it goes away with it
+    """
+    scheduler = getattr(lpgbt, "_i2c_scheduler", None)
+    if scheduler is None:
+        with _attach_lock:
+            scheduler = getattr(lpgbt, "_i2c_scheduler", None)
+            if scheduler is None:
+                scheduler = lpgbt._i2c_scheduler = I2CScheduler(lpgbt)
+    return scheduler
+
+
+def shutdown_i2c_scheduler(lpgbt: lpgbt_chip, wait: bool = True):
+    """
+    Stops the worker threads of the lpGBT's shared scheduler (a new one is made on next use)
+    """
+    with _attach_lock:
+        scheduler = getattr(lpgbt, "_i2c_scheduler", None)
+        lpgbt._i2c_scheduler = None
+    if scheduler is not None:
+        scheduler.shutdown(wait=wait)
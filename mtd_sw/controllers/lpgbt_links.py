@@ -0,0 +1,265 @@
+"""
+Description:
+Discovery of a working lpGBT link. Candidate (downlink, uplink, lpGBT address, uplink
+invert) combinations are probed with a bounded number of retries and the search stops at
+the first candidate that reads the ROM register back as 0xa6. The last good candidate of
+every board is cached so the next bring-up tries it first.
+
+def make_lpgbt(downlink):
+    return lpgbt_chip("Master LPGBT", link=downlink, connection=...)
+
+link = discover_link(EmpLinkProber(make_lpgbt), board="RB0")
+lpgbt = prober.lpgbt(link.downlink)
+"""
+from .lpgbt_controller import lpgbt_chip
+from .lpgbt_config import ROM_VALUE, LAST_REGISTER
+from .lpgbt_i2c import ic_lock
+from ..utils.metrics import REGISTRY
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, asdict
+import itertools
+import json
+import os
+import threading
+import time
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".etl_mtd_daq", "lpgbt_links.json")
+
+LINK_PROBES = REGISTRY.counter("etl_link_probes_total", "lpGBT link probe attempts")
+LINK_RETRIES = REGISTRY.counter("etl_link_retries_total", "lpGBT link probe retries after a failed attempt")
+
+
+class LinkDiscoveryError(RuntimeError):
+    pass
+
+
+@dataclass(frozen=True)
+class LinkCandidate:
+    """
+    lpgbt_address None keeps the address the lpgbt_chip was created with
+    """
+    downlink: int
+    uplink: int
+    lpgbt_address: int | None = None
+    invert: bool = False
+
+
+def candidates(downlinks=(4,), uplinks=range(12), lpgbt_addresses=(None,), inverts=(True, False),
+               same_downlink: bool = True) -> list[LinkCandidate]:
+    """
+    Search order of the uplink test apps: fixed downlink 4, every uplink, invert on first.
+    same_downlink: then the pairs with downlink == uplink, as the second pass of S_link_test
+    Pass downlinks=range(12) to scan every downlink.
+    """
+    search = [LinkCandidate(downlink, uplink, address, invert)
+              for downlink, uplink, address, invert in itertools.product(downlinks, uplinks, lpgbt_addresses, inverts)]
+    if same_downlink:
+        search += [LinkCandidate(uplink, uplink, address, invert)
+                   for uplink, address, invert in itertools.product(uplinks, lpgbt_addresses, inverts)
+                   if uplink not in downlinks]
+    return search
+
+
+def init_lpgbt(lpgbt: lpgbt_chip, settle: float = 1):
+    """
+    Power up and clock settings used by the uplink test apps before the first read
+    """
+    lpgbt.lpgbt_cont_.set_multiwrite(False)
+    lpgbt.init_lpgbt()
+    time.sleep(settle)
+    lpgbt.write_reg(0x03b, 0)
+    lpgbt.write_reg(0x0f1, 0x50)
+    lpgbt.write_reg(0x039, 0x7f)
+    lpgbt.write_reg(0x037, 0)
+    time.sleep(settle)
+
+
+class EmpLinkProber:
+    """
+    Probes candidates through the EMP controller, following the bring-up steps of the uplink
+    test apps (toggle downlink into uplink, uplink invert, POWERUP2, select uplink, read ROM).
+    One lpgbt_chip is created and initialized per downlink and reused for every probe on it.
+
+    All probes share the datapath link selection of one EMP controller, so they can not
+    run concurrently; use one prober per controller/board and discover_links to probe
+    boards in parallel.
+    """
+    concurrent = False
+
+    def __init__(self, make_lpgbt: Callable[[int], lpgbt_chip], settle: float = 0.1,
+                 toggle_uplink: bool = True, init: Callable[[lpgbt_chip], None] | None = init_lpgbt):
+        self.make_lpgbt = make_lpgbt
+        self.settle = settle
+        self.toggle_uplink = toggle_uplink
+        self.init = init
+        self._lpgbts: dict[int, lpgbt_chip] = {}
+        self._addresses: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def lpgbt(self, downlink: int) -> lpgbt_chip:
+        if downlink not in self._lpgbts:
+            lpgbt = self.make_lpgbt(downlink)
+            if self.init is not None:
+                self.init(lpgbt)
+            self._addresses[downlink] = lpgbt.lpgbt_cont_.lpgbt_addr
+            self._lpgbts[downlink] = lpgbt
+        return self._lpgbts[downlink]
+
+    def select(self, candidate: LinkCandidate) -> lpgbt_chip:
+        """
+        Sets the lpGBT address, uplink invert and uplink of the candidate. Both are always
+        written, so nothing is left over from the candidate probed before.
+        """
+        lpgbt = self.lpgbt(candidate.downlink)
+        com = lpgbt.lpgbt_cont_.lpgbt_com
+        with ic_lock(lpgbt):
+            if candidate.lpgbt_address is not None:
+                lpgbt.lpgbt_cont_.lpgbt_addr = hex(candidate.lpgbt_address)
+            else:
+                lpgbt.lpgbt_cont_.lpgbt_addr = self._addresses[candidate.downlink]
+            # HIGH SPEED DATA OUT INVERT, set_link writes the given CHIPCONFIG bits without
+            # waiting for the (possibly inverted) uplink
+            reg_addr = lpgbt.decode_reg_addr(lpgbt.CHIPCONFIG)
+            mask = lpgbt.CHIPCONFIG.HIGHSPEEDDATAOUTINVERT.bit_mask if candidate.invert else 0
+            com.set_link(reg_addr = reg_addr, mask = mask, lpgbt_addr = int(lpgbt.lpgbt_cont_.lpgbt_addr, 16))
+            com.emp_cont.getDatapath().selectLink(candidate.uplink)
+        return lpgbt
+
+    def probe(self, candidate: LinkCandidate) -> bool:
+        with self._lock:
+            lpgbt = self.lpgbt(candidate.downlink)
+            # the chip may be shared (uhal_pool.shared_lpgbt), keep other threads off the link
+            with ic_lock(lpgbt):
+                if self.toggle_uplink:
+                    # TOGGLE DOWNLINK INTO UPLINK
+                    lpgbt.write_reg(0x128, 0xC0)
+                    time.sleep(self.settle)
+                    lpgbt.write_reg(0x128, 0)
+                self.select(candidate)
+                lpgbt.config_done() #POWERUP2
+                time.sleep(self.settle)
+                return lpgbt.read_reg(LAST_REGISTER) == ROM_VALUE
+
+    def recover(self, candidate: LinkCandidate):
+        if candidate.downlink in self._lpgbts:
+            lpgbt = self._lpgbts[candidate.downlink]
+            with ic_lock(lpgbt):
+                lpgbt.lpgbt_cont_.lpgbt_com.reset_slow_control_logic()
+
+
+class LinkCache:
+    """
+    JSON file with the last known-good LinkCandidate of every board
+    """
+    def __init__(self, path: str = DEFAULT_CACHE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def get(self, board: str) -> LinkCandidate | None:
+        entry = self._load().get(board)
+        return LinkCandidate(**entry) if entry else None
+
+    def put(self, board: str, candidate: LinkCandidate):
+        with self._lock:
+            entries = self._load()
+            entries[board] = asdict(candidate)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+def _try_candidate(prober, candidate: LinkCandidate, retries: int, backoff: float,
+                   found: threading.Event, board: str, max_backoff: float = 1.0) -> bool:
+    for attempt in range(retries):
+        if found.is_set():
+            return False
+        LINK_PROBES.inc(board=board)
+        try:
+            if prober.probe(candidate):
+                return True
+        except Exception as error:
+            print(f"Link probe {candidate} failed: {error}")
+            if hasattr(prober, "recover"):
+                try:
+                    prober.recover(candidate)
+                except Exception as recover_error:
+                    print(f"Slow control reset failed: {recover_error}")
+        if attempt + 1 < retries:
+            LINK_RETRIES.inc(board=board)
+            time.sleep(min(backoff * 2**attempt, max_backoff))
+    return False
+
+
+def discover_link(prober, board: str = "default", search: list[LinkCandidate] | None = None,
+                  retries: int = 3, backoff: float = 0.05, cache: LinkCache | None = None,
+                  max_workers: int = 4, max_backoff: float = 1.0) -> LinkCandidate:
+    """
+    Finds a working candidate, trying the cached one for this board first. Probes run
+    concurrently only if the prober says it supports it (prober.concurrent).
+    The wait before retry n of a candidate is min(backoff*2**n, max_backoff).
+    """
+    cache = cache or LinkCache()
+    search = list(search or candidates())
+    cached = cache.get(board)
+    if cached is not None:
+        # tried on its own first, not probed again if it fails
+        search = [c for c in search if c != cached]
+
+    found = threading.Event()
+    winner = None
+    if cached is not None and _try_candidate(prober, cached, retries, backoff, found, board, max_backoff):
+        winner = cached
+    elif getattr(prober, "concurrent", False):
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(_try_candidate, prober, c, retries, backoff, found, board, max_backoff): c for c in search}
+            for future in as_completed(futures):
+                if future.result():
+                    winner = futures[future]
+                    found.set()
+                    break
+    else:
+        for candidate in search:
+            if _try_candidate(prober, candidate, retries, backoff, found, board, max_backoff):
+                winner = candidate
+                break
+
+    if winner is None:
+        tried = len(search) + (cached is not None)
+        raise LinkDiscoveryError(f"No working lpGBT link found for board {board} in {tried} candidates")
+    # leave the hardware on the winning candidate (a concurrent search may have moved on)
+    if hasattr(prober, "select"):
+        prober.select(winner)
+    cache.put(board, winner)
+    print(f"lpGBT link for board {board}: downlink {winner.downlink}, uplink {winner.uplink}, "
+          f"address {winner.lpgbt_address}, invert {winner.invert}")
+    return winner
+
+
+def discover_links(probers: dict, retries: int = 3, backoff: float = 0.05,
+                   cache: LinkCache | None = None, max_backoff: float = 1.0) -> dict[str, LinkCandidate | LinkDiscoveryError]:
+    """
+    Runs discover_link for several boards (one prober each, e.g. one per EMP controller)
+    in parallel. Boards without a working link map to their LinkDiscoveryError.
+    """
+    cache = cache or LinkCache()
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(len(probers), 1)) as pool:
+        futures = {pool.submit(discover_link, prober, board, None, retries, backoff, cache,
+                               max_backoff=max_backoff): board
+                   for board, prober in probers.items()}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except LinkDiscoveryError as error:
+                results[futures[future]] = error
+    return results
@@ -0,0 +1,161 @@
+"""
+Description:
+Retry policy for lpGBT IC and I2C master transactions. Errors are classified as
+timeouts, NACKs or link errors (anything else, e.g. a TypeError, is a bug and is raised
+straight away). Classified errors are retried with exponential backoff and jitter, and a
+recovery action (slow control reset, I2C master reset) can be run before the next attempt.
+Every retry, recovery and exhausted call is counted in the metrics registry.
+
+policy = i2c_policy(lpgbt, master_id=1)
+value = policy.call(lpgbt.i2c_master_read, master_id=1, ..., op="i2c_read")
+
+lpgbt = RetryingLpgbt(lpgbt)    # IC register accesses with ic_policy
+"""
+from .lpgbt_controller import lpgbt_chip
+from .lpgbt_i2c import ic_lock
+from ..utils.metrics import REGISTRY
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from functools import wraps
+import random
+import time
+
+TIMEOUT = "timeout"
+NACK = "nack"
+LINK = "link"
+
+RETRIES = REGISTRY.counter("etl_lpgbt_retries_total", "lpGBT IC/I2C transactions retried after an error")
+EXHAUSTED = REGISTRY.counter("etl_lpgbt_retries_exhausted_total", "lpGBT IC/I2C transactions that failed after all retries")
+RECOVERIES = REGISTRY.counter("etl_lpgbt_recoveries_total", "Recovery actions run between retries")
+
+# matched against the exception class name and message, lower case
+_TIMEOUT_WORDS = ("timeout", "timed out", "time out")
+_NACK_WORDS = ("nack", "no acknowledge", "not acknowledged", "noack")
+_LINK_WORDS = ("link", "uhal", "ipbus", "controlhub", "connection", "crc", "parity")
+
+
+class RetryExhausted(RuntimeError):
+    def __init__(self, op: str, kind: str, attempts: int, error: Exception):
+        super().__init__(f"{op or 'transaction'} failed after {attempts} attempts ({kind}): {error}")
+        self.op = op
+        self.kind = kind
+        self.attempts = attempts
+        self.error = error
+
+
+def classify(error: Exception) -> str | None:
+    """
+    Kind of a transaction error (TIMEOUT, NACK, LINK), or None if it should not be retried
+    """
+    if isinstance(error, (TypeError, ValueError, KeyError, AttributeError, NotImplementedError)):
+        return None
+    if isinstance(error, TimeoutError):
+        return TIMEOUT
+    if isinstance(error, ConnectionError):
+        return LINK
+    text = f"{type(error).__name__} {error}".lower()
+    for kind, words in ((TIMEOUT, _TIMEOUT_WORDS), (NACK, _NACK_WORDS), (LINK, _LINK_WORDS)):
+        if any(word in text for word in words):
+            return kind
+    return None
+
+
+@dataclass
+class RetryPolicy:
+    """
+    max_attempts: attempts per call, including the first one
+    base_delay, multiplier, max_delay: backoff before retry n is min(base_delay*multiplier**n, max_delay)
+    jitter: fraction of the backoff that is randomized, so retries of many chips do not line up
+    recovery: action to run before retrying, per error kind
+    """
+    max_attempts: int = 4
+    base_delay: float = 0.001
+    multiplier: float = 4
+    max_delay: float = 0.25
+    jitter: float = 0.5
+    retry_on: tuple[str, ...] = (TIMEOUT, NACK, LINK)
+    recovery: dict[str, Callable[[], None]] = field(default_factory=dict)
+
+    def delay(self, retry: int) -> float:
+        backoff = min(self.base_delay*self.multiplier**retry, self.max_delay)
+        return backoff*(1 - self.jitter*random.random())
+
+    def call(self, function: Callable, *args, op: str = "", **kwargs):
+        for attempt in range(self.max_attempts):
+            try:
+                return function(*args, **kwargs)
+            except RetryExhausted:
+                raise
+            except Exception as error:
+                kind = classify(error)
+                if kind not in self.retry_on:
+                    raise
+                if attempt + 1 == self.max_attempts:
+                    EXHAUSTED.inc(op=op, kind=kind)
+                    raise RetryExhausted(op, kind, self.max_attempts, error) from error
+                RETRIES.inc(op=op, kind=kind)
+                time.sleep(self.delay(attempt))
+                action = self.recovery.get(kind)
+                if action is not None:
+                    RECOVERIES.inc(action=getattr(action, "__name__", "recovery"))
+                    try:
+                        action()
+                    except Exception as recover_error:
+                        print(f"Recovery {getattr(action, '__name__', action)} failed: {recover_error}")
+
+    def wrap(self, function: Callable, op: str = "") -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            return self.call(function, *args, op=op, **kwargs)
+        return wrapper
+
+
+def slow_control_reset(lpgbt: lpgbt_chip) -> Callable[[], None]:
+    def slow_control_reset():
+        with ic_lock(lpgbt):
+            lpgbt.lpgbt_cont_.lpgbt_com.reset_slow_control_logic()
+    return slow_control_reset
+
+
+def i2c_master_reset(lpgbt: lpgbt_chip, master_id: int) -> Callable[[], None]:
+    def i2c_master_reset():
+        with ic_lock(lpgbt):
+            lpgbt.i2c_master_reset(master_id)
+    return i2c_master_reset
+
+
+def ic_policy(lpgbt: lpgbt_chip, **kwargs) -> RetryPolicy:
+    """
+    Policy for IC register accesses: every error kind recovers with a slow control reset
+    """
+    reset = slow_control_reset(lpgbt)
+    return RetryPolicy(recovery={TIMEOUT: reset, LINK: reset}, **kwargs)
+
+
+def i2c_policy(lpgbt: lpgbt_chip, master_id: int, **kwargs) -> RetryPolicy:
+    """
+    Policy for transactions of one lpGBT I2C master: a NACK or timeout on the I2C bus
+    resets the I2C master, a link error resets the slow control logic
+    """
+    i2c_reset = i2c_master_reset(lpgbt, master_id)
+    return RetryPolicy(recovery={TIMEOUT: i2c_reset, NACK: i2c_reset, LINK: slow_control_reset(lpgbt)}, **kwargs)
+
+
+class RetryingLpgbt:
+    """
+    lpgbt_chip proxy whose IC register and GPIO/ADC accesses go through a retry policy,
+    everything else is passed through unchanged
+    """
+    IC_METHODS = ("read_reg", "write_reg", "read_regs", "write_regs", "read_adc", "write_gpio_output",
+                  "gpio_get_out", "gpio_set_out")
+
+    def __init__(self, lpgbt: lpgbt_chip, policy: RetryPolicy | None = None):
+        self._lpgbt = lpgbt
+        ic_lock(lpgbt)      # created on the chip, so the proxy and the chip share it
+        self.policy = policy or ic_policy(lpgbt)
+        for name in self.IC_METHODS:
+            if hasattr(lpgbt, name):
+                setattr(self, name, self.policy.wrap(getattr(lpgbt, name), op=name))
+
+    def __getattr__(self, name):
+        return getattr(self._lpgbt, name)
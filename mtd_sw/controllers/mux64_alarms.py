@@ -0,0 +1,188 @@
+"""
+Description:
+Alarm/interlock rules on MUX64 readings. Per-channel limits (low/high, rate of change,
+hysteresis) are compiled into arrays indexed by adc_port so every sweep is checked with
+a handful of vectorized comparisons, independent of how many channels carry rules.
+
+mux64 = mux64_chip(lpgbt)
+monitor = Mux64Monitor.with_default_rates(mux64)
+alarms = AlarmEngine.from_config(mux64, actions={"TEMP_ETROC0": etroc_reset_action([etroc])})
+alarms.attach(monitor)
+monitor.start()
+"""
+from .mux64_controller import mux64_chip
+from collections.abc import Callable
+from dataclasses import dataclass
+import numpy as np
+
+N_PORTS = 64
+
+
+@dataclass
+class AlarmRule:
+    """
+    channel: MUX64 channel name (or adc_port)
+    low/high: limits on the converted voltage, None to disable
+    max_rate: limit on |dV/dt| in V/s between consecutive readings, None to disable
+    hysteresis: a low/high alarm only clears once the value is this far back inside the limit
+    action: called with the AlarmEvent when the alarm is raised
+    """
+    channel: str | int
+    low: float | None = None
+    high: float | None = None
+    max_rate: float | None = None
+    hysteresis: float = 0.0
+    action: Callable | None = None
+
+    @classmethod
+    def from_dict(cls, channel: str | int, config: dict, action: Callable | None = None):
+        return cls(
+            channel    = channel,
+            low        = config.get("low"),
+            high       = config.get("high"),
+            max_rate   = config.get("max_rate"),
+            hysteresis = config.get("hysteresis", 0.0),
+            action     = action
+        )
+
+
+@dataclass
+class AlarmEvent:
+    channel: str
+    adc_port: int
+    kind: str        # "low", "high" or "rate"
+    value: float
+    limit: float
+    timestamp: float
+
+
+class AlarmEngine:
+    """
+    Evaluates all rules on each batch of readings, the signature of evaluate matches
+    the Mux64Monitor subscriber callback
+    """
+    def __init__(self, mux64: mux64_chip, rules: list[AlarmRule] | None = None):
+        self.mux64 = mux64
+        self.low = np.full(N_PORTS, -np.inf)
+        self.high = np.full(N_PORTS, np.inf)
+        self.max_rate = np.full(N_PORTS, np.inf)
+        self.hysteresis = np.zeros(N_PORTS)
+        self.actions: dict[int, list[Callable]] = {}
+        self.subscribers: list[Callable] = []
+
+        # alarm state per port
+        self.active_low = np.zeros(N_PORTS, dtype=bool)
+        self.active_high = np.zeros(N_PORTS, dtype=bool)
+        self.active_rate = np.zeros(N_PORTS, dtype=bool)
+        self.last_value = np.full(N_PORTS, np.nan)
+        self.last_time = np.full(N_PORTS, np.nan)
+
+        for rule in rules or []:
+            self.add_rule(rule)
+
+    @classmethod
+    def from_config(cls, mux64: mux64_chip, actions: dict[str, Callable] | None = None):
+        """
+        Builds the rules from the optional "low"/"high"/"max_rate"/"hysteresis" fields of
+        the MUX64 DB channel configuration
+        """
+        actions = actions or {}
+        rules = []
+        for config in mux64.config["configurations"]["ADC"]:
+            if any(config.get(key) is not None for key in ("low", "high", "max_rate")):
+                rules.append(AlarmRule.from_dict(config["register"], config, actions.get(config["register"])))
+        return cls(mux64, rules)
+
+    def add_rule(self, rule: AlarmRule):
+        port = self.mux64.find_channel(rule.channel).adc_port
+        if rule.low is not None:
+            self.low[port] = rule.low
+        if rule.high is not None:
+            self.high[port] = rule.high
+        if rule.max_rate is not None:
+            self.max_rate[port] = rule.max_rate
+        self.hysteresis[port] = rule.hysteresis
+        if rule.action is not None:
+            self.actions.setdefault(port, []).append(rule.action)
+
+    def attach(self, monitor):
+        monitor.subscribe(self.evaluate)
+
+    def subscribe(self, callback: Callable):
+        """
+        Callback is called with every AlarmEvent, on top of the per-rule actions
+        """
+        self.subscribers.append(callback)
+
+    @property
+    def active(self) -> list[str]:
+        ports = np.flatnonzero(self.active_low | self.active_high | self.active_rate)
+        return [self.mux64.channel_map[int(port)].name for port in ports]
+
+    def evaluate(self, ports, raw, voltages, timestamps) -> list[AlarmEvent]:
+        """
+        Updates the alarm states with one batch of readings and fires the actions of
+        newly raised alarms
+        """
+        ports = np.asarray(ports, dtype=int)
+        values = np.asarray(voltages, dtype=float)
+        times = np.asarray(timestamps, dtype=float)
+        low, high, hysteresis = self.low[ports], self.high[ports], self.hysteresis[ports]
+
+        raise_low = ~self.active_low[ports] & (values < low)
+        raise_high = ~self.active_high[ports] & (values > high)
+        self.active_low[ports] = (self.active_low[ports] | raise_low) & ~(values > low + hysteresis)
+        self.active_high[ports] = (self.active_high[ports] | raise_high) & ~(values < high - hysteresis)
+
+        dt = times - self.last_time[ports]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rate = np.abs(values - self.last_value[ports]) / dt
+        over_rate = np.nan_to_num(rate, nan=0.0) > self.max_rate[ports]
+        raise_rate = ~self.active_rate[ports] & over_rate
+        self.active_rate[ports] = over_rate
+        self.last_value[ports] = values
+        self.last_time[ports] = times
+
+        events = []
+        for kind, raised, limits, observed in (
+                ("low", raise_low, low, values),
+                ("high", raise_high, high, values),
+                ("rate", raise_rate, self.max_rate[ports], rate)):
+            for i in np.flatnonzero(raised):
+                port = int(ports[i])
+                events.append(AlarmEvent(
+                    channel   = self.mux64.channel_map[port].name,
+                    adc_port  = port,
+                    kind      = kind,
+                    value     = float(observed[i]),
+                    limit     = float(limits[i]),
+                    timestamp = float(times[i])))
+
+        for event in events:
+            print(f"ALARM {event.kind.upper()}: {event.channel} = {event.value:.4g} (limit {event.limit:.4g})")
+            for callback in self.actions.get(event.adc_port, []) + self.subscribers:
+                try:
+                    callback(event)
+                except Exception as error:
+                    print(f"Alarm action {callback} failed: {error}")
+        return events
+
+
+def etroc_reset_action(etrocs: list, hard: bool = True) -> Callable:
+    """
+    Action that resets the given ETROCs (see etroc_chip.reset)
+    """
+    def action(event: AlarmEvent):
+        for etroc in etrocs:
+            etroc.reset(hard=hard)
+    return action
+
+
+def vref_off_action(etrocs: list) -> Callable:
+    """
+    Action that powers down the internal VREF of the given ETROCs
+    """
+    def action(event: AlarmEvent):
+        for etroc in etrocs:
+            etroc.vref = False
+    return action
@@ -6,9 +6,13 @@ Reads from mux64 which is a chip on ETL Readout Board
 that handles monitoring of temperatures and voltages on the ETROCs and Readout Board
 """
 from .lpgbt_controller import lpgbt_chip
-from ..utils.Configure_from_DB import etl_asic_config_from_db
+from .lpgbt_adc import AdcCalibrator, AdcCalibrationStore
+from .lpgbt_config import apply_csv_config
+from .lpgbt_gpio import gpio_bank
+from ..utils.config_cache import CONFIG_CACHE
 from typing import Union
 from dataclasses import dataclass
+import numpy as np
 try:
     from tabulate import tabulate
     has_tabulate = True
@@ -18,6 +22,43 @@ except ModuleNotFoundError:
 
 VERBOSE_OUTPUT = False 
 
+MUXCNT_NAMES = [f"MUXCNT{i+1}" for i in range(6)]
+
+# One row per channel returned by mux64_chip.read_channels
+READING_DTYPE = np.dtype([
+    ("name",           "U32"),
+    ("adc_port",       np.int16),
+    ("samples",        np.int32),
+    ("raw",            np.float64),  # mean of the raw ADC samples
+    ("raw_std",        np.float64),
+    ("raw_min",        np.float64),
+    ("raw_max",        np.float64),
+    ("calib",          np.float64),  # gain/offset corrected mean
+    ("voltage_direct", np.float64),
+    ("voltage",        np.float64),  # after the R1/R2 divider
+    ("voltage_std",    np.float64),
+])
+
+
+def gray_rank(port: int) -> int:
+    """
+    Position of a channel in the Gray-code sweep (inverse Gray code of the port number)
+    """
+    rank = port
+    shift = 1
+    while port >> shift:
+        rank ^= port >> shift
+        shift += 1
+    return rank
+
+
+def gray_order(ports=range(64)) -> list[int]:
+    """
+    Orders channels so consecutive channels differ in as few MUXCNT select lines as possible,
+    for the full 0..63 range exactly one line changes per step
+    """
+    return sorted(ports, key=gray_rank)
+
 
 class Mux64Error(Exception):
     pass
@@ -46,6 +87,23 @@ class Channel:
             comment  = config["comment"]
         )
     
+def parse_channel_map(config: dict) -> tuple[dict[int, Channel], np.ndarray, np.ndarray]:
+    """
+    Channel map of a MUX64 DB config plus the divider resistors indexed by adc_port
+    for vectorized conversion (NaN for unmapped ports)
+    """
+    channel_map: dict[int, Channel] = {
+        c['adc_port']: Channel.from_dict(c) for c in config["MUX64"]["configurations"]["ADC"]}
+    R1 = np.full(64, np.nan)
+    R2 = np.full(64, np.nan)
+    for port, channel in channel_map.items():
+        R1[port] = channel.R1
+        R2[port] = channel.R2
+    R1.flags.writeable = False
+    R2.flags.writeable = False
+    return channel_map, R1, R2
+
+
 class mux64_chip:
     """
     mux_out: Current selected output channel of mux64
@@ -60,28 +118,59 @@ class mux64_chip:
     R02: float
     mux_out: Channel
 
-    def __init__(self, lpgbt: lpgbt_chip, board='rbv3'): 
+    def __init__(self, lpgbt: lpgbt_chip, board='rbv3', muxcnt_pins: list[int] | None = None,
+                 load_calibration: bool = True, calibration_store: AdcCalibrationStore | None = None): 
         """
-        Calls DB to get mapping of all signals connected to mux64
+        Gets mapping of all signals connected to mux64 from the DB (through the local config cache)
+
+        muxcnt_pins: lpGBT GPIO pin numbers of MUXCNT1..6, looked up in the lpGBT config if not given
+        load_calibration: load the persisted lpGBT ADC calibration (or measure it if there is none)
         """
         self.lpgbt = lpgbt
-        self.config = etl_asic_config_from_db('MUX64')
+        self.config = CONFIG_CACHE.config('MUX64')
         self.config = self.config["MUX64"]
-        self.channel_map: dict[int, Channel] = {
-            config['adc_port']: Channel.from_dict(config) for config in self.config["configurations"]["ADC"]}
+        # parsed once per process and shared by all mux64_chip instances, do not modify
+        self.channel_map, self.R1, self.R2 = CONFIG_CACHE.parsed("channel_map", parse_channel_map, 'MUX64')
         self.selected_channel = None
         self.mux_out = None
         
-        #TODO: Change this to lpgbt controller
-        self.cal_gain = None
-        self.cal_offset = None
-        self.calibrated = False
+        self.adc_calibration = AdcCalibrator(lpgbt, calibration_store)
+        if load_calibration:
+            self.adc_calibration.load_or_calibrate()
 
 
         #TODO: get R01 and R02 from DB (This is for RBF3 and above)
         self.R01 = 20
         self.R02 = 20
 
+        self.muxcnt_pins = muxcnt_pins or self._find_muxcnt_pins()
+        self.gpio = gpio_bank(lpgbt)
+
+    @property
+    def calibrated(self) -> bool:
+        return self.adc_calibration.calibrated
+
+    @property
+    def cal_gain(self) -> float | None:
+        return self.adc_calibration.gain if self.calibrated else None
+
+    @property
+    def cal_offset(self) -> float | None:
+        return self.adc_calibration.offset if self.calibrated else None
+
+
+    def _find_muxcnt_pins(self) -> list[int] | None:
+        """
+        Looks up the GPIO pin number of every MUXCNT select line in the lpGBT configuration,
+        returns None if they can not all be found (then the pins are written one by one by name)
+        """
+        try:
+            gpios = self.lpgbt.config["configurations"]["GPIO"]
+            pins = {gpio["register"]: gpio["pin"] for gpio in gpios}
+            return [int(pins[name]) for name in MUXCNT_NAMES]
+        except (AttributeError, KeyError, TypeError):
+            return None
+
 
     def find_channel(self, identifier: Union[int, str]) -> Channel:
         """
@@ -106,53 +195,116 @@ class mux64_chip:
         """    
         if not isinstance(channel, Channel):
             raise NotImplementedError(f"Channel is not a Channel type, instead you gave {type(channel)}")
+        if self.mux_out is not None and self.mux_out.adc_port == channel.adc_port:
+            return
         self.selected_channel = channel
 
-        for i in range(6):
-            s = (channel.adc_port >> i) & 0x1
-            self.lpgbt.write_gpio_output(f"MUXCNT{i+1}", s)
+        # all six select lines in one PIOOUT write (pins without a known number are written by name)
+        lines = self.muxcnt_pins or MUXCNT_NAMES
+        self.gpio.set_pins({line: (channel.adc_port >> i) & 0x1 for i, line in enumerate(lines)})
 
         self.mux_out = channel
 
-
-    def read_channel(self, channel_identifier: Union[int, str], calib = True) -> float:
+    def invalidate_gpio_cache(self):
         """
-        Physicaly selects channel and then reads mux64 output voltage 
+        Call when GPIO outputs were changed behind the back of this class, the next
+        select re-reads the PIOOUT registers
         """
-        channel = self.find_channel(channel_identifier)
-        self.select_channel(channel)
+        self.gpio.invalidate()
+        self.mux_out = None
 
 
-        raw_adc = self.lpgbt.read_adc("MUX64OUT")
+    def convert(self, raw_adc, adc_ports, calib = True):
+        """
+        Converts raw ADC readings to (raw_adc_calib, voltage_direct, voltage), works on
+        scalars or on NumPy arrays of readings and their matching adc_ports in one step
+        """
+        if calib and not self.calibrated:
+            raise Mux64Error("lpGBT ADC is not calibrated, run calibrate_adc() first")
+        raw_adc = np.asarray(raw_adc, dtype=float)
+        adc_ports = np.asarray(adc_ports)
         # ------------
         #TODO: Discuss moving this to lpgbt controller when reading lpGBT ADC
-        raw_adc_calib = raw_adc*self.cal_gain/1.85 + (512 - self.cal_offset)
+        if self.calibrated:
+            raw_adc_calib = raw_adc*self.cal_gain/1.85 + (512 - self.cal_offset)
+        else:
+            raw_adc_calib = np.full_like(raw_adc, np.nan)
         # ------------
 
         value = raw_adc_calib if calib else raw_adc
         voltage_direct = value / (2**10 - 1)
 
         #TODO: Use a conversion factor funciton that utalizes r01 and r02 to calculate this value (This is for RBF3 and above)
-        voltage = voltage_direct * ((channel.R1 + channel.R2) / channel.R2)
+        voltage = voltage_direct * ((self.R1[adc_ports] + self.R2[adc_ports]) / self.R2[adc_ports])
+
+        return raw_adc_calib, voltage_direct, voltage
+
+    def read_channel(self, channel_identifier: Union[int, str], calib = True) -> float:
+        """
+        Physicaly selects channel and then reads mux64 output voltage 
+        """
+        channel = self.find_channel(channel_identifier)
+        with self.adc_calibration.lock:
+            self.adc_calibration.check()
+            self.select_channel(channel)
+            raw_adc = self.lpgbt.read_adc("MUX64OUT")
+        raw_adc_calib, voltage_direct, voltage = self.convert(raw_adc, channel.adc_port, calib=calib)
 
-        return raw_adc, raw_adc_calib, voltage_direct, voltage
+        return raw_adc, float(raw_adc_calib), float(voltage_direct), float(voltage)
 
+    def read_channels(self, channel_identifiers = None, samples: int = 1, calib = True) -> np.ndarray:
+        """
+        Reads several channels with `samples` ADC readings each and returns one READING_DTYPE
+        row per channel (sorted by adc_port). Channels are visited in Gray-code order and the
+        statistics and conversion are computed for all channels at once.
 
-    def read_all_ch(self):
+        channel_identifiers: adc_ports or names, all mapped channels if None
         """
-        Read and prints all signals connected to mux64
+        if channel_identifiers is None:
+            channel_identifiers = self.channel_map.keys()
+        channels = [self.find_channel(identifier) for identifier in channel_identifiers]
+        channels = [self.channel_map[port] for port in gray_order({c.adc_port for c in channels})]
+
+        raw = np.empty((len(channels), samples))
+        with self.adc_calibration.lock:
+            self.adc_calibration.check()
+            for i, channel in enumerate(channels):
+                self.select_channel(channel)
+                raw[i] = [self.lpgbt.read_adc("MUX64OUT") for _ in range(samples)]
+
+        ports = np.array([channel.adc_port for channel in channels], dtype=int)
+        readings = np.zeros(len(channels), dtype=READING_DTYPE)
+        readings["name"] = [channel.name for channel in channels]
+        readings["adc_port"] = ports
+        readings["samples"] = samples
+        readings["raw"] = raw.mean(axis=1)
+        readings["raw_std"] = raw.std(axis=1, ddof=1) if samples > 1 else 0
+        readings["raw_min"] = raw.min(axis=1)
+        readings["raw_max"] = raw.max(axis=1)
+        readings["calib"], readings["voltage_direct"], readings["voltage"] = self.convert(readings["raw"], ports, calib=calib)
+        # conversion is linear so the spread scales with the same factor as the mean
+        gain = self.cal_gain/1.85 if calib else 1
+        divider = (self.R1[ports] + self.R2[ports]) / self.R2[ports]
+        readings["voltage_std"] = readings["raw_std"] * gain / (2**10 - 1) * divider
+
+        return np.sort(readings, order="adc_port")
+
+
+    def read_all_ch(self, samples: int = 1) -> np.ndarray:
         """
+        Read and prints all signals connected to mux64, returns the READING_DTYPE array
+
+        Channels are visited in Gray-code order so only one select line changes per step,
+        the table is printed sorted by pin
+        """
+        readings = self.read_channels(samples=samples)
         table = []
-        for i in range(64):
-            try:
-                raw, calib, volt_dit, volt = self.read_channel(i)
-                current = self.mux_out
-                if VERBOSE_OUTPUT:
-                    table.append([current.name, current.adc_port, raw, calib, volt_dit, volt, current.comment])
-                else:
-                    table.append([current.name, current.adc_port, volt, current.comment])
-            except Mux64Error as error: 
-                ...
+        for r in readings:
+            current = self.channel_map[int(r["adc_port"])]
+            if VERBOSE_OUTPUT:
+                table.append([current.name, current.adc_port, r["raw"], r["calib"], r["voltage_direct"], r["voltage"], current.comment])
+            else:
+                table.append([current.name, current.adc_port, r["voltage"], current.comment])
 
         if VERBOSE_OUTPUT:
             headers = ["Channel","Pin", "Reading (raw)", "Reading (calib)", "Voltage (direct)", "Voltage (conv)", "Comment"]
@@ -169,50 +321,23 @@ class mux64_chip:
             for line in table:
                 print(data_string.format(*line))
 
+        return readings
+
 
-    # ------------------------------------------------------------------------------
-    # TODO: NEED TO DISCUSS MOVING THIS TO LPGBT CONTROLLER
-    # ------------------------------------------------------------------------------
     def calibrate_adc(self):
         '''
-        Calculates the offset and gain of the lpGBT ADCs
+        Measures the offset and gain of the lpGBT ADCs now and persists them
         '''
-        LPGBT = self.lpgbt
-        offset = LPGBT.read_adc(0xf)
-
-        intial_val = LPGBT.read_reg(LPGBT.Reg['ADCMON'])
-        mask = ~(1 << 4)
-        LPGBT.write_reg(LPGBT.Reg['ADCMON'], intial_val & mask)
-
-        # ADC = (Vdiff/Vref)*Gain*512 + Offset
-        gain = 2*abs(LPGBT.read_adc(0xC)-offset)/512
-        print(f"Calibrated lpgbt  ADC. Gain: {gain} / Offset: {offset}")
-
-        LPGBT.write_reg(LPGBT.Reg['ADCMON'], intial_val)
-        if gain < 1.65 or gain > 2 or offset < 490 or offset > 530:
-            raise RuntimeError("ADC Calibration Failed!")
-
-        self.cal_gain = gain
-        self.cal_offset = offset
-        self.calibrated = True
+        self.adc_calibration.calibrate()
 
 
     # ------------------------------------------------------------------------------
     # TEMPORARY FUNCTION TILL WE FIX DB FORMAT
     # ------------------------------------------------------------------------------
-    def write_config(self):
+    def write_config(self, path: str = 'tamalero_lpgbt_config.csv'):
         """
-        Writes to all lpGBT registers default Tamalero configuration value based on csv file
+        Writes to all lpGBT registers default Tamalero configuration value based on csv file,
+        see lpgbt_config.apply_csv_config (only registers that differ are written, in blocks)
         """
-        import csv
-        with open('tamalero_lpgbt_config.csv', newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            next(reader)  # skip the header row
-            for register, value in reader:
-                if value == 'N/A' or "POWERUP" in register.upper():
-                    print(register)
-                    continue
-                self.lpgbt.write_reg(
-                    self.lpgbt.Reg[register], int(value,16))
-
-
+        apply_csv_config(self.lpgbt, path)
+        self.invalidate_gpio_cache()
@@ -0,0 +1,215 @@
+"""
+Description:
+Background slow-control monitoring of the MUX64 channels. Each configured channel is
+swept at its own period and the readings are kept in fixed-size ring buffers so the
+latest values and recent time windows can be queried at any time without touching
+the hardware.
+"""
+from .mux64_controller import mux64_chip, Channel, Mux64Error
+from ..utils.metrics import REGISTRY
+from collections.abc import Callable
+from typing import Union
+import threading
+import time
+import numpy as np
+
+MUX64_VOLTAGE = REGISTRY.gauge("etl_mux64_voltage_volts", "Last converted voltage of a MUX64 channel")
+MUX64_READ_TIME = REGISTRY.gauge("etl_mux64_last_read_timestamp_seconds", "Unix time of the last MUX64 channel reading")
+MUX64_SWEEPS = REGISTRY.counter("etl_mux64_sweeps_total", "MUX64 monitor sweeps")
+MUX64_ERRORS = REGISTRY.counter("etl_mux64_read_errors_total", "MUX64 channel readings that failed")
+MUX64_CALLBACK_ERRORS = REGISTRY.counter("etl_mux64_subscriber_errors_total", "MUX64 monitor subscriber callbacks that raised")
+
+
+class RingBuffer:
+    """
+    Fixed-size time series of MUX64 readings backed by NumPy arrays.
+
+    Once full the oldest samples are overwritten.
+    """
+    def __init__(self, size: int = 4096):
+        self.size = size
+        self.timestamps = np.full(size, np.nan)
+        self.raw = np.full(size, np.nan)
+        self.voltage = np.full(size, np.nan)
+        self._count = 0  # total number of samples ever appended
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return min(self._count, self.size)
+
+    def append(self, timestamp: float, raw: float, voltage: float):
+        with self._lock:
+            i = self._count % self.size
+            self.timestamps[i] = timestamp
+            self.raw[i] = raw
+            self.voltage[i] = voltage
+            self._count += 1
+
+    def latest(self) -> tuple[float, float, float] | None:
+        """
+        Most recent (timestamp, raw, voltage) or None if nothing was recorded yet
+        """
+        with self._lock:
+            if self._count == 0:
+                return None
+            i = (self._count - 1) % self.size
+            return self.timestamps[i], self.raw[i], self.voltage[i]
+
+    def ordered(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Copies of all stored samples, oldest first
+        """
+        with self._lock:
+            n = min(self._count, self.size)
+            start = (self._count - n) % self.size
+            idx = (start + np.arange(n)) % self.size
+            return self.timestamps[idx], self.raw[idx], self.voltage[idx]
+
+    def window(self, seconds: float, now: float | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Samples from the last `seconds` seconds, oldest first
+        """
+        now = time.time() if now is None else now
+        timestamps, raw, voltage = self.ordered()
+        first = np.searchsorted(timestamps, now - seconds, side="left")
+        return timestamps[first:], raw[first:], voltage[first:]
+
+
+class Mux64Monitor:
+    """
+    Sweeps MUX64 channels in a background thread, each at its own period.
+
+    mux64 = mux64_chip(lpgbt)
+    monitor = Mux64Monitor(mux64, {"VREF": 1.0, "TEMP_ETROC0": 10.0})
+    monitor.start()
+    monitor.latest("VREF")
+    monitor.window("TEMP_ETROC0", 600)
+
+    Every reading is the mean of `samples` ADC samples (see mux64_chip.read_channels).
+    Subscribers are called after every sweep with (adc_ports, raw, voltages, timestamps) arrays
+    of the channels read in that sweep.
+    """
+    def __init__(self, mux64: mux64_chip, periods: dict[Union[int, str], float], buffer_size: int = 4096, samples: int = 1):
+        self.mux64 = mux64
+        self.samples = samples
+        self.channels: dict[int, Channel] = {}
+        self.periods: dict[int, float] = {}
+        for identifier, period in periods.items():
+            channel = mux64.find_channel(identifier)
+            self.channels[channel.adc_port] = channel
+            self.periods[channel.adc_port] = period
+        self.buffers = {port: RingBuffer(buffer_size) for port in self.channels}
+        self.errors = {port: 0 for port in self.channels}
+        self.sweeps = 0
+        self._next_due = {port: 0.0 for port in self.channels}
+        self._subscribers: list[Callable] = []
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @classmethod
+    def with_default_rates(cls, mux64: mux64_chip, fast: float = 1.0, slow: float = 10.0, **kwargs):
+        """
+        Monitors every mapped channel, temperatures at the slow period and everything else
+        (supply voltages, references) at the fast period
+        """
+        periods = {
+            port: slow if "TEMP" in channel.name.upper() else fast
+            for port, channel in mux64.channel_map.items()}
+        return cls(mux64, periods, **kwargs)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def subscribe(self, callback: Callable):
+        self._subscribers.append(callback)
+
+    def start(self):
+        if self.running:
+            return
+        if not self.mux64.calibrated:
+            self.mux64.calibrate_adc()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="mux64-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _due_channels(self, now: float) -> list[int]:
+        return [port for port, due in self._next_due.items() if due <= now]
+
+    def sweep(self, ports: list[int]):
+        """
+        Reads the given channels once, stores the results and notifies subscribers
+        """
+        try:
+            readings = self.mux64.read_channels(ports, samples=self.samples)
+        except Exception as error:
+            # read the channels one by one, so one failing channel does not drop the others
+            print(f"MUX64 monitor: sweep of {len(ports)} channels failed ({error}), reading them one by one")
+            readings = []
+            for port in ports:
+                try:
+                    readings.append(self.mux64.read_channels([port], samples=self.samples))
+                except Exception as error:
+                    self.errors[port] += 1
+                    MUX64_ERRORS.inc(channel=self.channels[port].name)
+                    print(f"MUX64 monitor: reading channel {self.channels[port].name} failed: {error}")
+            if not readings:
+                return
+            readings = np.concatenate(readings)
+        timestamp = time.time()
+        for reading in readings:
+            self.buffers[int(reading["adc_port"])].append(timestamp, reading["raw"], reading["voltage"])
+            MUX64_VOLTAGE.set(float(reading["voltage"]), channel=reading["name"], adc_port=int(reading["adc_port"]))
+            MUX64_READ_TIME.set(timestamp, channel=reading["name"], adc_port=int(reading["adc_port"]))
+        self.sweeps += 1
+        MUX64_SWEEPS.inc()
+
+        timestamps = np.full(len(readings), timestamp)
+        for callback in self._subscribers:
+            # a failing subscriber (e.g. the store writer) must not stop the monitor or the others
+            try:
+                callback(readings["adc_port"], readings["raw"], readings["voltage"], timestamps)
+            except Exception as error:
+                MUX64_CALLBACK_ERRORS.inc(callback=getattr(callback, "__qualname__", type(callback).__name__))
+                print(f"MUX64 monitor: subscriber {callback} failed: {error!r}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.time()
+            ports = self._due_channels(now)
+            if ports:
+                try:
+                    self.sweep(ports)
+                except Exception as error:
+                    print(f"MUX64 monitor: sweep failed: {error!r}")
+                for port in ports:
+                    # schedule from the nominal due time so the rate does not drift,
+                    # unless the sweep fell behind by more than a full period
+                    due = self._next_due[port] + self.periods[port]
+                    self._next_due[port] = due if due > now else now + self.periods[port]
+            wait = min(self._next_due.values()) - time.time() if self._next_due else 1.0
+            if wait > 0:
+                self._stop.wait(wait)
+
+    def latest(self, identifier: Union[int, str]) -> tuple[float, float, float] | None:
+        """
+        Most recent (timestamp, raw, voltage) for a channel, never touches the hardware.
+        None if the channel has not been read yet or is not monitored.
+        """
+        buffer = self.buffers.get(self.mux64.find_channel(identifier).adc_port)
+        return buffer.latest() if buffer is not None else None
+
+    def window(self, identifier: Union[int, str], seconds: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        (timestamps, raw, voltages) of a channel over the last `seconds` seconds
+        """
+        channel = self.mux64.find_channel(identifier)
+        if channel.adc_port not in self.buffers:
+            raise Mux64Error(f"Channel {channel.name} is not monitored")
+        return self.buffers[channel.adc_port].window(seconds)
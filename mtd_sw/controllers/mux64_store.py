@@ -0,0 +1,259 @@
+"""
+Description:
+Append-only, memory-mapped columnar storage for MUX64 monitoring samples.
+
+Samples are written into preallocated segment files, one contiguous block per column
+(timestamp, adc_port, raw ADC, calibrated ADC, voltage). Each segment keeps a sparse time
+index (timestamp of every `index_stride`-th row) so a reader can map a multi-week run and
+slice a time window without reading more than the rows it returns. Segments are rotated
+once full or after `max_segment_seconds`, and the oldest ones can be dropped with `max_segments`.
+
+Timestamps are assumed to be non-decreasing, which is how Mux64Monitor produces them.
+"""
+from collections.abc import Iterator
+import glob
+import os
+import time
+import numpy as np
+
+MAGIC = b"ETLMON01"
+HEADER_SIZE = 4096
+HEADER_DTYPE = np.dtype([
+    ("magic",        "S8"),
+    ("capacity",     np.uint64),
+    ("count",        np.uint64),   # rows written and committed
+    ("index_stride", np.uint64),
+    ("t_first",      np.float64),
+    ("t_last",       np.float64),
+])
+COLUMNS = np.dtype([
+    ("timestamp", np.float64),
+    ("adc_port",  np.uint16),
+    ("raw",       np.float32),
+    ("calib",     np.float32),
+    ("voltage",   np.float32),
+])
+
+
+def _align(offset: int, alignment: int = 64) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _layout(capacity: int, index_stride: int) -> tuple[int, dict[str, int], int]:
+    """
+    Byte offsets of the time index and of every column block, and the total file size
+    """
+    index_offset = HEADER_SIZE
+    offset = _align(index_offset + 8*(capacity // index_stride + 1))
+    column_offsets = {}
+    for name in COLUMNS.names:
+        column_offsets[name] = offset
+        offset = _align(offset + COLUMNS[name].itemsize*capacity)
+    return index_offset, column_offsets, offset
+
+
+class Segment:
+    """
+    One memory-mapped segment file
+    """
+    def __init__(self, path: str, capacity: int | None = None, index_stride: int = 1024, mode: str = "r"):
+        self.path = path
+        if capacity is not None:
+            # create a new, preallocated segment
+            _, _, size = _layout(capacity, index_stride)
+            with open(path, "wb") as f:
+                f.truncate(size)
+            self._map = np.memmap(path, dtype=np.uint8, mode="r+")
+            self.header = self._map[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)
+            self.header["magic"] = MAGIC
+            self.header["capacity"] = capacity
+            self.header["index_stride"] = index_stride
+            self.header["t_first"] = np.nan
+            self.header["t_last"] = np.nan
+        else:
+            self._map = np.memmap(path, dtype=np.uint8, mode=mode)
+            self.header = self._map[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)
+            if self.header["magic"][0] != MAGIC:
+                raise ValueError(f"{path} is not a MUX64 monitoring segment")
+
+        index_offset, column_offsets, _ = _layout(self.capacity, self.index_stride)
+        self.index = self._map[index_offset:index_offset + 8*(self.capacity // self.index_stride + 1)].view(np.float64)
+        self.columns = {
+            name: self._map[offset:offset + COLUMNS[name].itemsize*self.capacity].view(COLUMNS[name])
+            for name, offset in column_offsets.items()}
+
+    @property
+    def capacity(self) -> int:
+        return int(self.header["capacity"][0])
+
+    @property
+    def count(self) -> int:
+        return int(self.header["count"][0])
+
+    @property
+    def index_stride(self) -> int:
+        return int(self.header["index_stride"][0])
+
+    @property
+    def t_first(self) -> float:
+        return float(self.header["t_first"][0])
+
+    @property
+    def t_last(self) -> float:
+        return float(self.header["t_last"][0])
+
+    @property
+    def free(self) -> int:
+        return self.capacity - self.count
+
+    def append(self, rows: dict[str, np.ndarray]) -> int:
+        """
+        Writes as many rows as fit straight into the mapped columns, then commits the new
+        row count. Returns the number of rows written.
+        """
+        start = self.count
+        n = min(len(rows["timestamp"]), self.free)
+        if n == 0:
+            return 0
+        stop = start + n
+        for name in COLUMNS.names:
+            self.columns[name][start:stop] = rows[name][:n]
+
+        stride = self.index_stride
+        first_indexed = -(-start // stride)
+        indexed = np.arange(first_indexed*stride, stop, stride)
+        self.index[indexed // stride] = self.columns["timestamp"][indexed]
+
+        if start == 0:
+            self.header["t_first"] = rows["timestamp"][0]
+        self.header["t_last"] = rows["timestamp"][n - 1]
+        # commit last, a crash before this point leaves the new rows invisible
+        self.header["count"] = stop
+        return n
+
+    def row_range(self, t_start: float, t_stop: float) -> tuple[int, int]:
+        """
+        Rows [first, last) with t_start <= timestamp < t_stop, found through the sparse
+        index so only two index strides of the timestamp column are touched
+        """
+        count = self.count
+        stride = self.index_stride
+        n_index = -(-count // stride)
+        index = self.index[:n_index]
+        timestamps = self.columns["timestamp"]
+
+        def locate(t):
+            block = max(int(np.searchsorted(index, t, side="left")) - 1, 0)
+            lo, hi = block*stride, min((block + 2)*stride, count)
+            return lo + int(np.searchsorted(timestamps[lo:hi], t, side="left"))
+        return locate(t_start), locate(t_stop)
+
+    def read(self, first: int, last: int) -> np.ndarray:
+        out = np.empty(last - first, dtype=COLUMNS)
+        for name in COLUMNS.names:
+            out[name] = self.columns[name][first:last]
+        return out
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self.flush()
+        del self._map
+
+
+class Mux64StoreWriter:
+    """
+    Appends monitoring samples to rotating segments in `directory`
+
+    store = Mux64StoreWriter("/data/mux64")
+    store.attach(monitor)
+    """
+    def __init__(self, directory: str, capacity: int = 1 << 20, index_stride: int = 1024,
+                 max_segment_seconds: float = 24*3600, max_segments: int | None = None):
+        self.directory = directory
+        self.capacity = capacity
+        self.index_stride = index_stride
+        self.max_segment_seconds = max_segment_seconds
+        self.max_segments = max_segments
+        self.segment: Segment | None = None
+        self._segment_opened = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def _rotate(self):
+        if self.segment is not None:
+            self.segment.close()
+        path = os.path.join(self.directory, f"mux64_{time.time_ns()}.seg")
+        self.segment = Segment(path, capacity=self.capacity, index_stride=self.index_stride)
+        self._segment_opened = time.time()
+        if self.max_segments is not None:
+            for old in segment_paths(self.directory)[:-self.max_segments]:
+                os.remove(old)
+
+    def append(self, timestamp, adc_port, raw, calib, voltage):
+        rows = {
+            "timestamp": np.atleast_1d(np.asarray(timestamp, dtype=np.float64)),
+            "adc_port":  np.atleast_1d(np.asarray(adc_port, dtype=np.uint16)),
+            "raw":       np.atleast_1d(np.asarray(raw, dtype=np.float32)),
+            "calib":     np.atleast_1d(np.asarray(calib, dtype=np.float32)),
+            "voltage":   np.atleast_1d(np.asarray(voltage, dtype=np.float32)),
+        }
+        n_rows = len(rows["timestamp"])
+        written = 0
+        while written < n_rows:
+            if (self.segment is None or self.segment.free == 0
+                    or time.time() - self._segment_opened > self.max_segment_seconds):
+                self._rotate()
+            written += self.segment.append({name: column[written:] for name, column in rows.items()})
+
+    def attach(self, monitor):
+        """
+        Stores every sweep of a Mux64Monitor
+        """
+        def store_sweep(ports, raw, voltages, timestamps):
+            calib, _, _ = monitor.mux64.convert(raw, ports)
+            self.append(timestamps, ports, raw, calib, voltages)
+        monitor.subscribe(store_sweep)
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+
+def segment_paths(directory: str) -> list[str]:
+    return sorted(glob.glob(os.path.join(directory, "mux64_*.seg")),
+                  key=lambda path: int(os.path.basename(path)[6:-4]))
+
+
+class Mux64StoreReader:
+    """
+    Read-only view on a directory of segments, can be used while a writer is appending
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def segments(self) -> Iterator[Segment]:
+        for path in segment_paths(self.directory):
+            try:
+                yield Segment(path, mode="r")
+            except (ValueError, FileNotFoundError):
+                continue
+
+    def window(self, t_start: float, t_stop: float, adc_ports=None) -> np.ndarray:
+        """
+        All samples with t_start <= timestamp < t_stop, optionally only for some channels
+        """
+        chunks = []
+        for segment in self.segments():
+            if segment.count == 0 or segment.t_last < t_start or segment.t_first >= t_stop:
+                continue
+            chunk = segment.read(*segment.row_range(t_start, t_stop))
+            if adc_ports is not None:
+                chunk = chunk[np.isin(chunk["adc_port"], adc_ports)]
+            chunks.append(chunk)
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=COLUMNS)
+
+    def last(self, seconds: float, adc_ports=None) -> np.ndarray:
+        now = time.time()
+        return self.window(now - seconds, np.inf, adc_ports)
@@ -0,0 +1,132 @@
+"""
+Description:
+Process-wide pool of uHAL connections. The ConnectionManager, HwInterface and EMP
+Controller of a (connections file, device ID) pair are created on first use and shared by
+every caller afterwards. uHAL interfaces are not thread safe, so each pooled handle comes
+with a lock that callers hold around their transactions. Handles are health-checked when
+handed out (at most every `health_interval` seconds) and rebuilt if the check fails.
+
+lpgbt_chip objects can be shared the same way with shared_lpgbt, so the connection setup
+happens once per process instead of once per chip object.
+
+hw = HW_POOL.get("~/mtd-daq/.../hls_connections.xml", "x0")
+with hw.lock:
+    hw.controller.getDatapath().selectLink(4)
+"""
+from .lpgbt_controller import lpgbt_chip
+from collections.abc import Callable
+from dataclasses import dataclass, field
+import os
+import threading
+import time
+try:
+    import uhal
+    import emp
+    has_uhal = True
+except ModuleNotFoundError:
+    print ("Packages `uhal`/`emp` not found.")
+    has_uhal = False
+
+
+def connection_uri(connection: str) -> str:
+    """
+    Normalized "file://" URI of a connections file, used as the pool key
+    """
+    if connection.startswith("file://"):
+        connection = connection[len("file://"):]
+    return "file://" + os.path.abspath(os.path.expanduser(connection))
+
+
+@dataclass
+class HardwareHandle:
+    connection: str
+    device: str
+    manager: object
+    hw: object
+    controller: object
+    lock: threading.RLock = field(default_factory=threading.RLock)
+    created: float = field(default_factory=time.time)
+    checked: float = field(default_factory=time.time)
+
+
+class HardwarePool:
+    """
+    health_node: uHAL node read by the health check, if None the check only dispatches
+    health_interval: seconds between health checks of a handle
+    """
+    def __init__(self, health_node: str | None = None, health_interval: float = 30,
+                 health_check: Callable[[HardwareHandle], None] | None = None):
+        self.health_node = health_node
+        self.health_interval = health_interval
+        self.health_check = health_check or self._default_health_check
+        self._handles: dict[tuple[str, str], HardwareHandle] = {}
+        self._key_locks: dict[tuple[str, str], threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _default_health_check(self, handle: HardwareHandle):
+        if self.health_node is not None:
+            handle.hw.getNode(self.health_node).read()
+        handle.hw.dispatch()
+
+    def _create(self, connection: str, device: str) -> HardwareHandle:
+        if not has_uhal:
+            raise ModuleNotFoundError("uhal and emp are needed to connect to the hardware")
+        uhal.setLogLevelTo(uhal.LogLevel.WARNING)
+        manager = uhal.ConnectionManager(connection)
+        hw = uhal.HwInterface(manager.getDevice(device))
+        return HardwareHandle(connection, device, manager, hw, emp.Controller(hw))
+
+    def _healthy(self, handle: HardwareHandle) -> bool:
+        if time.time() - handle.checked < self.health_interval:
+            return True
+        try:
+            with handle.lock:
+                self.health_check(handle)
+        except Exception as error:
+            print(f"Connection to {handle.device} ({handle.connection}) failed its health check: {error}")
+            return False
+        handle.checked = time.time()
+        return True
+
+    def get(self, connection: str, device: str = "x0") -> HardwareHandle:
+        key = (connection_uri(connection), device)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # creation of one device does not block callers of other devices
+        with key_lock:
+            handle = self._handles.get(key)
+            if handle is None or not self._healthy(handle):
+                handle = self._create(*key)
+                self._handles[key] = handle
+            return handle
+
+    def drop(self, connection: str, device: str = "x0"):
+        with self._lock:
+            self._handles.pop((connection_uri(connection), device), None)
+
+    def clear(self):
+        with self._lock:
+            self._handles.clear()
+
+
+HW_POOL = HardwarePool()
+
+_lpgbts: dict[tuple, lpgbt_chip] = {}
+_lpgbt_key_locks: dict[tuple, threading.Lock] = {}
+_lpgbts_lock = threading.Lock()
+
+
+def shared_lpgbt(name: str, connection: str, link: int = 4, **kwargs) -> lpgbt_chip:
+    """
+    lpgbt_chip for (connections file, link, options), created once per process. The chip is
+    not thread safe, callers sharing it across threads hold ic_lock(lpgbt) (lpgbt_i2c)
+    around their accesses, as the I2C scheduler and GPIO bank do.
+    """
+    key = (connection_uri(connection), link, tuple(sorted(kwargs.items())))
+    with _lpgbts_lock:
+        key_lock = _lpgbt_key_locks.setdefault(key, threading.Lock())
+    # the connection setup of one chip does not block lookups of the others
+    with key_lock:
+        if key not in _lpgbts:
+            _lpgbts[key] = lpgbt_chip(name, connection=connection, link=link, **kwargs)
+        return _lpgbts[key]
@@ -0,0 +1,186 @@
+"""
+Description:
+Vectorized decoder for ETROC2 40-bit data frames (scrambler off, as set in etroc_chip.config).
+
+    Header:  [39:22] 0x3C5C<<2 | 0b00, L1Counter[21:14], type[13:12], BCID[11:0]
+    Filler:  [39:22] 0x3C5C<<2 | 0b10, L1Counter[21:14], EBS[13:12], BCID[11:0]
+    Data:    [39] 1, EA[38:37], COL[36:33], ROW[32:29], TOA[28:19], TOT[18:10], CAL[9:0]
+    Trailer: [39] 0, chipID[38:22], status[21:16], hits[15:8], CRC[7:0]
+
+Frames are classified and their fields extracted with whole-array bit operations, every
+hit is tagged with the L1Counter/BCID of the header before it.
+
+frames = load_frames("capture.bin", layout="packed40")
+decoded = decode(frames)
+decoded.hits["toa"]
+"""
+from dataclasses import dataclass
+import numpy as np
+
+HEADER_PATTERN = 0x3C5C << 2
+FILLER_PATTERN = (0x3C5C << 2) | 0b10
+
+HEADER = 0
+DATA = 1
+TRAILER = 2
+FILLER = 3
+
+MASK_40 = np.uint64((1 << 40) - 1)
+
+HEADER_DTYPE = np.dtype([
+    ("frame",     np.int64),   # position in the frame stream
+    ("l1counter", np.uint8),
+    ("type",      np.uint8),
+    ("bcid",      np.uint16),
+])
+FILLER_DTYPE = np.dtype([
+    ("frame",     np.int64),
+    ("l1counter", np.uint8),
+    ("ebs",       np.uint8),
+    ("bcid",      np.uint16),
+])
+HIT_DTYPE = np.dtype([
+    ("frame",     np.int64),
+    ("event",     np.int64),   # index into headers, -1 for hits before the first header
+    ("l1counter", np.uint8),
+    ("bcid",      np.uint16),
+    ("ea",        np.uint8),
+    ("row",       np.uint8),
+    ("col",       np.uint8),
+    ("toa",       np.uint16),
+    ("tot",       np.uint16),
+    ("cal",       np.uint16),
+])
+TRAILER_DTYPE = np.dtype([
+    ("frame",     np.int64),
+    ("event",     np.int64),
+    ("chip_id",   np.uint32),
+    ("status",    np.uint8),
+    ("hits",      np.uint8),
+    ("crc",       np.uint8),
+])
+
+
+@dataclass
+class DecodedFrames:
+    kind: np.ndarray       # HEADER/DATA/TRAILER/FILLER per frame
+    headers: np.ndarray
+    hits: np.ndarray
+    trailers: np.ndarray
+    fillers: np.ndarray
+
+
+def _field(frames: np.ndarray, low: int, width: int) -> np.ndarray:
+    return (frames >> np.uint64(low)) & np.uint64((1 << width) - 1)
+
+
+def frames_from_packed40(buffer) -> np.ndarray:
+    """
+    Frames stored as 5 big-endian bytes each, back to back
+    """
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    raw = raw[:len(raw) - len(raw) % 5].reshape(-1, 5).astype(np.uint64)
+    return ((raw[:, 0] << np.uint64(32)) | (raw[:, 1] << np.uint64(24)) | (raw[:, 2] << np.uint64(16))
+            | (raw[:, 3] << np.uint64(8)) | raw[:, 4])
+
+
+def frames_from_u64(buffer) -> np.ndarray:
+    """
+    Frames stored in the low 40 bits of little-endian 64-bit words
+    """
+    raw = np.frombuffer(buffer, dtype="<u8")
+    return raw & MASK_40
+
+
+LAYOUTS = {"packed40": frames_from_packed40, "u64": frames_from_u64}
+
+
+def load_frames(path: str, layout: str = "packed40") -> np.ndarray:
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    return LAYOUTS[layout](data)
+
+
+def classify(frames: np.ndarray) -> np.ndarray:
+    frames = np.asarray(frames, dtype=np.uint64)
+    top = _field(frames, 22, 18)
+    kind = np.where(_field(frames, 39, 1) == 1, DATA, TRAILER).astype(np.uint8)
+    kind[top == HEADER_PATTERN] = HEADER
+    kind[top == FILLER_PATTERN] = FILLER
+    return kind
+
+
+def decode(frames, layout: str | None = None) -> DecodedFrames:
+    """
+    frames: uint64 array of 40-bit frames, or a raw buffer if a layout is given
+    """
+    if layout is not None:
+        frames = LAYOUTS[layout](frames)
+    frames = np.asarray(frames, dtype=np.uint64)
+    kind = classify(frames)
+    positions = np.arange(len(frames), dtype=np.int64)
+
+    is_header = kind == HEADER
+    header_frames = frames[is_header]
+    headers = np.empty(len(header_frames), dtype=HEADER_DTYPE)
+    headers["frame"] = positions[is_header]
+    headers["l1counter"] = _field(header_frames, 14, 8)
+    headers["type"] = _field(header_frames, 12, 2)
+    headers["bcid"] = _field(header_frames, 0, 12)
+
+    is_filler = kind == FILLER
+    filler_frames = frames[is_filler]
+    fillers = np.empty(len(filler_frames), dtype=FILLER_DTYPE)
+    fillers["frame"] = positions[is_filler]
+    fillers["l1counter"] = _field(filler_frames, 14, 8)
+    fillers["ebs"] = _field(filler_frames, 12, 2)
+    fillers["bcid"] = _field(filler_frames, 0, 12)
+
+    # index of the last header at or before every frame
+    event = np.cumsum(is_header, dtype=np.int64) - 1
+
+    is_data = kind == DATA
+    data_frames = frames[is_data]
+    hits = np.empty(len(data_frames), dtype=HIT_DTYPE)
+    hits["frame"] = positions[is_data]
+    hits["event"] = event[is_data]
+    hits["ea"] = _field(data_frames, 37, 2)
+    hits["col"] = _field(data_frames, 33, 4)
+    hits["row"] = _field(data_frames, 29, 4)
+    hits["toa"] = _field(data_frames, 19, 10)
+    hits["tot"] = _field(data_frames, 10, 9)
+    hits["cal"] = _field(data_frames, 0, 10)
+    hits["l1counter"] = 0
+    hits["bcid"] = 0
+    tagged = hits["event"] >= 0
+    if tagged.any():
+        hits["l1counter"][tagged] = headers["l1counter"][hits["event"][tagged]]
+        hits["bcid"][tagged] = headers["bcid"][hits["event"][tagged]]
+
+    is_trailer = kind == TRAILER
+    trailer_frames = frames[is_trailer]
+    trailers = np.empty(len(trailer_frames), dtype=TRAILER_DTYPE)
+    trailers["frame"] = positions[is_trailer]
+    trailers["event"] = event[is_trailer]
+    trailers["chip_id"] = _field(trailer_frames, 22, 17)
+    trailers["status"] = _field(trailer_frames, 16, 6)
+    trailers["hits"] = _field(trailer_frames, 8, 8)
+    trailers["crc"] = _field(trailer_frames, 0, 8)
+
+    return DecodedFrames(kind, headers, hits, trailers, fillers)
+
+
+def encode_header(l1counter: int, bcid: int, type: int = 0) -> int:
+    return (HEADER_PATTERN << 22) | ((l1counter & 0xff) << 14) | ((type & 0x3) << 12) | (bcid & 0xfff)
+
+
+def encode_hit(row: int, col: int, toa: int, tot: int, cal: int, ea: int = 0) -> int:
+    return ((1 << 39) | ((ea & 0x3) << 37) | ((col & 0xf) << 33) | ((row & 0xf) << 29)
+            | ((toa & 0x3ff) << 19) | ((tot & 0x1ff) << 10) | (cal & 0x3ff))
+
+
+def encode_trailer(chip_id: int, hits: int, status: int = 0, crc: int = 0) -> int:
+    return ((chip_id & 0x1ffff) << 22) | ((status & 0x3f) << 16) | ((hits & 0xff) << 8) | (crc & 0xff)
+
+
+def encode_filler(l1counter: int, bcid: int, ebs: int = 0) -> int:
+    return (FILLER_PATTERN << 22) | ((l1counter & 0xff) << 14) | ((ebs & 0x3) << 12) | (bcid & 0xfff)
@@ -0,0 +1,267 @@
+"""
+Description:
+Event builder merging the decoded streams of several ETROCs (and of both ports of a chip
+when singlePort=0) into events, one per L1A.
+
+Every header is given an absolute trigger number by unwrapping its 8-bit L1Counter
+along its stream, and its BCID is moved to the common bunch crossing by removing the
+chip's BCIDoffset (modulo the 3564 bunch crossings of an orbit). Fragments of all streams
+are kept as sorted arrays: a batch is merged with one stable sort and grouped with
+np.unique, so the cost per event stays constant whatever the trigger rate.
+
+An event is built once every stream has moved past its trigger (or it fell more than
+max_lag triggers behind the newest one). Streams without a fragment are reported as
+missing, fragments arriving for a trigger that was already built are reported as late.
+
+builder = EventBuilder(n_streams=2, bcid_offsets=[etroc.read(PeriReg.BCIDoffset)]*2)
+built = builder.add(0, decoded_left)
+built = builder.add(1, decoded_right)
+built.events["trigger"], built.hits["event"]
+built = builder.flush()     # end of run
+"""
+from .etroc_decoder import DecodedFrames
+from ..utils.metrics import REGISTRY
+from collections.abc import Callable
+from dataclasses import dataclass
+import threading
+import numpy as np
+
+L1COUNTER_MODULO = 256
+BX_PER_ORBIT = 3564
+MAX_STREAMS = 64
+
+EVENT_DTYPE = np.dtype([
+    ("trigger",       np.int64),    # unwrapped L1A number
+    ("l1counter",     np.uint8),
+    ("bcid",          np.uint16),   # bunch crossing, BCIDoffset removed
+    ("streams",       np.uint64),   # bit mask of the streams with a fragment
+    ("n_hits",        np.uint32),
+    ("bcid_mismatch", np.bool_),    # fragments disagree on the bunch crossing
+])
+EVENT_HIT_DTYPE = np.dtype([
+    ("event",  np.int64),           # index into the events of the same BuiltEvents
+    ("stream", np.uint8),
+    ("ea",     np.uint8),
+    ("row",    np.uint8),
+    ("col",    np.uint8),
+    ("toa",    np.uint16),
+    ("tot",    np.uint16),
+    ("cal",    np.uint16),
+])
+FRAGMENT_DTYPE = np.dtype([
+    ("trigger", np.int64),
+    ("stream",  np.uint8),
+])
+_PENDING_DTYPE = np.dtype([
+    ("trigger",   np.int64),
+    ("stream",    np.uint8),
+    ("l1counter", np.uint8),
+    ("bcid",      np.uint16),
+])
+_PENDING_HIT_DTYPE = np.dtype([("trigger", np.int64)] + EVENT_HIT_DTYPE.descr[1:])
+
+BUILT_EVENTS = REGISTRY.counter("etl_event_builder_events_total", "Events built from the ETROC streams")
+MISSING_FRAGMENTS = REGISTRY.counter("etl_event_builder_missing_fragments_total",
+                                     "Built events without a fragment of a stream")
+LATE_FRAGMENTS = REGISTRY.counter("etl_event_builder_late_fragments_total",
+                                  "Fragments arriving after their event was built")
+PENDING_FRAGMENTS = REGISTRY.gauge("etl_event_builder_pending_fragments", "Fragments waiting for the other streams")
+
+
+@dataclass
+class BuiltEvents:
+    events: np.ndarray      # EVENT_DTYPE, sorted by trigger
+    hits: np.ndarray        # EVENT_HIT_DTYPE, grouped by event
+    missing: np.ndarray     # FRAGMENT_DTYPE, streams without a fragment in a built event
+    late: np.ndarray        # FRAGMENT_DTYPE, fragments dropped because their event was already built
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+
+def unwrap_l1counter(l1counter: np.ndarray, previous: int | None = None, reference: int = 0) -> np.ndarray:
+    """
+    Absolute trigger numbers of consecutive L1Counter values of one stream. Counts up by
+    the forward distance between neighbours, so up to 255 lost triggers are tolerated.
+    previous: trigger number of the stream's last header, if any. Otherwise the first value
+              is placed on the first trigger number at or after `reference` with the same
+              L1Counter (e.g. the next trigger still to be built), never before it.
+    """
+    l1counter = np.asarray(l1counter, dtype=np.int64)
+    if len(l1counter) == 0:
+        return l1counter
+    if previous is None:
+        start = reference + int(l1counter[0] - reference) % L1COUNTER_MODULO
+        steps = np.diff(l1counter) % L1COUNTER_MODULO
+        return start + np.concatenate(([0], np.cumsum(steps)))
+    steps = np.diff(l1counter, prepend=previous) % L1COUNTER_MODULO
+    return previous + np.cumsum(steps)
+
+
+def bunch_crossing(bcid: np.ndarray, bcid_offset: int) -> np.ndarray:
+    """
+    Bunch crossing of the chip's BCID counter, which starts from BCIDoffset at every orbit
+    """
+    return ((np.asarray(bcid, dtype=np.int64) - bcid_offset) % BX_PER_ORBIT).astype(np.uint16)
+
+
+class EventBuilder:
+    def __init__(self, n_streams: int, bcid_offsets: list[int] | None = None, max_lag: int = 1 << 20):
+        """
+        n_streams: streams to merge (up to 64), e.g. one per port of every ETROC
+        bcid_offsets: BCIDoffset of the chip behind every stream, 0 for all by default
+        max_lag: triggers a stream may fall behind the newest one before events are built
+                 without it, bounds the memory held for a stream that stopped sending
+        """
+        if not 0 < n_streams <= MAX_STREAMS:
+            raise ValueError(f"n_streams must be between 1 and {MAX_STREAMS}")
+        self.n_streams = n_streams
+        self.bcid_offsets = list(bcid_offsets or [0]*n_streams)
+        if len(self.bcid_offsets) != n_streams:
+            raise ValueError("One BCID offset per stream is needed")
+        self.max_lag = max_lag
+        self._last = np.full(n_streams, -1, dtype=np.int64)    # trigger of every stream's last header
+        self._seen = np.zeros(n_streams, dtype=bool)
+        self._built_until = -1                                 # highest trigger built so far
+        self._fragments = np.empty(0, dtype=_PENDING_DTYPE)
+        self._hits = np.empty(0, dtype=_PENDING_HIT_DTYPE)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_etrocs(cls, etrocs: list, ports: int = 2, **kwargs) -> "EventBuilder":
+        """
+        One stream per port of every chip (chip 0 left, chip 0 right, chip 1 left, ...),
+        with the BCIDoffset read back from the chips
+        """
+        offsets = [etroc.read("BCIDoffset") for etroc in etrocs for _ in range(ports)]
+        return cls(len(offsets), offsets, **kwargs)
+
+    @property
+    def pending(self) -> int:
+        return len(self._fragments)
+
+    def add(self, stream: int, decoded: DecodedFrames) -> BuiltEvents:
+        """
+        Adds a decoded block of one stream and returns the events that became complete.
+        Hits before the first header of the block belong to the stream's last event.
+        """
+        with self._lock:
+            late = self._add(stream, decoded)
+            frontier = self._frontier()
+            return self._build(frontier, late)
+
+    def flush(self) -> BuiltEvents:
+        """
+        Builds every pending event, e.g. at the end of a run
+        """
+        with self._lock:
+            frontier = int(self._fragments["trigger"].max()) if len(self._fragments) else self._built_until
+            return self._build(frontier, np.empty(0, dtype=FRAGMENT_DTYPE))
+
+    def consumer(self, stream: int, sink: Callable[[BuiltEvents], None]) -> Callable:
+        """
+        Pipeline consumer adding the blocks of one stream and passing built events to sink
+        """
+        def consume(block):
+            built = self.add(stream, block.decoded)
+            if len(built) or len(built.late):
+                sink(built)
+        consume.__qualname__ = f"event_builder{stream}"
+        return consume
+
+    def _add(self, stream: int, decoded: DecodedFrames) -> np.ndarray:
+        headers = decoded.headers
+        # a stream's first header belongs to the next event still to be built, or a later one
+        reference = self._built_until + 1
+        previous = int(self._last[stream]) if self._seen[stream] else None
+        triggers = unwrap_l1counter(headers["l1counter"], previous, reference)
+
+        hits = decoded.hits
+        if not self._seen[stream]:
+            hits = hits[hits["event"] >= 0]
+        hit_triggers = np.where(hits["event"] >= 0, triggers[np.maximum(hits["event"], 0)] if len(triggers) else 0,
+                                self._last[stream])
+        if len(triggers):
+            self._last[stream] = triggers[-1]
+            self._seen[stream] = True
+
+        # anything for an event that was built already is too late
+        late_headers = triggers <= self._built_until
+        late = np.empty(int(late_headers.sum()), dtype=FRAGMENT_DTYPE)
+        late["trigger"], late["stream"] = triggers[late_headers], stream
+        if len(late):
+            LATE_FRAGMENTS.inc(len(late), stream=str(stream))
+        on_time = hit_triggers > self._built_until
+
+        fragments = np.empty(int((~late_headers).sum()), dtype=_PENDING_DTYPE)
+        fragments["trigger"] = triggers[~late_headers]
+        fragments["stream"] = stream
+        fragments["l1counter"] = headers["l1counter"][~late_headers]
+        fragments["bcid"] = bunch_crossing(headers["bcid"][~late_headers], self.bcid_offsets[stream])
+
+        new_hits = np.empty(int(on_time.sum()), dtype=_PENDING_HIT_DTYPE)
+        new_hits["trigger"] = hit_triggers[on_time]
+        new_hits["stream"] = stream
+        for name in ("ea", "row", "col", "toa", "tot", "cal"):
+            new_hits[name] = hits[name][on_time]
+
+        self._fragments = np.concatenate((self._fragments, fragments))
+        self._hits = np.concatenate((self._hits, new_hits))
+        return late
+
+    def _frontier(self) -> int:
+        """
+        Highest trigger every stream has moved past. The last event of a stream stays open,
+        more of its hits may come with the stream's next block.
+        """
+        if not self._seen.any():
+            return self._built_until
+        newest = int(self._last[self._seen].max())
+        frontier = int(self._last.min()) - 1 if self._seen.all() else self._built_until
+        return max(frontier, newest - self.max_lag, self._built_until)
+
+    def _build(self, frontier: int, late: np.ndarray) -> BuiltEvents:
+        ready = self._fragments["trigger"] <= frontier
+        fragments = self._fragments[ready]
+        self._fragments = self._fragments[~ready]
+        ready_hits = self._hits["trigger"] <= frontier
+        hits = self._hits[ready_hits]
+        self._hits = self._hits[~ready_hits]
+        self._built_until = max(self._built_until, frontier)
+        PENDING_FRAGMENTS.set(len(self._fragments))
+
+        fragments = fragments[np.argsort(fragments["trigger"], kind="stable")]
+        triggers, first, event_of_fragment = np.unique(fragments["trigger"], return_index=True, return_inverse=True)
+        events = np.zeros(len(triggers), dtype=EVENT_DTYPE)
+        events["trigger"] = triggers
+        events["l1counter"] = fragments["l1counter"][first]
+        events["bcid"] = fragments["bcid"][first]
+        if len(fragments):
+            masks = np.left_shift(np.uint64(1), fragments["stream"].astype(np.uint64))
+            events["streams"] = np.bitwise_or.reduceat(masks, first)
+            bcid = fragments["bcid"].astype(np.int64)
+            events["bcid_mismatch"] = np.minimum.reduceat(bcid, first) != np.maximum.reduceat(bcid, first)
+
+        # hits whose header never arrived are dropped with it
+        hits = hits[np.argsort(hits["trigger"], kind="stable")]
+        event = np.searchsorted(triggers, hits["trigger"])
+        matched = event < len(triggers)
+        matched[matched] = triggers[event[matched]] == hits["trigger"][matched]
+        built_hits = np.empty(int(matched.sum()), dtype=EVENT_HIT_DTYPE)
+        built_hits["event"] = event[matched]
+        for name in EVENT_HIT_DTYPE.names[1:]:
+            built_hits[name] = hits[name][matched]
+        events["n_hits"] = np.bincount(built_hits["event"], minlength=len(events))
+
+        # (event, stream) pairs without a fragment
+        absent = (events["streams"][:, None] >> np.arange(self.n_streams, dtype=np.uint64)) & np.uint64(1)
+        missing_event, missing_stream = np.nonzero(absent == 0)
+        missing = np.empty(len(missing_event), dtype=FRAGMENT_DTYPE)
+        missing["trigger"] = triggers[missing_event]
+        missing["stream"] = missing_stream
+        if len(missing):
+            for stream, n in zip(*np.unique(missing_stream, return_counts=True)):
+                MISSING_FRAGMENTS.inc(int(n), stream=str(stream))
+        if len(events):
+            BUILT_EVENTS.inc(len(events))
+        return BuiltEvents(events, built_hits, missing, late)
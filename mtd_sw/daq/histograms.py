@@ -0,0 +1,179 @@
+"""
+Description:
+Per-pixel TOA/TOT/CAL histograms, shaped (chips, 16, 16, bins) with fixed binning.
+
+Hits are filled a whole decoded array at a time: every hit is turned into a flat bin
+index and the counts are added with one bincount (or unique-count for small arrays).
+For multi-process filling every worker fills its own PixelHistograms shard and merges it
+into its slot of a SharedPixelHistograms from time to time; a monitoring process attached
+to the same shared memory sums the slots to get live totals. Slots are only written by
+their owner, so merges need no lock.
+
+shared = SharedPixelHistograms.create(n_workers=4, n_chips=2)
+# in worker i:
+shard = PixelHistograms(n_chips=2)
+shard.fill(decoded.hits, chip=0)
+SharedPixelHistograms.attach(shared.name, 4, 2).merge(shard, worker=i)
+"""
+from multiprocessing import shared_memory
+import numpy as np
+
+N_ROWS = 16
+N_COLS = 16
+
+# variable -> (value range, number of bins)
+DEFAULT_BINNING = {
+    "toa": (1024, 1024),
+    "tot": (512, 512),
+    "cal": (1024, 1024),
+}
+COUNT_DTYPE = np.uint32
+
+
+class PixelHistograms:
+    def __init__(self, n_chips: int = 1, binning: dict[str, tuple[int, int]] | None = None, arrays: dict | None = None):
+        """
+        arrays: existing count arrays to use (e.g. views of shared memory), zeroed arrays otherwise
+        """
+        self.n_chips = n_chips
+        self.binning = dict(binning or DEFAULT_BINNING)
+        self.counts = arrays or {
+            name: np.zeros((n_chips, N_ROWS, N_COLS, bins), dtype=COUNT_DTYPE)
+            for name, (_, bins) in self.binning.items()}
+
+    def _pixel_index(self, hits: np.ndarray, chip) -> np.ndarray:
+        chip = np.broadcast_to(np.asarray(chip, dtype=np.int64), len(hits))
+        return (chip*N_ROWS + hits["row"].astype(np.int64))*N_COLS + hits["col"].astype(np.int64)
+
+    def fill(self, hits: np.ndarray, chip: int | np.ndarray = 0):
+        """
+        hits: HIT_DTYPE array (or anything with row, col and the histogrammed fields)
+        chip: chip index of all hits, or one per hit
+        """
+        if len(hits) == 0:
+            return
+        pixel = self._pixel_index(hits, chip)
+        for name, (value_range, bins) in self.binning.items():
+            values = hits[name].astype(np.int64)
+            in_range = (values >= 0) & (values < value_range)
+            index = pixel*bins + values*bins//value_range
+            if not in_range.all():
+                index = index[in_range]
+            flat = self.counts[name].reshape(-1)
+            if len(index) > flat.size//8:
+                flat += np.bincount(index, minlength=flat.size).astype(COUNT_DTYPE)
+            else:
+                bins_hit, n = np.unique(index, return_counts=True)
+                flat[bins_hit] += n.astype(COUNT_DTYPE)
+
+    def consume(self, block, chip: int = 0):
+        """
+        Pipeline consumer, fills the hits of a DecodedBlock
+        """
+        self.fill(block.decoded.hits, chip)
+
+    def merge(self, other: "PixelHistograms"):
+        for name in self.counts:
+            self.counts[name] += other.counts[name]
+
+    def reset(self):
+        for counts in self.counts.values():
+            counts[...] = 0
+
+    def occupancy(self) -> np.ndarray:
+        """
+        Hits per pixel, (chips, 16, 16)
+        """
+        name = next(iter(self.counts))
+        return self.counts[name].sum(axis=-1, dtype=np.uint64)
+
+    def bin_centers(self, name: str) -> np.ndarray:
+        value_range, bins = self.binning[name]
+        width = value_range/bins
+        return (np.arange(bins) + 0.5)*width
+
+    def bin_values(self, name: str) -> np.ndarray:
+        """
+        Mean of the integer values falling in each bin: the lower edge for unit-width bins,
+        rather than the bin centre which is half a count too high
+        """
+        value_range, bins = self.binning[name]
+        width = value_range/bins
+        return np.arange(bins)*width + max(width - 1, 0)/2
+
+    def mean(self, name: str) -> np.ndarray:
+        """
+        Mean value per pixel (exact for unit-width bins), NaN for pixels without hits
+        """
+        counts = self.counts[name]
+        total = counts.sum(axis=-1, dtype=np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (counts @ self.bin_values(name))/total
+
+
+def _slot_layout(n_chips: int, binning: dict) -> tuple[dict[str, tuple[int, tuple]], int]:
+    offset, layout = 0, {}
+    for name, (_, bins) in binning.items():
+        shape = (n_chips, N_ROWS, N_COLS, bins)
+        layout[name] = (offset, shape)
+        offset += int(np.prod(shape))*np.dtype(COUNT_DTYPE).itemsize
+    return layout, offset
+
+
+class SharedPixelHistograms:
+    """
+    One slot of histograms per worker process in a shared memory block
+    """
+    def __init__(self, memory: shared_memory.SharedMemory, n_workers: int, n_chips: int, binning: dict | None = None):
+        self.memory = memory
+        self.n_workers = n_workers
+        self.n_chips = n_chips
+        self.binning = dict(binning or DEFAULT_BINNING)
+        layout, self.slot_bytes = _slot_layout(n_chips, self.binning)
+        self.slots = [
+            PixelHistograms(n_chips, self.binning, arrays={
+                name: np.ndarray(shape, dtype=COUNT_DTYPE, buffer=memory.buf, offset=worker*self.slot_bytes + offset)
+                for name, (offset, shape) in layout.items()})
+            for worker in range(n_workers)]
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    @classmethod
+    def create(cls, n_workers: int, n_chips: int = 1, binning: dict | None = None, name: str | None = None):
+        _, slot_bytes = _slot_layout(n_chips, dict(binning or DEFAULT_BINNING))
+        memory = shared_memory.SharedMemory(name=name, create=True, size=n_workers*slot_bytes)
+        shared = cls(memory, n_workers, n_chips, binning)
+        for slot in shared.slots:
+            slot.reset()
+        return shared
+
+    @classmethod
+    def attach(cls, name: str, n_workers: int, n_chips: int = 1, binning: dict | None = None):
+        return cls(shared_memory.SharedMemory(name=name), n_workers, n_chips, binning)
+
+    def merge(self, shard: PixelHistograms, worker: int, reset: bool = True):
+        """
+        Adds a worker's local shard into its slot (and clears the shard)
+        """
+        self.slots[worker].merge(shard)
+        if reset:
+            shard.reset()
+
+    def total(self) -> PixelHistograms:
+        """
+        Sum over all workers, a snapshot that can be plotted while the workers keep filling
+        """
+        total = PixelHistograms(self.n_chips, self.binning)
+        for slot in self.slots:
+            total.merge(slot)
+        return total
+
+    def close(self):
+        # drop the views before closing the mapping
+        self.slots = []
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
@@ -0,0 +1,248 @@
+"""
+Description:
+Streaming pipeline from captured uplink data to analysis consumers with bounded memory.
+
+A source generator yields raw byte blocks (from a file, a FIFO or a replayed capture),
+the blocks are cut on frame boundaries (and, by default, before the last header so no
+event is split between blocks), decoded, and handed to every consumer. Each stage runs in
+its own thread connected by bounded queues: a slow consumer blocks the decoder, which
+blocks the reader, so memory stays at a few blocks per stage whatever the run size.
+Per-stage throughput and the time spent blocked by back-pressure are in the metrics registry.
+
+pipeline = Pipeline(file_source("run.bin"), [histograms.consume, writer.consume])
+pipeline.run()
+"""
+from .etroc_decoder import DecodedFrames, HEADER, LAYOUTS, classify, decode
+from ..utils.metrics import REGISTRY
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+FRAME_BYTES = {"packed40": 5, "u64": 8}
+DEFAULT_BLOCK_BYTES = 1 << 22
+
+STAGE_BLOCKS = REGISTRY.counter("etl_daq_stage_blocks_total", "Blocks processed by a DAQ pipeline stage")
+STAGE_FRAMES = REGISTRY.counter("etl_daq_stage_frames_total", "Frames processed by a DAQ pipeline stage")
+STAGE_BUSY = REGISTRY.counter("etl_daq_stage_busy_seconds_total", "Time a DAQ pipeline stage spent working")
+STAGE_BLOCKED = REGISTRY.counter("etl_daq_stage_blocked_seconds_total",
+                                 "Time a DAQ pipeline stage waited on a full downstream queue")
+STAGE_QUEUE = REGISTRY.gauge("etl_daq_stage_queue_depth", "Blocks waiting in the input queue of a DAQ pipeline stage")
+
+
+@dataclass
+class DecodedBlock:
+    index: int            # block number in the run
+    first_frame: int      # position of the block's first frame in the run
+    frames: np.ndarray
+    decoded: DecodedFrames
+
+
+def stream_source(stream, block_bytes: int = DEFAULT_BLOCK_BYTES, layout: str = "packed40") -> Iterator[bytes]:
+    """
+    Reads a binary stream in blocks that always hold whole frames, a partial frame at the
+    end of a read (short reads are normal on FIFOs) is kept for the next block
+    """
+    frame_bytes = FRAME_BYTES[layout]
+    block_bytes -= block_bytes % frame_bytes
+    carry = b""
+    while True:
+        chunk = stream.read(block_bytes - len(carry))
+        if not chunk:
+            break
+        data = carry + chunk
+        usable = len(data) - len(data) % frame_bytes
+        carry = data[usable:]
+        if usable:
+            yield data[:usable]
+    if carry:
+        print(f"Dropping {len(carry)} trailing bytes, not a whole frame")
+
+
+def file_source(path: str, block_bytes: int = DEFAULT_BLOCK_BYTES, layout: str = "packed40") -> Iterator[bytes]:
+    with open(path, "rb", buffering=0) as stream:
+        yield from stream_source(stream, block_bytes, layout)
+
+
+def fifo_source(path: str, block_bytes: int = DEFAULT_BLOCK_BYTES, layout: str = "packed40") -> Iterator[bytes]:
+    """
+    Reads a named pipe (created if missing) until the writer closes it
+    """
+    if not os.path.exists(path):
+        os.mkfifo(path)
+    yield from file_source(path, block_bytes, layout)
+
+
+def replay_source(frames: np.ndarray, block_frames: int = 1 << 19, layout: str = "packed40",
+                  rate: float | None = None, repeat: int = 1) -> Iterator[bytes]:
+    """
+    Local stand-in for the back-end: replays frames (e.g. a decoded capture) as raw blocks,
+    optionally limited to `rate` frames per second
+    """
+    frames = np.asarray(frames, dtype=np.uint64)
+    for _ in range(repeat):
+        for start in range(0, len(frames), block_frames):
+            block = frames[start:start + block_frames]
+            if layout == "u64":
+                data = block.astype("<u8").tobytes()
+            else:
+                data = np.stack([(block >> np.uint64(shift)) & np.uint64(0xff) for shift in (32, 24, 16, 8, 0)],
+                                axis=1).astype(np.uint8).tobytes()
+            started = time.perf_counter()
+            yield data
+            if rate:
+                time.sleep(max(len(block)/rate - (time.perf_counter() - started), 0))
+
+
+def decode_stream(source: Iterable[bytes], layout: str = "packed40", align_events: bool = True) -> Iterator[DecodedBlock]:
+    """
+    Decodes raw blocks. With align_events the frames from the last header of a block on are
+    carried into the next block, so every event is decoded in one piece.
+    """
+    carry = np.empty(0, dtype=np.uint64)
+    first_frame = 0
+    index = 0
+    for data in source:
+        frames = LAYOUTS[layout](data)
+        if len(carry):
+            frames = np.concatenate((carry, frames))
+        if align_events:
+            headers = np.flatnonzero(classify(frames) == HEADER)
+            cut = int(headers[-1]) if len(headers) and headers[-1] > 0 else len(frames)
+            frames, carry = frames[:cut], frames[cut:]
+        if len(frames) == 0:
+            continue
+        yield DecodedBlock(index, first_frame, frames, decode(frames))
+        first_frame += len(frames)
+        index += 1
+    if len(carry):
+        yield DecodedBlock(index, first_frame, carry, decode(carry))
+
+
+_DONE = object()
+
+
+class Pipeline:
+    """
+    consumers: callables taking a DecodedBlock (e.g. an object's consume method), each runs
+               in its own thread behind a queue of `queue_blocks` blocks
+    """
+    def __init__(self, source: Iterable[bytes], consumers: list[Callable[[DecodedBlock], None]],
+                 layout: str = "packed40", align_events: bool = True, queue_blocks: int = 4, name: str = "daq"):
+        self.source = source
+        self.consumers = consumers
+        self.layout = layout
+        self.align_events = align_events
+        self.queue_blocks = queue_blocks
+        self.name = name
+        self._stop = threading.Event()
+        self._errors: list[BaseException] = []
+
+    def _put(self, q: queue.Queue, item, stage: str):
+        started = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        STAGE_BLOCKED.inc(time.perf_counter() - started, pipeline=self.name, stage=stage)
+
+    def _get(self, q: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _timed_blocks(self, stage: str, iterator: Iterator) -> Iterator:
+        while not self._stop.is_set():
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            STAGE_BUSY.inc(time.perf_counter() - started, pipeline=self.name, stage=stage)
+            STAGE_BLOCKS.inc(pipeline=self.name, stage=stage)
+            yield item
+
+    def _read(self, out: queue.Queue):
+        try:
+            for data in self._timed_blocks("read", iter(self.source)):
+                STAGE_FRAMES.inc(len(data)//FRAME_BYTES[self.layout], pipeline=self.name, stage="read")
+                self._put(out, data, "read")
+        except BaseException as error:
+            self._fail(error)
+        finally:
+            self._put(out, _DONE, "read")
+
+    def _decode(self, raw: queue.Queue, outs: list[queue.Queue]):
+        def blocks():
+            while True:
+                item = self._get(raw)
+                if item is _DONE:
+                    return
+                yield item
+        try:
+            decoded = decode_stream(blocks(), self.layout, self.align_events)
+            for block in self._timed_blocks("decode", decoded):
+                STAGE_FRAMES.inc(len(block.frames), pipeline=self.name, stage="decode")
+                for out in outs:
+                    self._put(out, block, "decode")
+        except BaseException as error:
+            self._fail(error)
+        finally:
+            for out in outs:
+                self._put(out, _DONE, "decode")
+
+    def _consume(self, consumer: Callable, stage: str, q: queue.Queue):
+        try:
+            while True:
+                block = self._get(q)
+                if block is _DONE:
+                    return
+                started = time.perf_counter()
+                consumer(block)
+                STAGE_BUSY.inc(time.perf_counter() - started, pipeline=self.name, stage=stage)
+                STAGE_BLOCKS.inc(pipeline=self.name, stage=stage)
+                STAGE_FRAMES.inc(len(block.frames), pipeline=self.name, stage=stage)
+        except BaseException as error:
+            self._fail(error)
+
+    def _fail(self, error: BaseException):
+        self._errors.append(error)
+        self._stop.set()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        """
+        Runs the pipeline until the source is exhausted, re-raising the first stage error
+        """
+        raw = queue.Queue(maxsize=self.queue_blocks)
+        outs = [queue.Queue(maxsize=self.queue_blocks) for _ in self.consumers]
+        stages = ["decode"]
+        STAGE_QUEUE.set_function(raw.qsize, pipeline=self.name, stage="decode")
+        threads = [threading.Thread(target=self._read, args=(raw,), name=f"{self.name}-read"),
+                   threading.Thread(target=self._decode, args=(raw, outs), name=f"{self.name}-decode")]
+        for i, (consumer, out) in enumerate(zip(self.consumers, outs)):
+            # the index keeps two consumers of the same class (e.g. two writers) apart
+            stage = f"{i}:{getattr(consumer, '__qualname__', 'consumer')}"
+            stages.append(stage)
+            STAGE_QUEUE.set_function(out.qsize, pipeline=self.name, stage=stage)
+            threads.append(threading.Thread(target=self._consume, args=(consumer, stage, out),
+                                            name=f"{self.name}-{stage}"))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the queues are gone with this run, so are their depth gauges
+        for stage in stages:
+            STAGE_QUEUE.remove(pipeline=self.name, stage=stage)
+        if self._errors:
+            raise self._errors[0]
@@ -0,0 +1,289 @@
+"""
+Description:
+Raw data container for captured ETROC streams.
+
+    <name>.raw   4096-byte header, then the frames, one 40-bit frame in the low bits of
+                 every little-endian 64-bit word (the "u64" capture layout)
+    <name>.idx   one INDEX_DTYPE record per complete event (header ... trailer): frame
+                 offset, length, L1Counter, BCID and chip ID
+
+Both files are append-only. The writer passes the capture buffer straight to the file
+(no conversion copy when it already is in the u64 layout). Readers memory-map both files
+and select events or chips from the index without scanning the body. After a crash the
+index is repaired from the body: in memory by readers, on disk when a writer reopens the file.
+
+with RawFileWriter("run42.raw") as writer:
+    writer.append(capture_buffer)
+raw = RawFile("run42.raw")
+frames = raw.event_frames(raw.find(l1counter=17, chip_id=0x1abcd)[0])
+"""
+from .etroc_decoder import HEADER, TRAILER, classify, frames_from_packed40
+import os
+import time
+import numpy as np
+
+MAGIC = b"ETLRAW01"
+VERSION = 1
+HEADER_SIZE = 4096
+FILE_HEADER_DTYPE = np.dtype([
+    ("magic",   "S8"),
+    ("version", np.uint32),
+    ("created", np.float64),
+    ("frames",  np.uint64),    # frames committed at the last clean close
+])
+INDEX_DTYPE = np.dtype([
+    ("offset",    np.uint64),  # frame number of the event header in the body
+    ("n_frames",  np.uint32),  # header to trailer, inclusive
+    ("l1counter", np.uint8),
+    ("bcid",      np.uint16),
+    ("chip_id",   np.uint32),
+])
+FRAME_MASK = np.uint64((1 << 40) - 1)
+REBUILD_BLOCK = 1 << 24
+
+
+def index_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".idx"
+
+
+class _EventIndexer:
+    """
+    Pairs every trailer with the header before it across blocks and emits index records
+    """
+    def __init__(self, first_frame: int = 0):
+        self.position = first_frame
+        self.pending: tuple[int, int, int] | None = None   # (offset, l1counter, bcid) of an open event
+
+    def feed(self, frames: np.ndarray) -> np.ndarray:
+        kind = classify(frames)
+        marks = np.flatnonzero((kind == HEADER) | (kind == TRAILER))
+        marks_kind = kind[marks]
+        # an event is a header directly followed (among headers/trailers) by a trailer
+        header_at = np.full(len(marks), -1, dtype=np.int64)
+        header_at[marks_kind == HEADER] = marks[marks_kind == HEADER] + self.position
+        previous = np.concatenate(([-1 if self.pending is None else self.pending[0]], header_at[:-1]))
+        is_event = (marks_kind == TRAILER) & (previous >= 0)
+
+        trailers = marks[is_event]
+        starts = previous[is_event]
+        records = np.empty(len(trailers), dtype=INDEX_DTYPE)
+        records["offset"] = starts
+        records["n_frames"] = trailers + self.position - starts + 1
+        local = starts - self.position
+        inside = local >= 0
+        header_words = frames[np.maximum(local, 0)]
+        records["l1counter"] = (header_words >> np.uint64(14)) & np.uint64(0xff)
+        records["bcid"] = header_words & np.uint64(0xfff)
+        if self.pending is not None and not inside.all():
+            records["l1counter"][~inside] = self.pending[1]
+            records["bcid"][~inside] = self.pending[2]
+        records["chip_id"] = (frames[trailers] >> np.uint64(22)) & np.uint64(0x1ffff)
+
+        # an event still open at the end of the block
+        if len(marks) and marks_kind[-1] == HEADER:
+            word = int(frames[marks[-1]])
+            self.pending = (int(marks[-1]) + self.position, (word >> 14) & 0xff, word & 0xfff)
+        elif len(marks):
+            self.pending = None
+        self.position += len(frames)
+        return records
+
+
+class RawFileWriter:
+    def __init__(self, path: str):
+        self.path = path
+        new = not os.path.exists(path) or os.path.getsize(path) < HEADER_SIZE
+        if new:
+            header = np.zeros(1, dtype=FILE_HEADER_DTYPE)
+            header["magic"], header["version"], header["created"] = MAGIC, VERSION, time.time()
+            with open(path, "wb") as f:
+                f.write(header.tobytes().ljust(HEADER_SIZE, b"\0"))
+            open(index_path(path), "wb").close()
+            self._indexer = _EventIndexer()
+        else:
+            # appending to an existing file, picking up an event left open at its end
+            self._indexer = recover(path)
+        self._body = open(path, "ab", buffering=0)
+        self._index = open(index_path(path), "ab", buffering=0)
+
+    @property
+    def frames(self) -> int:
+        return self._indexer.position
+
+    def append(self, frames):
+        """
+        frames: uint64 array or raw buffer in the u64 layout, written as is
+        """
+        words = np.frombuffer(frames, dtype="<u8") if not isinstance(frames, np.ndarray) else frames
+        if words.dtype != np.dtype("<u8"):
+            words = words.astype("<u8")
+        view = memoryview(np.ascontiguousarray(words)).cast("B")
+        written = 0
+        while written < len(view):
+            written += self._body.write(view[written:])
+        records = self._indexer.feed(words & FRAME_MASK)
+        if len(records):
+            self._index.write(records.tobytes())
+
+    def append_packed40(self, buffer):
+        """
+        Captures in the 5-byte packed layout are widened to 64-bit words first
+        """
+        self.append(frames_from_packed40(buffer))
+
+    def flush(self):
+        os.fsync(self._body.fileno())
+        os.fsync(self._index.fileno())
+
+    def close(self):
+        self.flush()
+        self._body.close()
+        self._index.close()
+        with open(self.path, "r+b") as f:
+            header = np.frombuffer(f.read(FILE_HEADER_DTYPE.itemsize), dtype=FILE_HEADER_DTYPE).copy()
+            header["frames"] = self.frames
+            f.seek(0)
+            f.write(header.tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _body_frames(path: str) -> int:
+    return (os.path.getsize(path) - HEADER_SIZE)//8
+
+
+def _read_index(path: str) -> np.ndarray:
+    """
+    Whole records of the index file (a torn last record is ignored)
+    """
+    try:
+        size = os.path.getsize(index_path(path))
+    except FileNotFoundError:
+        return np.empty(0, dtype=INDEX_DTYPE)
+    n = size//INDEX_DTYPE.itemsize
+    if n == 0:
+        return np.empty(0, dtype=INDEX_DTYPE)
+    return np.memmap(index_path(path), dtype=INDEX_DTYPE, mode="r", shape=(n,))
+
+
+def _map_body(path: str) -> np.ndarray:
+    n_frames = _body_frames(path)
+    if n_frames == 0:
+        return np.empty(0, dtype="<u8")
+    return np.memmap(path, dtype="<u8", mode="r", offset=HEADER_SIZE, shape=(n_frames,))
+
+
+def scan_events(body: np.ndarray, start: int = 0) -> tuple[np.ndarray, _EventIndexer]:
+    """
+    Index records of the events from frame `start` on, scanning the body in blocks.
+    The returned indexer holds an event still open at the end of the body.
+    """
+    indexer = _EventIndexer(start)
+    records = [np.empty(0, dtype=INDEX_DTYPE)]
+    for block in range(start, len(body), REBUILD_BLOCK):
+        records.append(indexer.feed(body[block:block + REBUILD_BLOCK] & FRAME_MASK))
+    return np.concatenate(records), indexer
+
+
+def _checked_index(path: str, body: np.ndarray) -> tuple[np.ndarray, bool]:
+    """
+    Index records that agree with the body, and whether the index file has to be rewritten
+    """
+    if not os.path.exists(index_path(path)):
+        return np.empty(0, dtype=INDEX_DTYPE), True
+    index = _read_index(path)
+    if len(index) and index["offset"][-1] + index["n_frames"][-1] > len(body):
+        return np.empty(0, dtype=INDEX_DTYPE), True
+    return index, False
+
+
+def _indexed_until(index: np.ndarray) -> int:
+    return int(index["offset"][-1] + index["n_frames"][-1]) if len(index) else 0
+
+
+def recover(path: str) -> _EventIndexer:
+    """
+    Makes a file consistent after a crash, before appending to it: drops a partially
+    written last word, rebuilds a torn index or one pointing past the body, and indexes
+    complete events that were written to the body but not to the index.
+    Returns an indexer positioned at the end of the body.
+    """
+    with open(path, "rb") as f:
+        header = np.frombuffer(f.read(FILE_HEADER_DTYPE.itemsize), dtype=FILE_HEADER_DTYPE)
+    if header["magic"][0] != MAGIC:
+        raise ValueError(f"{path} is not an ETL raw data file")
+    n_frames = _body_frames(path)
+    if os.path.getsize(path) != HEADER_SIZE + 8*n_frames:
+        os.truncate(path, HEADER_SIZE + 8*n_frames)
+
+    body = _map_body(path)
+    index, rewrite = _checked_index(path, body)
+    if rewrite:
+        print(f"Rebuilding the index of {path}")
+        records, indexer = scan_events(body)
+        with open(index_path(path) + ".tmp", "wb") as f:
+            f.write(records.tobytes())
+        os.replace(index_path(path) + ".tmp", index_path(path))
+        return indexer
+
+    # drop a torn last record, then index the tail of the body
+    os.truncate(index_path(path), len(index)*INDEX_DTYPE.itemsize)
+    records, indexer = scan_events(body, _indexed_until(index))
+    if len(records):
+        with open(index_path(path), "ab") as f:
+            f.write(records.tobytes())
+    return indexer
+
+
+class RawFile:
+    """
+    Read-only, memory-mapped view of a raw data file and its index. The files are never
+    modified, so a file can be opened while it is written: events in the body that are not
+    (yet) in the index file are indexed in memory, and a broken index is rebuilt in memory.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.frames = _map_body(path)
+        index, rebuild = _checked_index(path, self.frames)
+        if rebuild:
+            print(f"Index of {path} is missing or does not match the body, indexing it in memory")
+        tail, _ = scan_events(self.frames, _indexed_until(index))
+        self.index = np.concatenate((index, tail)) if len(tail) else index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def find(self, l1counter: int | None = None, bcid: int | None = None, chip_id: int | None = None) -> np.ndarray:
+        """
+        Index positions of the events matching all the given keys
+        """
+        mask = np.ones(len(self.index), dtype=bool)
+        for name, value in (("l1counter", l1counter), ("bcid", bcid), ("chip_id", chip_id)):
+            if value is not None:
+                mask &= self.index[name] == value
+        return np.flatnonzero(mask)
+
+    def byte_offset(self, event: int) -> int:
+        return HEADER_SIZE + 8*int(self.index["offset"][event])
+
+    def event_frames(self, event: int) -> np.ndarray:
+        record = self.index[event]
+        start = int(record["offset"])
+        return self.frames[start:start + int(record["n_frames"])] & FRAME_MASK
+
+    def chip_frames(self, chip_id: int) -> np.ndarray:
+        """
+        All frames of one chip's events, concatenated in file order
+        """
+        events = self.index[self.index["chip_id"] == chip_id]
+        if len(events) == 0:
+            return np.empty(0, dtype=np.uint64)
+        starts = events["offset"].astype(np.int64)
+        lengths = events["n_frames"].astype(np.int64)
+        # frame positions of all events without a Python loop
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return self.frames[positions] & FRAME_MASK
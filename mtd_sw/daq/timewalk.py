@@ -0,0 +1,147 @@
+"""
+Description:
+Per-pixel time-walk calibration: a polynomial TOA(TOT) fitted for every pixel of every
+chip at once.
+
+The least-squares fits only need sums of powers of TOT (and of TOT^k * TOA) per pixel,
+which are accumulated over whole hit arrays with one bincount per power. The sums can be
+updated as data streams in (or merged between processes) and all the pixels are solved
+together as a stack of small normal-equation systems. apply() evaluates the polynomials
+of the pixels of a whole hit array and returns the corrected TOA.
+
+calibration = TimeWalkCalibration(n_chips=2, degree=3)
+calibration.update(decoded.hits, chip=0)       # as often as needed
+calibration.fit()
+corrected = calibration.apply(decoded.hits, chip=0)
+"""
+import numpy as np
+
+N_ROWS = 16
+N_COLS = 16
+TOT_SCALE = 512.0       # TOT is fitted as TOT/512 to keep the normal equations well conditioned
+MAX_CONDITION = 1e12
+
+
+class TimeWalkCalibration:
+    def __init__(self, n_chips: int = 1, degree: int = 3, min_hits: int | None = None):
+        """
+        degree: polynomial degree in TOT
+        min_hits: hits a pixel needs to be fitted, 10 per coefficient by default
+        """
+        self.n_chips = n_chips
+        self.degree = degree
+        self.min_hits = min_hits if min_hits is not None else 10*(degree + 1)
+        n_pixels = n_chips*N_ROWS*N_COLS
+        self.moments = np.zeros((n_pixels, 2*degree + 1))     # sum of x^k, k = 0..2*degree
+        self.cross = np.zeros((n_pixels, degree + 1))         # sum of x^k * toa
+        self.toa2 = np.zeros(n_pixels)                        # sum of toa^2, for the residuals
+        self.coefficients = np.full((n_chips, N_ROWS, N_COLS, degree + 1), np.nan)
+
+    def _pixel_index(self, hits: np.ndarray, chip) -> np.ndarray:
+        chip = np.broadcast_to(np.asarray(chip, dtype=np.int64), len(hits))
+        return (chip*N_ROWS + hits["row"].astype(np.int64))*N_COLS + hits["col"].astype(np.int64)
+
+    @property
+    def hits(self) -> np.ndarray:
+        """
+        Hits accumulated per pixel, (chips, 16, 16)
+        """
+        return self.moments[:, 0].reshape(self.n_chips, N_ROWS, N_COLS)
+
+    def update(self, hits: np.ndarray, chip: int | np.ndarray = 0):
+        """
+        hits: array with row, col, toa and tot fields (decoded, event-built or scan hits)
+        chip: chip index of all hits, or one per hit
+        """
+        if len(hits) == 0:
+            return
+        n_pixels = len(self.moments)
+        pixel = self._pixel_index(hits, chip)
+        x = hits["tot"]/TOT_SCALE
+        toa = hits["toa"].astype(np.float64)
+        power = np.ones(len(hits))
+        for k in range(2*self.degree + 1):
+            self.moments[:, k] += np.bincount(pixel, power, minlength=n_pixels)
+            if k <= self.degree:
+                self.cross[:, k] += np.bincount(pixel, power*toa, minlength=n_pixels)
+            power = power*x
+        self.toa2 += np.bincount(pixel, toa*toa, minlength=n_pixels)
+
+    def consume(self, block, chip: int = 0):
+        """
+        Pipeline consumer, accumulates the hits of a DecodedBlock
+        """
+        self.update(block.decoded.hits, chip)
+
+    def merge(self, other: "TimeWalkCalibration"):
+        self.moments += other.moments
+        self.cross += other.cross
+        self.toa2 += other.toa2
+
+    def reset(self):
+        self.moments[...] = 0
+        self.cross[...] = 0
+        self.toa2[...] = 0
+
+    def _normal_matrices(self) -> np.ndarray:
+        powers = np.arange(self.degree + 1)
+        return self.moments[:, powers[:, None] + powers[None, :]]
+
+    def fit(self) -> np.ndarray:
+        """
+        Solves all pixels with enough hits, coefficients (lowest power first, in TOT/512) are
+        NaN for the others and for pixels whose TOT spread is too small for the degree
+        """
+        matrices = self._normal_matrices()
+        ok = self.moments[:, 0] >= self.min_hits
+        ok[ok] = np.linalg.cond(matrices[ok]) < MAX_CONDITION
+        coefficients = np.full(self.cross.shape, np.nan)
+        if ok.any():
+            coefficients[ok] = np.linalg.solve(matrices[ok], self.cross[ok][..., None])[..., 0]
+        self.coefficients = coefficients.reshape(self.n_chips, N_ROWS, N_COLS, self.degree + 1)
+        print(f"Time walk fit: {int(ok.sum())} of {len(ok)} pixels calibrated")
+        return self.coefficients
+
+    def residual_rms(self) -> np.ndarray:
+        """
+        RMS of the fit residuals per pixel in TOA counts, (chips, 16, 16), from the sums alone
+        """
+        c = self.coefficients.reshape(len(self.moments), -1)
+        ss = self.toa2 - 2*np.einsum("pk,pk->p", c, self.cross) + np.einsum("pj,pjk,pk->p", c, self._normal_matrices(), c)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(np.maximum(ss, 0)/self.moments[:, 0]).reshape(self.n_chips, N_ROWS, N_COLS)
+
+    def walk(self, hits: np.ndarray, chip: int | np.ndarray = 0) -> np.ndarray:
+        """
+        Fitted TOA of every hit from its TOT, NaN for hits on uncalibrated pixels
+        """
+        c = self.coefficients.reshape(-1, self.degree + 1)[self._pixel_index(hits, chip)]
+        x = hits["tot"]/TOT_SCALE
+        value = c[:, -1].copy()
+        for k in range(self.degree - 1, -1, -1):
+            value = value*x + c[:, k]
+        return value
+
+    def apply(self, hits: np.ndarray, chip: int | np.ndarray = 0) -> np.ndarray:
+        """
+        TOA corrected for the time walk (and the pixel's offset), in TOA counts
+        """
+        return hits["toa"] - self.walk(hits, chip)
+
+    def save(self, path: str):
+        np.savez(path, degree=self.degree, min_hits=self.min_hits, moments=self.moments, cross=self.cross,
+                 toa2=self.toa2, coefficients=self.coefficients)
+
+    @classmethod
+    def load(cls, path: str) -> "TimeWalkCalibration":
+        """
+        Restores the fit and its sums, so the calibration can be updated with new data
+        """
+        with np.load(path) as data:
+            coefficients = data["coefficients"]
+            calibration = cls(len(coefficients), int(data["degree"]), int(data["min_hits"]))
+            calibration.moments[...] = data["moments"]
+            calibration.cross[...] = data["cross"]
+            calibration.toa2[...] = data["toa2"]
+            calibration.coefficients = coefficients
+        return calibration
@@ -0,0 +1,120 @@
+"""
+Description:
+On-disk and in-memory cache for the ASIC configuration documents from the DB.
+
+Documents are cached per ASIC type, the only thing the DB query takes, with the time they
+were fetched and a SHA-256 of their content. Within the TTL the cache is used without contacting the DB;
+past the TTL the DB is asked again and, if it can not be reached, the cached copy is used
+anyway. In offline mode (offline=True or ETL_CONFIG_OFFLINE=1) the DB is never contacted.
+
+Objects parsed from a document (e.g. the MUX64 channel map) can be memoized with
+`parsed()` so every instance in the process shares them.
+"""
+from .Configure_from_DB import etl_asic_config_from_db
+from collections.abc import Callable
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".etl_mtd_daq", "config_cache")
+
+
+class ConfigCacheError(RuntimeError):
+    pass
+
+
+def content_hash(config: dict) -> str:
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+class ConfigCache:
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, ttl: float = 24*3600, offline: bool | None = None):
+        self.directory = directory
+        self.ttl = ttl
+        self.offline = offline if offline is not None else os.environ.get("ETL_CONFIG_OFFLINE", "0") == "1"
+        self._documents: dict[tuple, dict] = {}    # key -> {"fetched", "sha256", "config"}
+        self._parsed: dict[tuple, object] = {}
+        self._lock = threading.RLock()
+
+    def _path(self, key: tuple) -> str:
+        return os.path.join(self.directory, "_".join(str(k) for k in key) + ".json")
+
+    def _read_disk(self, key: tuple) -> dict | None:
+        try:
+            with open(self._path(key)) as f:
+                document = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if content_hash(document.get("config")) != document.get("sha256"):
+            print(f"Cached config {self._path(key)} is corrupted, ignoring it")
+            return None
+        return document
+
+    def _write_disk(self, key: tuple, document: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self._path(key)}.tmp{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(document, f)
+        os.replace(tmp_path, self._path(key))
+
+    def _fetch(self, key: tuple, asic: str) -> dict:
+        config = etl_asic_config_from_db(asic)
+        document = {"fetched": time.time(), "sha256": content_hash(config), "config": config}
+        self._write_disk(key, document)
+        return document
+
+    def document(self, asic: str) -> dict:
+        """
+        Cache entry for an ASIC configuration, fetching it from the DB only when needed
+        """
+        key = (asic,)
+        with self._lock:
+            document = self._documents.get(key) or self._read_disk(key)
+            fresh = document is not None and time.time() - document["fetched"] < self.ttl
+            if not fresh and not self.offline:
+                try:
+                    document = self._fetch(key, asic)
+                except Exception as error:
+                    if document is None:
+                        raise ConfigCacheError(f"No cached {asic} config and the DB is not reachable: {error}") from error
+                    print(f"DB not reachable ({error}), using cached {asic} config from "
+                          f"{time.ctime(document['fetched'])}")
+            if document is None:
+                raise ConfigCacheError(f"Offline mode and no cached {asic} config")
+            self._documents[key] = document
+            return document
+
+    def config(self, asic: str) -> dict:
+        """
+        Same as etl_asic_config_from_db(asic), served from the cache. The caller gets its own copy.
+        """
+        return copy.deepcopy(self.document(asic)["config"])
+
+    def parsed(self, name: str, builder: Callable[[dict], object], asic: str):
+        """
+        Result of builder(config) for this document, built once per content hash and shared
+        between all callers (do not modify it)
+        """
+        document = self.document(asic)
+        key = (name, asic, document["sha256"])
+        with self._lock:
+            if key not in self._parsed:
+                self._parsed[key] = builder(document["config"])
+            return self._parsed[key]
+
+    def invalidate(self, asic: str | None = None):
+        with self._lock:
+            for key in [k for k in self._documents if asic is None or k[0] == asic]:
+                del self._documents[key]
+                if os.path.exists(self._path(key)):
+                    os.remove(self._path(key))
+
+
+CONFIG_CACHE = ConfigCache()
+
+
+def cached_asic_config(asic: str) -> dict:
+    return CONFIG_CACHE.config(asic)
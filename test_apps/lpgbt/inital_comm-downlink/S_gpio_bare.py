@@ -7,10 +7,8 @@ funcstions to control a GPIO pin on the lpGBT
 import time
 import sys
 from lpgbt_control_lib import LpgbtV1
-import emp
-import uhal
 import logging
-print(emp.__file__)
+from ..controllers.uhal_pool import HW_POOL
 
 # make sure to change in db:
 # lpgbt = LpgbtV1(
@@ -20,31 +18,33 @@ print(emp.__file__)
 #     lpgbt_address="0x73"
 # )
 logger = logging.getLogger("lpgbt")
-con_man = uhal.ConnectionManager(
-    "file://~/mtd-emp-toolbox/mtd-daq/lpGBTv2_3_SO1_ceacmsfw_250603_1554_ETL/hls_connections.xml")
-hw_int = uhal.HwInterface(con_man.getDevice("x0"))
-EMP_CONTROLLER = emp.Controller(hw_int)
+HW = HW_POOL.get(
+    "~/mtd-emp-toolbox/mtd-daq/lpGBTv2_3_SO1_ceacmsfw_250603_1554_ETL/hls_connections.xml", "x0")
+EMP_CONTROLLER = HW.controller
 LPGBT_ADDR = 0x73
 LINK=4
-EMP_CONTROLLER.getDatapath().selectLink(LINK)
+# the pooled connection is shared, hold its lock around every uHAL access
+with HW.lock:
+    EMP_CONTROLLER.getDatapath().selectLink(LINK)
 
 def write_lpgbt_regs(reg_addr, reg_vals:list):
 
     if not hasattr(reg_vals, "__len__"):
         reg_vals = [reg_vals]
 
-    print("grabbing link")
-    EMP_CONTROLLER.getDatapath().selectLink(LINK)
-    print("grabbing sccic")
-    sccic = EMP_CONTROLLER.getSCCIC()
-    time.sleep(1)
-    print("writing")
-    # for reg_val in reg_vals:
-    #     sccic.icWrite(reg_addr, reg_val, LPGBT_ADDR)
-    try:
-        sccic.icWriteBlock(reg_addr, reg_vals, LPGBT_ADDR)
-    except Exception as e:
-        print("icWriteBlock failed")
+    with HW.lock:
+        print("grabbing link")
+        EMP_CONTROLLER.getDatapath().selectLink(LINK)
+        print("grabbing sccic")
+        sccic = EMP_CONTROLLER.getSCCIC()
+        time.sleep(1)
+        print("writing")
+        # for reg_val in reg_vals:
+        #     sccic.icWrite(reg_addr, reg_val, LPGBT_ADDR)
+        try:
+            sccic.icWriteBlock(reg_addr, reg_vals, LPGBT_ADDR)
+        except Exception as e:
+            print("icWriteBlock failed")
     time.sleep(1)
 
 def read_lpgbt_regs(reg_adddr, read_len):
@@ -58,7 +58,8 @@ lpgbt.register_comm_intf(
             default=True
         )
 time.sleep(1)
-EMP_CONTROLLER.getSCC().reset()
+with HW.lock:
+    EMP_CONTROLLER.getSCC().reset()
 
 time.sleep(1)
 # reg_addr = lpgbt.decode_reg_addr(lpgbt.CHIPCONFIG)
@@ -6,6 +6,7 @@ steps to try to then attempt the first read of the lpGBT
 import time
 import sys
 from ..controllers.lpgbt_controller import *
+from ..controllers.lpgbt_links import candidates, discover_link, EmpLinkProber
 
 if "/home/cmx/mtd-emp-toolbox/chip_reformat/src" in sys.path:
     sys.path.remove("/home/cmx/mtd-emp-toolbox/chip_reformat/src")
@@ -32,50 +33,12 @@ try:
 except Exception as e:
     print(f"Failed to read:{e}")
 
-for i in range(50):
-    try:
-        # TOGGLE DOWNLINK INTO UPLINK
-        print("Toggling downlink into uplink")
-        time.sleep(0.01)
-        lpgbt.write_reg(0x128, 0xC0)#0xC0
-        time.sleep(0.1)
-        lpgbt.write_reg(0x128, 0)
-        # time.sleep(1)
+def make_lpgbt(downlink):
+    # the lpgbt_chip above, already powered up
+    return lpgbt
 
-        # HIGH SPEED DATA OUT INVERT, 
-        reg_addr = lpgbt.decode_reg_addr(lpgbt.CHIPCONFIG)
-        mask = lpgbt.CHIPCONFIG.HIGHSPEEDDATAOUTINVERT.bit_mask
-        lpgbt.lpgbt_cont_.lpgbt_com.set_link(reg_addr = reg_addr, mask = mask, lpgbt_addr = int(lpgbt.lpgbt_cont_.lpgbt_addr, 16))
-
-        lpgbt.config_done() #POWERUP2
-        time.sleep(0.01)
-        # should have this method because it inherits from LpgbtV1 which inherits from Lpgbt
-
-        print("attempting to read!!")
-
-        do_break = False
-        for link in [0,1,2,3,4,5,6,7,8,9,10,11]:
-            try:
-                lpgbt.lpgbt_cont_.lpgbt_com.emp_cont.getDatapath().selectLink(link)
-                time.sleep(0.1)
-                v1 = lpgbt.read_reg(0x1d7)
-                do_break = True
-            except Exception as e:
-                print(f"Link {link} failed with error: {e}")
-
-        if do_break:
-            break
-
-        # print("0x{0:x}".format(
-        #     lpgbt.lpgbt_cont_.read_lpgbt_regs(int("0x1d9", 0), 1)[0])
-        # )
-
-        # print("v1 is", v1)
-        # if v1 == 0xa6:
-        #     break
-        # else:
-        #     print(f"trying again... it was read as: {v1}")
-        #     time.sleep(0.3)
-    except Exception as e:
-        print(f"failed but gonna try again: {e}")
-        lpgbt.lpgbt_cont_.lpgbt_com.reset_slow_control_logic()
+# toggle downlink into uplink, invert on, POWERUP2, then every uplink
+search = candidates(inverts=(True,), same_downlink=False)
+prober = EmpLinkProber(make_lpgbt, toggle_uplink=True, init=None)
+link = discover_link(prober, board="Master LPGBT", search=search, retries=5)
+print(f"ROM register: {lpgbt.read_reg(0x1d7):#x}")
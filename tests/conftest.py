@@ -0,0 +1,9 @@
+"""
+Description:
+Makes the mtd_sw package importable when pytest is run from any directory.
+Tests of controllers that need the lpGBT/uHAL software skip when it is not installed.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
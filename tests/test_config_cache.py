@@ -0,0 +1,38 @@
+"""
+Description:
+ASIC config cache: one DB query per ASIC, served from disk past the TTL when the DB is down.
+"""
+import pytest
+
+config_cache = pytest.importorskip("mtd_sw.utils.config_cache")
+
+
+@pytest.fixture
+def db(monkeypatch):
+    calls = []
+
+    def etl_asic_config_from_db(asic):
+        calls.append(asic)
+        return {asic: {"configurations": {"ADC": [len(calls)]}}}
+    monkeypatch.setattr(config_cache, "etl_asic_config_from_db", etl_asic_config_from_db)
+    return calls
+
+
+def test_one_query_per_asic(tmp_path, db):
+    cache = config_cache.ConfigCache(str(tmp_path))
+    first = cache.config("MUX64")
+    first["MUX64"]["configurations"]["ADC"].append("modified")
+    assert cache.config("MUX64") == {"MUX64": {"configurations": {"ADC": [1]}}}
+    assert cache.parsed("n", len, "MUX64") is cache.parsed("n", len, "MUX64")
+    assert db == ["MUX64"]
+
+
+def test_stale_copy_used_when_db_is_down(tmp_path, db, monkeypatch):
+    config_cache.ConfigCache(str(tmp_path)).config("MUX64")
+
+    def unreachable(asic):
+        raise OSError("db down")
+    monkeypatch.setattr(config_cache, "etl_asic_config_from_db", unreachable)
+    assert config_cache.ConfigCache(str(tmp_path), ttl=0).config("MUX64") == {"MUX64": {"configurations": {"ADC": [1]}}}
+    with pytest.raises(config_cache.ConfigCacheError):
+        config_cache.ConfigCache(str(tmp_path), offline=True).config("LPGBT")
@@ -0,0 +1,55 @@
+"""
+Description:
+Threshold scan of a full chip: pixels with a failing I2C link come back as NaN, other
+errors stop the scan, and the chip is put back into readout either way.
+"""
+import numpy as np
+import pytest
+
+etroc_controller = pytest.importorskip("mtd_sw.controllers.etroc_controller")
+from mtd_sw.controllers.etroc_registers import PixReg
+from mtd_sw.controllers.lpgbt_retry import RetryExhausted
+
+
+class FakePixel:
+    def __init__(self, error=None):
+        self.error = error
+
+    async def auto_threshold_scan_async(self):
+        if self.error is not None:
+            raise self.error
+        return 500, 3
+
+
+class FakePixels(list):
+    def __init__(self, bad=None, error=None):
+        super().__init__([[FakePixel(error if (row, col) == bad else None) for col in range(16)] for row in range(16)])
+        self.written = {}
+
+    async def write_async(self, register, value):
+        self.written[register] = value
+
+
+def chip(pixels):
+    etroc = object.__new__(etroc_controller.etroc_chip)
+    etroc.addr_i2c = 0x60
+    etroc.pixels = pixels
+    return etroc
+
+
+@pytest.mark.parametrize("error", [RetryExhausted("i2c_read", "nack", 4, RuntimeError("NACK")),
+                                   TimeoutError("I2C master 1 timed out")])
+def test_link_errors_give_nan(error):
+    pixels = FakePixels(bad=(3, 4), error=error)
+    baselines, noisewidths = etroc_controller.run_sync(chip(pixels).run_threshold_scan_async())
+    assert np.isnan(baselines[3, 4]) and np.isnan(noisewidths[3, 4])
+    assert np.isfinite(np.delete(baselines.reshape(-1), 3*16 + 4)).all()
+    assert pixels.written[PixReg.disDataReadout] == 0
+
+
+def test_bugs_are_raised():
+    pixels = FakePixels(bad=(0, 1), error=KeyError("DACC"))
+    with pytest.raises(KeyError):
+        etroc_controller.run_sync(chip(pixels).run_threshold_scan_async())
+    assert pixels.written[PixReg.disDataReadout] == 0
+    assert pixels.written[PixReg.enable_TDC] == 1
@@ -0,0 +1,71 @@
+"""
+Description:
+ETROC2 frame decoder: encode/decode round trip in both capture layouts.
+"""
+import numpy as np
+
+from mtd_sw.daq import etroc_decoder as dec
+
+
+def make_frames(rng, n_events=50, chip_id=0x1abcd):
+    frames, expected = [], []
+    for event in range(n_events):
+        l1counter, bcid = event % 256, rng.integers(0, 4096)
+        frames.append(dec.encode_header(l1counter, int(bcid), type=event % 4))
+        n_hits = rng.integers(0, 5)
+        for _ in range(n_hits):
+            hit = dict(row=rng.integers(16), col=rng.integers(16), toa=rng.integers(1024),
+                       tot=rng.integers(512), cal=rng.integers(1024), ea=rng.integers(4))
+            hit = {k: int(v) for k, v in hit.items()}
+            frames.append(dec.encode_hit(**hit))
+            expected.append(dict(hit, event=event, l1counter=l1counter, bcid=int(bcid)))
+        frames.append(dec.encode_trailer(chip_id, int(n_hits), status=event % 64, crc=event % 256))
+        if event % 10 == 0:
+            frames.append(dec.encode_filler(l1counter, int(bcid), ebs=1))
+    return np.array(frames, dtype=np.uint64), expected
+
+
+def check(decoded, expected, n_events, chip_id=0x1abcd):
+    assert len(decoded.headers) == len(decoded.trailers) == n_events
+    assert len(decoded.fillers) == (n_events + 9)//10
+    assert (decoded.headers["l1counter"] == np.arange(n_events) % 256).all()
+    assert (decoded.headers["type"] == np.arange(n_events) % 4).all()
+    assert (decoded.trailers["chip_id"] == chip_id).all()
+    assert (decoded.trailers["status"] == np.arange(n_events) % 64).all()
+    assert (decoded.trailers["event"] == np.arange(n_events)).all()
+    assert len(decoded.hits) == len(expected)
+    for name in ("row", "col", "toa", "tot", "cal", "ea", "event", "l1counter", "bcid"):
+        assert decoded.hits[name].tolist() == [hit[name] for hit in expected], name
+    counts = np.bincount(decoded.hits["event"], minlength=n_events)
+    assert (decoded.trailers["hits"] == counts).all()
+
+
+def test_round_trip():
+    frames, expected = make_frames(np.random.default_rng(1))
+    check(dec.decode(frames), expected, 50)
+
+
+def test_round_trip_capture_layouts():
+    frames, expected = make_frames(np.random.default_rng(2))
+    packed = b"".join(int(frame).to_bytes(5, "big") for frame in frames)
+    check(dec.decode(packed, layout="packed40"), expected, 50)
+    # bits above 40 in the u64 layout are ignored
+    u64 = (frames | np.uint64(0xab << 48)).astype("<u8").tobytes()
+    check(dec.decode(u64, layout="u64"), expected, 50)
+
+
+def test_load_frames(tmp_path):
+    frames, expected = make_frames(np.random.default_rng(3), n_events=5)
+    path = tmp_path/"capture.bin"
+    path.write_bytes(b"".join(int(frame).to_bytes(5, "big") for frame in frames) + b"\x01\x02")
+    check(dec.decode(dec.load_frames(str(path))), expected, 5)
+
+
+def test_hits_before_first_header_are_untagged():
+    frames = np.array([dec.encode_hit(1, 2, 3, 4, 5), dec.encode_header(7, 100), dec.encode_hit(3, 4, 5, 6, 7),
+                       dec.encode_trailer(1, 1)], dtype=np.uint64)
+    decoded = dec.decode(frames)
+    assert decoded.kind.tolist() == [dec.DATA, dec.HEADER, dec.DATA, dec.TRAILER]
+    assert decoded.hits["event"].tolist() == [-1, 0]
+    assert decoded.hits["l1counter"].tolist() == [0, 7]
+    assert decoded.hits["bcid"].tolist() == [0, 100]
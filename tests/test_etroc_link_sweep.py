@@ -0,0 +1,98 @@
+"""
+Description:
+Uplink sweep: the working point choice, skipping points known to be error free, and the
+chip put back to its settings after the sweep.
+"""
+import numpy as np
+import pytest
+
+from mtd_sw.controllers import etroc_link_sweep
+from mtd_sw.controllers.etroc_registers import PeriReg
+
+INITIAL = {PeriReg.singlePort: 0, PeriReg.serRateLeft: 1, PeriReg.serRateRight: 1, PeriReg.LTx_AmplSel: 4,
+           PeriReg.RTx_AmplSel: 4, PeriReg.linkResetTestPattern: 0, PeriReg.linkResetFixedPattern: 0x1234,
+           PeriReg.asyLinkReset: 1}
+
+
+class FakeEtroc:
+    addr_i2c = 0x60
+    i2c_master = 1
+
+    def __init__(self):
+        self.periphery = dict(INITIAL)
+        self.writes = 0
+
+    def write(self, register, value):
+        self.periphery[register] = value
+        self.writes += 1
+
+    def read(self, register):
+        return self.periphery[register]
+
+
+def pattern_frames(errors: bool, n=64):
+    frames = np.full(n, etroc_link_sweep.FIXED_PATTERN, dtype=np.uint64)
+    if errors:
+        frames[::8] ^= np.uint64(0b101)
+    return frames
+
+
+class Captures:
+    """
+    Error free at amplitudes 2-5 up to 640 Mbps, records the points measured
+    """
+    def __init__(self):
+        self.measured = []
+
+    def __call__(self, link, point):
+        self.measured.append((link, point))
+        return pattern_frames(not (2 <= point.amplitude <= 5 and point.ser_rate <= 1))
+
+
+def sweep(etroc, captures, cache_path, counter=None):
+    return etroc_link_sweep.UplinkSweep(etroc, counter or etroc_link_sweep.ReplayErrorCounter(captures),
+                                        duration=0, cache_path=cache_path)
+
+
+def test_working_point():
+    shape = (2, 3, 8)
+    bits = np.ones(shape, dtype=np.int64)
+    errors = np.ones(shape, dtype=np.int64)
+    errors[0, 1, 1:6] = 0       # dual port, 640 Mbps, amplitudes 1-5
+    errors[0, 1, 7] = 0
+    errors[1, 1, 0:8] = 0       # single port is wider but dual port is preferred
+    errors[0, 0, :] = 0
+    result = etroc_link_sweep.LinkSweepResult("left", ("dual", "single"), (0, 1, 2), tuple(range(8)), errors, bits)
+    assert result.working_point() == etroc_link_sweep.SweepPoint("dual", 1, 3)
+    assert etroc_link_sweep.LinkSweepResult("left", ("dual",), (0,), (0,), np.ones((1, 1, 1)),
+                                            np.ones((1, 1, 1))).working_point() is None
+
+
+def test_sweep_restores_the_chip_and_skips_known_good(tmp_path):
+    etroc = FakeEtroc()
+    captures = Captures()
+    cache_path = str(tmp_path/"sweeps.json")
+    results = sweep(etroc, captures, cache_path).run()
+    assert etroc.periphery == INITIAL
+    assert results["left"].working_point() == etroc_link_sweep.SweepPoint("dual", 1, 3)
+    good = int(((results["left"].errors == 0) & (results["left"].bits > 0)).sum())
+    assert good == 2*2*4
+
+    captures.measured.clear()
+    again = sweep(etroc, captures, cache_path).run()
+    assert len(captures.measured) == 2*(2*3*8 - good)      # both links, only the failing points
+    assert (again["right"].bits == results["right"].bits).all()
+    assert etroc.periphery == INITIAL
+
+
+def test_failed_sweep_restores_the_chip(tmp_path):
+    class Failing:
+        def count(self, etroc, link, point, duration):
+            if point.ser_rate == 2:
+                raise TimeoutError("back end not responding")
+            return 0, 32
+
+    etroc = FakeEtroc()
+    with pytest.raises(TimeoutError):
+        sweep(etroc, None, str(tmp_path/"sweeps.json"), counter=Failing()).run()
+    assert etroc.periphery == INITIAL
@@ -0,0 +1,146 @@
+"""
+Description:
+Scan bookkeeping: serpentine ordering, PixelRegister write counts, the charge injection
+scan restoring the chip when it ends or fails, and the noise scan masking.
+"""
+import numpy as np
+import pytest
+
+from mtd_sw.controllers import etroc_scans
+from mtd_sw.controllers.etroc_registers import PeriReg, PixReg
+
+
+class FakeEtroc:
+    """
+    Register store with broadcast semantics, counts every write
+    """
+    addr_i2c = 0x60
+
+    def __init__(self):
+        self.pixels = {}
+        self.periphery = {PeriReg.chargeInjectionDelay: 7, PeriReg.asyResetChargeInj: 0}
+        self.writes = []
+
+    def write(self, register, value, row=None, col=None, broadcast=False):
+        self.writes.append((register, value, row, col, broadcast))
+        if isinstance(register, PeriReg):
+            self.periphery[register] = value
+        elif broadcast:
+            for r in range(16):
+                for c in range(16):
+                    self.pixels[register, r, c] = value
+        else:
+            self.pixels[register, row, col] = value
+
+    def read(self, register, row=None, col=None):
+        if isinstance(register, PeriReg):
+            return self.periphery.get(register, 0)
+        return self.pixels.get((register, row, col), 0)
+
+    def pixel_values(self, register):
+        return np.array([[self.read(register, r, c) for c in range(16)] for r in range(16)])
+
+
+@pytest.mark.parametrize("shape", [(3,), (2, 3), (3, 2, 4)])
+def test_serpentine_changes_one_axis_per_step(shape):
+    points = etroc_scans.serpentine(shape)
+    assert sorted(points) == sorted(np.ndindex(*shape))
+    steps = np.abs(np.diff(np.array(points), axis=0))
+    assert (steps.sum(axis=1) == 1).all()
+
+
+def test_pixel_register_writes_only_differences():
+    etroc = FakeEtroc()
+    register = etroc_scans.PixelRegister(etroc, PixReg.DAC)
+    values = np.full((16, 16), 500)
+    values[3, 4] = 510
+    assert register.apply(values) == 2          # broadcast of 500 plus one pixel
+    values[0, 0] = 490
+    assert register.apply(values) == 1
+    assert register.apply(np.full((16, 16), 600)) == 1
+    assert register.writes == 4
+    assert (etroc.pixel_values(PixReg.DAC) == 600).all()
+
+
+def test_pixel_groups_cover_the_matrix_once():
+    groups = etroc_scans.pixel_groups(16)
+    assert (np.sum(groups, axis=0) == 1).all()
+    mask = etroc_scans.PixelMask(FakeEtroc(), PixReg.QInjEn)
+    assert len(etroc_scans.order_groups(groups, mask)) == 16
+
+
+def scan(etroc, backend, **kwargs):
+    return etroc_scans.ChargeInjectionScan(etroc, backend, qsels=(0, 8), dacs=(500, 520), delays=(5, 10),
+                                           groups=etroc_scans.pixel_groups(2), pulses=5, **kwargs)
+
+
+def test_injection_scan_restores_the_chip():
+    etroc = FakeEtroc()
+    etroc.write(PixReg.QSel, 3, broadcast=True)
+    thresholds = np.full((16, 16), 530)
+    thresholds[1, 1] = 540
+    result = scan(etroc, etroc_scans.SimulatedInjection(seed=1), thresholds=thresholds).run()
+    assert result.efficiency.shape == (2, 2, 2, 16, 16)
+    assert (etroc.pixel_values(PixReg.DAC) == thresholds).all()
+    assert (etroc.pixel_values(PixReg.QSel) == 3).all()
+    assert (etroc.pixel_values(PixReg.Bypass_THCal) == 0).all()
+    assert not etroc.pixel_values(PixReg.QInjEn).any()
+    assert etroc.periphery[PeriReg.chargeInjectionDelay] == 7
+    assert etroc.periphery[PeriReg.asyResetChargeInj] == 0
+
+
+def test_failed_injection_scan_still_restores():
+    class Failing(etroc_scans.SimulatedInjection):
+        def inject(self, etroc, count, point):
+            raise RuntimeError("fast command link down")
+
+    etroc = FakeEtroc()
+    with pytest.raises(RuntimeError):
+        scan(etroc, Failing()).run()
+    assert (etroc.pixel_values(PixReg.DAC) == 1023).all()
+    assert (etroc.pixel_values(PixReg.Bypass_THCal) == 0).all()
+    assert not etroc.pixel_values(PixReg.QInjEn).any()
+    assert etroc.periphery[PeriReg.chargeInjectionDelay] == 7
+    assert etroc.periphery[PeriReg.asyResetChargeInj] == 0
+
+
+def hot_pixels(*pixels, occupancy=0.3):
+    hot = np.zeros((16, 16))
+    for pixel in pixels:
+        hot[pixel] = occupancy
+    return hot
+
+
+def test_noise_scan_masks_hot_pixels():
+    etroc = FakeEtroc()
+    source = etroc_scans.SimulatedNoise(hot=hot_pixels((2, 3), (9, 9)), seed=2)
+    result = etroc_scans.NoiseScan(etroc, source, thresholds=530, noise_limit=1e-2).run()
+    assert result.quiet and result.iterations == 2
+    assert set(zip(*np.nonzero(result.masked))) == {(2, 3), (9, 9)}
+    assert (result.newly_masked == result.masked).all()
+    for register in (PixReg.disDataReadout, PixReg.disTrigPath):
+        assert (etroc.pixel_values(register).astype(bool) == result.masked).all()
+    assert (etroc.pixel_values(PixReg.DAC) == 530).all()
+
+
+def test_noise_scan_writes_masks_of_the_last_iteration():
+    etroc = FakeEtroc()
+    source = etroc_scans.SimulatedNoise(hot=hot_pixels((2, 3), (9, 9)), seed=2)
+    result = etroc_scans.NoiseScan(etroc, source, thresholds=530, noise_limit=1e-2, max_iterations=1).run()
+    assert not result.quiet
+    assert result.masked.sum() == 2
+    assert (etroc.pixel_values(PixReg.disDataReadout).astype(bool) == result.masked).all()
+
+
+def test_noise_scan_keeps_previous_masks_and_limits_masking():
+    etroc = FakeEtroc()
+    previous = np.zeros((16, 16), dtype=bool)
+    previous[0, 0] = True
+    hot = hot_pixels(*[(row, 5) for row in range(8)])
+    scan = etroc_scans.NoiseScan(etroc, etroc_scans.SimulatedNoise(hot=hot, seed=3), thresholds=530,
+                                 noise_limit=1e-2, masked=previous, max_masked=4)
+    result = scan.run()
+    assert not result.quiet
+    assert result.masked[0, 0] and not result.newly_masked[0, 0]
+    assert result.masked.sum() == 1              # eight noisy pixels would exceed max_masked
+    assert etroc.read(PixReg.disDataReadout, 0, 0)
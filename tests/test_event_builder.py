@@ -0,0 +1,70 @@
+import numpy as np
+from mtd_sw.daq.etroc_decoder import decode, encode_header, encode_hit, encode_trailer
+from mtd_sw.daq.event_builder import EventBuilder, unwrap_l1counter
+
+
+def make_stream(triggers, chip_id=0, bcid_offset=0, hits_per_event=1):
+    frames = []
+    for trigger in triggers:
+        frames.append(encode_header(trigger & 0xff, (trigger*7 + bcid_offset) % 3564))
+        for i in range(hits_per_event):
+            frames.append(encode_hit(row=i, col=chip_id, toa=trigger % 1024, tot=10, cal=200))
+        frames.append(encode_trailer(chip_id, hits_per_event))
+    return np.array(frames, dtype=np.uint64)
+
+
+def build_all(builder, blocks):
+    events, missing, late = [], [], []
+    for stream, frames in blocks:
+        built = builder.add(stream, decode(frames))
+        events.append(built.events), missing.append(built.missing), late.append(built.late)
+    built = builder.flush()
+    events.append(built.events), missing.append(built.missing)
+    return np.concatenate(events), np.concatenate(missing), np.concatenate(late)
+
+
+def test_unwrap_counts_through_wraps():
+    l1counter = np.array([254, 255, 0, 1, 3]) & 0xff
+    assert unwrap_l1counter(l1counter, previous=253).tolist() == [254, 255, 256, 257, 259]
+
+
+def test_unwrap_first_value_never_before_reference():
+    assert unwrap_l1counter([200, 201])[0] == 200
+    assert unwrap_l1counter([5], reference=300)[0] == 517
+    assert unwrap_l1counter([44], reference=300)[0] == 300
+
+
+def test_single_stream_starting_above_127():
+    builder = EventBuilder(1)
+    events, missing, late = build_all(builder, [(0, make_stream(range(200, 210)))])
+    assert events["trigger"].tolist() == list(range(200, 210))
+    assert len(missing) == 0 and len(late) == 0
+
+
+def test_two_streams_starting_at_250_lose_nothing():
+    triggers = range(250, 600)
+    builder = EventBuilder(2, bcid_offsets=[0, 100])
+    streams = [make_stream(triggers, chip_id=0), make_stream(triggers, chip_id=1, bcid_offset=100)]
+    blocks = [(s, block) for pair in zip(*(np.array_split(f, 7) for f in streams)) for s, block in enumerate(pair)]
+    events, missing, late = build_all(builder, blocks)
+    assert events["trigger"].tolist() == list(triggers)
+    assert (events["streams"] == 0b11).all() and not events["bcid_mismatch"].any()
+    assert (events["n_hits"] == 2).all()
+    assert len(missing) == 0 and len(late) == 0
+
+
+def test_missing_and_late_fragments_are_reported():
+    builder = EventBuilder(2)
+    full = list(range(0, 100))
+    events, missing, _ = build_all(builder, [
+        (0, make_stream(full)), (1, make_stream([t for t in full if t != 42]))])
+    assert len(events) == 100
+    assert missing.tolist() == [(42, 1)]
+
+    builder = EventBuilder(2, max_lag=10)
+    builder.add(0, decode(make_stream(range(0, 5))))
+    builder.add(1, decode(make_stream(range(0, 5))))
+    builder.add(0, decode(make_stream(range(5, 100))))
+    built = builder.add(1, decode(make_stream(range(5, 100))))
+    assert len(built.late) > 0
+    assert (built.late["stream"] == 1).all()
@@ -0,0 +1,76 @@
+"""
+Description:
+Per-pixel histograms: filling against a reference count, binning, merging and the
+shared-memory slots.
+"""
+import numpy as np
+import pytest
+
+from mtd_sw.daq import histograms
+from mtd_sw.daq.etroc_decoder import HIT_DTYPE
+
+
+def random_hits(rng, n):
+    hits = np.zeros(n, dtype=HIT_DTYPE)
+    hits["row"], hits["col"] = rng.integers(0, 16, n), rng.integers(0, 16, n)
+    hits["toa"], hits["tot"], hits["cal"] = rng.integers(0, 1024, n), rng.integers(0, 512, n), rng.integers(0, 1024, n)
+    return hits
+
+
+def reference(hits, chips, n_chips, name, value_range, bins):
+    counts = np.zeros((n_chips, 16, 16, bins))
+    np.add.at(counts, (chips, hits["row"], hits["col"], hits[name].astype(np.int64)*bins//value_range), 1)
+    return counts
+
+
+@pytest.mark.parametrize("n_hits", [50, 200000])      # unique-count and bincount paths
+def test_fill_matches_reference(n_hits):
+    rng = np.random.default_rng(n_hits)
+    hits = random_hits(rng, n_hits)
+    chips = rng.integers(0, 2, n_hits)
+    binning = {"toa": (1024, 64), "tot": (512, 512), "cal": (1024, 1024)}
+    h = histograms.PixelHistograms(n_chips=2, binning=binning)
+    h.fill(hits, chip=chips)
+    for name, (value_range, bins) in binning.items():
+        assert (h.counts[name] == reference(hits, chips, 2, name, value_range, bins)).all()
+    assert h.occupancy().sum() == n_hits
+
+
+def test_out_of_range_values_are_dropped_and_mean():
+    hits = np.zeros(3, dtype=HIT_DTYPE)
+    hits["toa"] = [10, 20, 2000]
+    h = histograms.PixelHistograms(binning={"toa": (1024, 1024)})
+    h.fill(hits)
+    assert h.counts["toa"].sum() == 2
+    assert h.mean("toa")[0, 0, 0] == pytest.approx(15)
+    assert np.isnan(h.mean("toa")[0, 1, 1])
+
+
+def test_mean_of_wide_bins():
+    hits = np.zeros(32, dtype=HIT_DTYPE)
+    hits["toa"] = np.arange(32)
+    h = histograms.PixelHistograms(binning={"toa": (1024, 64)})
+    h.fill(hits)
+    assert h.mean("toa")[0, 0, 0] == pytest.approx(hits["toa"].mean())
+
+
+def test_shared_slots_sum_to_the_total():
+    rng = np.random.default_rng(5)
+    shared = histograms.SharedPixelHistograms.create(n_workers=2, n_chips=1)
+    try:
+        expected = histograms.PixelHistograms()
+        for worker in range(2):
+            shard = histograms.PixelHistograms()
+            hits = random_hits(rng, 1000)
+            shard.fill(hits)
+            expected.fill(hits)
+            attached = histograms.SharedPixelHistograms.attach(shared.name, 2, 1)
+            attached.merge(shard, worker)
+            attached.close()
+            assert shard.occupancy().sum() == 0
+        total = shared.total()
+        for name in expected.counts:
+            assert (total.counts[name] == expected.counts[name]).all()
+    finally:
+        shared.close()
+        shared.unlink()
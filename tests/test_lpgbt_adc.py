@@ -0,0 +1,66 @@
+"""
+Description:
+lpGBT ADC calibration: every ADC access, also from the background recalibration, holds
+the lpGBT's IC lock.
+"""
+import threading
+
+import pytest
+
+lpgbt_adc = pytest.importorskip("mtd_sw.controllers.lpgbt_adc")
+from mtd_sw.controllers.lpgbt_i2c import ic_lock
+
+ADC_VALUES = {lpgbt_adc.ADC_OFFSET_INPUT: 512, lpgbt_adc.ADC_GAIN_INPUT: 512 + 474,
+              lpgbt_adc.ADC_TEMPERATURE_INPUT: 400}
+
+
+class FakeAdcLpgbt:
+    """
+    Counts the ADC and register accesses made without holding the IC lock
+    """
+    Reg = {"ADCMON": 0x1}
+
+    def __init__(self):
+        self.regs = {}
+        self.unlocked = 0
+
+    def _check(self):
+        if not ic_lock(self)._is_owned():
+            self.unlocked += 1
+
+    def read_adc(self, channel):
+        self._check()
+        return ADC_VALUES[channel]
+
+    def read_reg(self, address):
+        self._check()
+        return self.regs.get(address, 0)
+
+    def write_reg(self, address, value):
+        self._check()
+        self.regs[address] = value
+
+
+def test_lock_is_the_ic_lock(tmp_path):
+    lpgbt = FakeAdcLpgbt()
+    calibrator = lpgbt_adc.AdcCalibrator(lpgbt, lpgbt_adc.AdcCalibrationStore(str(tmp_path/"adc.json")))
+    assert calibrator.lock is ic_lock(lpgbt)
+
+
+def test_background_calibration_waits_for_the_ic_lock(tmp_path):
+    lpgbt = FakeAdcLpgbt()
+    calibrator = lpgbt_adc.AdcCalibrator(lpgbt, lpgbt_adc.AdcCalibrationStore(str(tmp_path/"adc.json")), max_age=0)
+    calibration = calibrator.calibrate()
+    assert calibration.gain == pytest.approx(1.85, abs=0.01)
+    started = threading.Event()
+    with ic_lock(lpgbt):
+        # another thread (e.g. an I2C scheduler worker) owns the IC link
+        thread = threading.Thread(target=lambda: (started.set(), calibrator.check(force=True)))
+        thread.start()
+        started.wait()
+        thread.join(0.05)
+        assert thread.is_alive()        # blocked on the IC lock
+    thread.join()
+    calibrator._thread.join()
+    assert calibrator.calibration is not calibration
+    assert lpgbt.unlocked == 0
@@ -0,0 +1,43 @@
+"""
+Description:
+Image writes: only differing registers are written, and gaps are only bridged over
+registers of the image.
+"""
+import pytest
+
+lpgbt_config = pytest.importorskip("mtd_sw.controllers.lpgbt_config")
+
+
+class FakeRegisters:
+    def __init__(self, values):
+        self.values = dict(values)
+        self.writes = []
+
+    def read_regs(self, address, n):
+        return [self.values.get(address + i, 0) for i in range(n)]
+
+    def write_regs(self, address, values):
+        self.writes.append((address, list(values)))
+        for i, value in enumerate(values):
+            self.values[address + i] = value
+
+
+def image(values):
+    result = lpgbt_config.RegisterImage.empty()
+    for address, value in values.items():
+        result.set(address, value)
+    return result
+
+
+def test_only_differing_registers_are_written():
+    chip = FakeRegisters({0x10: 1, 0x11: 2, 0x12: 3, 0x13: 4})
+    assert lpgbt_config.write_image(chip, image({0x10: 1, 0x11: 5, 0x12: 3, 0x13: 6})) == 2
+    assert chip.writes == [(0x11, [5]), (0x13, [6])]
+
+
+def test_gaps_are_bridged_only_over_image_registers():
+    chip = FakeRegisters({0x10: 1, 0x11: 2, 0x12: 3, 0x20: 0, 0x21: 7, 0x22: 0})
+    target = image({0x10: 9, 0x11: 2, 0x12: 9, 0x20: 9, 0x22: 9})
+    assert lpgbt_config.write_image(chip, target, max_gap=1) == 3
+    # 0x11 is in the image and bridged, 0x21 (e.g. a command register) is never written
+    assert chip.writes == [(0x10, [9, 2, 9]), (0x20, [9]), (0x22, [9])]
@@ -0,0 +1,58 @@
+"""
+Description:
+GPIO bank mirror: only changed PIOOUT registers are written, and writes of pins known only
+by name do not leave a stale mirror behind.
+"""
+import pytest
+
+lpgbt_gpio = pytest.importorskip("mtd_sw.controllers.lpgbt_gpio")
+
+PIODIRH, PIODIRL, PIOOUTH, PIOOUTL = 0x053, 0x054, 0x055, 0x056
+
+
+class FakeGpioLpgbt:
+    def __init__(self, named_pins=None):
+        self.Reg = {"PIODIRH": PIODIRH, "PIODIRL": PIODIRL, "PIOOUTH": PIOOUTH, "PIOOUTL": PIOOUTL}
+        self.config = {"configurations": {"GPIO": [{"register": "RESET1", "pin": 0}, {"register": "RESET2", "pin": 9}]}}
+        self.regs = {PIOOUTH: 0, PIOOUTL: 0}
+        self.named_pins = named_pins or {}
+        self.writes = []
+
+    def read_regs(self, address, n):
+        return [self.regs.get(address + i, 0) for i in range(n)]
+
+    def write_reg(self, address, value):
+        self.writes.append((address, [value]))
+        self.regs[address] = value
+
+    def write_regs(self, address, values):
+        self.writes.append((address, list(values)))
+        for i, value in enumerate(values):
+            self.regs[address + i] = value
+
+    def write_gpio_output(self, name, value):
+        # the lpGBT library knows the pin, the bank does not
+        pin = self.named_pins[name]
+        word = (self.regs[PIOOUTH] << 8) | self.regs[PIOOUTL]
+        word = (word & ~(1 << pin)) | (value << pin)
+        self.regs[PIOOUTH], self.regs[PIOOUTL] = word >> 8, word & 0xff
+
+
+def test_only_changed_registers_are_written():
+    chip = FakeGpioLpgbt()
+    bank = lpgbt_gpio.gpio_bank(chip)
+    assert lpgbt_gpio.gpio_bank(chip) is bank
+    bank.set_pins({"RESET1": 1, "RESET2": 1})
+    bank.set_pins({"RESET1": 1, 3: 1})
+    bank.set_pins({"RESET1": 1, 3: 1})
+    assert chip.writes == [(PIOOUTH, [0x02, 0x01]), (PIOOUTL, [0x09])]
+    assert bank.get_pin("RESET2") == 1
+
+
+def test_named_pin_fallback_does_not_leave_a_stale_mirror():
+    chip = FakeGpioLpgbt(named_pins={"MUXCNT1": 4})
+    bank = lpgbt_gpio.gpio_bank(chip)
+    bank.set_pins({"RESET1": 1})
+    bank.set_pins({"MUXCNT1": 1})
+    bank.set_pins({2: 1})
+    assert (chip.regs[PIOOUTH], chip.regs[PIOOUTL]) == (0x00, 0x15)
@@ -0,0 +1,167 @@
+"""
+Description:
+I2C scheduler against a register-level model of the lpGBT I2C masters: split transactions
+round trip, masters overlap on the bus, and no two IC accesses ever run at the same time.
+"""
+import threading
+import time
+
+import pytest
+
+lpgbt_i2c = pytest.importorskip("mtd_sw.controllers.lpgbt_i2c")
+
+BUS_TIME = 0.02         # time a transaction keeps the I2C bus busy
+MASTER_REGS = ["CONFIG", "ADDRESS", "DATA0", "DATA1", "DATA2", "DATA3", "CMD",
+               "CTRL", "STATUS"] + [f"READ{i}" for i in range(16)]
+
+
+class FakeI2CLpgbt:
+    """
+    IC registers of three I2C masters, each with 2-byte addressed slaves behind it.
+    Fails the test if two threads are inside an IC access at once.
+    """
+    def __init__(self, slaves=(0x60, 0x61, 0x62)):
+        self.Reg = {}
+        for master in range(3):
+            for i, name in enumerate(MASTER_REGS):
+                self.Reg[f"I2CM{master}{name}"] = 0x100 + 0x20*master + i
+        self.regs = {}
+        self.memory = {slave: {} for slave in slaves}
+        self.pointer = {}
+        self.done_at = {}
+        self.buffer = {master: [0]*16 for master in range(3)}
+        self.in_ic = 0
+        self.overlaps = 0
+        self.calls_lock = threading.Lock()
+
+    def _enter(self):
+        with self.calls_lock:
+            self.in_ic += 1
+            if self.in_ic > 1:
+                self.overlaps += 1
+        time.sleep(0.0005)
+
+    def _leave(self):
+        with self.calls_lock:
+            self.in_ic -= 1
+
+    def _master(self, address):
+        return (address - 0x100)//0x20, MASTER_REGS[(address - 0x100) % 0x20]
+
+    def read_reg(self, address):
+        self._enter()
+        try:
+            master, name = self._master(address)
+            if name == "STATUS":
+                status = self.regs.get(address, 0)
+                if status == 0x04 and time.monotonic() < self.done_at[master]:
+                    return 0
+                return status
+            return self.regs.get(address, 0)
+        finally:
+            self._leave()
+
+    def read_regs(self, address, n):
+        self._enter()
+        try:
+            return [self.regs.get(address + i, 0) for i in range(n)]
+        finally:
+            self._leave()
+
+    def write_regs(self, address, values):
+        self._enter()
+        try:
+            for i, value in enumerate(values):
+                self.regs[address + i] = value
+        finally:
+            self._leave()
+
+    def write_reg(self, address, value):
+        self._enter()
+        try:
+            self.regs[address] = value
+            master, name = self._master(address)
+            if name == "CMD":
+                self._command(master, value)
+        finally:
+            self._leave()
+
+    def _command(self, master, command):
+        reg = lambda name: self.Reg[f"I2CM{master}{name}"]
+        data = [self.regs.get(reg(f"DATA{i}"), 0) for i in range(4)]
+        if command == 0x0:
+            self.regs[reg("CTRL")] = data[0]
+            return
+        if 0x8 <= command <= 0xB:
+            self.buffer[master][4*(command - 0x8):4*(command - 0x8) + 4] = data
+            return
+        nbytes = (self.regs.get(reg("CTRL"), 0) >> 2) & 0x1f
+        slave = self.regs.get(reg("ADDRESS"), 0)
+        if slave not in self.memory:
+            self.regs[reg("STATUS")] = 0x40
+            return
+        if command == 0xC:
+            payload = self.buffer[master][:nbytes]
+            pointer = payload[0] | (payload[1] << 8)
+            for i, value in enumerate(payload[2:]):
+                self.memory[slave][pointer + i] = value
+            self.pointer[slave] = pointer
+        elif command == 0xD:
+            for i in range(nbytes):
+                self.regs[reg(f"READ{15 - i}")] = self.memory[slave].get(self.pointer[slave] + i, 0)
+        self.done_at[master] = time.monotonic() + BUS_TIME
+        self.regs[reg("STATUS")] = 0x04
+
+
+@pytest.fixture
+def lpgbt():
+    chip = FakeI2CLpgbt()
+    yield chip
+    lpgbt_i2c.shutdown_i2c_scheduler(chip)
+
+
+def test_split_transactions_round_trip(lpgbt):
+    scheduler = lpgbt_i2c.i2c_scheduler(lpgbt)
+    assert scheduler.split_phase
+    scheduler.write(0, 0x60, 0x1234, [1, 2, 3]).result()
+    assert scheduler.read(0, 0x60, 0x1234, read_len=3).result() == [1, 2, 3]
+    assert lpgbt.memory[0x60] == {0x1234: 1, 0x1235: 2, 0x1236: 3}
+
+
+def test_nack_and_timeout(lpgbt):
+    scheduler = lpgbt_i2c.i2c_scheduler(lpgbt)
+    with pytest.raises(lpgbt_i2c.I2CTransactionError, match="NACK"):
+        scheduler.read(1, 0x70, 0x0).result()
+    with pytest.raises(TimeoutError):
+        scheduler.write(1, 0x61, 0x0, 5, timeout=BUS_TIME/4).result()
+
+
+def test_masters_overlap_without_concurrent_ic_access(lpgbt):
+    scheduler = lpgbt_i2c.i2c_scheduler(lpgbt)
+    n = 5
+    start = time.monotonic()
+    futures = [scheduler.write(master, 0x60 + master, i, i) for i in range(n) for master in range(3)]
+    for future in futures:
+        future.result()
+    elapsed = time.monotonic() - start
+    assert elapsed < 2*n*BUS_TIME          # three masters one after the other would take 3*n*BUS_TIME
+    assert lpgbt.overlaps == 0
+    assert all(lpgbt.memory[0x60 + master] == {i: i for i in range(n)} for master in range(3))
+
+
+def test_queue_depth_and_shutdown(lpgbt):
+    scheduler = lpgbt_i2c.i2c_scheduler(lpgbt)
+    assert lpgbt_i2c.i2c_scheduler(lpgbt) is scheduler
+    labels = {"lpgbt": f"{id(lpgbt):x}", "master": 2}
+    release = threading.Event()
+    scheduler.submit(2, release.wait)
+    queued = [scheduler.submit(2, lambda: None) for _ in range(3)]
+    assert lpgbt_i2c.I2C_QUEUE_DEPTH.value(**labels) == 3
+    release.set()
+    for future in queued:
+        future.result()
+    assert lpgbt_i2c.I2C_QUEUE_DEPTH.value(**labels) == 0
+    lpgbt_i2c.shutdown_i2c_scheduler(lpgbt)
+    assert all(dict(key) != {k: str(v) for k, v in labels.items()}
+               for _, key, _ in lpgbt_i2c.I2C_QUEUE_DEPTH.samples())
+    assert lpgbt_i2c.i2c_scheduler(lpgbt) is not scheduler
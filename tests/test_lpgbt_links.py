@@ -0,0 +1,60 @@
+"""
+Description:
+Link discovery with a prober that only answers on one candidate.
+"""
+import pytest
+
+lpgbt_links = pytest.importorskip("mtd_sw.controllers.lpgbt_links")
+
+
+class FakeProber:
+    concurrent = False
+
+    def __init__(self, good):
+        self.good = good
+        self.probed = []
+        self.selected = []
+
+    def probe(self, candidate):
+        self.probed.append(candidate)
+        return candidate == self.good
+
+    def select(self, candidate):
+        self.selected.append(candidate)
+
+
+def test_candidates_include_downlink_equal_uplink():
+    search = lpgbt_links.candidates(uplinks=range(3), inverts=(True,))
+    assert [(c.downlink, c.uplink) for c in search] == [(4, 0), (4, 1), (4, 2), (0, 0), (1, 1), (2, 2)]
+    assert len(lpgbt_links.candidates(uplinks=range(3), same_downlink=False)) == 6
+
+
+def test_failed_cached_candidate_is_not_probed_again(tmp_path):
+    cache = lpgbt_links.LinkCache(str(tmp_path/"links.json"))
+    stale = lpgbt_links.LinkCandidate(4, 0, None, True)
+    good = lpgbt_links.LinkCandidate(4, 2, None, False)
+    cache.put("RB0", stale)
+    prober = FakeProber(good)
+    assert lpgbt_links.discover_link(prober, "RB0", retries=2, backoff=0, cache=cache) == good
+    assert prober.probed.count(stale) == 2
+    assert prober.selected == [good]
+    assert cache.get("RB0") == good
+
+
+def test_no_link_raises(tmp_path):
+    cache = lpgbt_links.LinkCache(str(tmp_path/"links.json"))
+    with pytest.raises(lpgbt_links.LinkDiscoveryError):
+        lpgbt_links.discover_link(FakeProber(None), "RB0", search=lpgbt_links.candidates(uplinks=[0]),
+                                  retries=1, backoff=0, cache=cache)
+
+
+def test_retry_backoff_is_capped(tmp_path, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(lpgbt_links.time, "sleep", sleeps.append)
+    cache = lpgbt_links.LinkCache(str(tmp_path/"links.json"))
+    with pytest.raises(lpgbt_links.LinkDiscoveryError):
+        lpgbt_links.discover_link(FakeProber(None), "RB0", search=[lpgbt_links.LinkCandidate(4, 0)],
+                                  retries=50, backoff=0.05, max_backoff=0.5, cache=cache)
+    assert len(sleeps) == 49
+    assert sleeps[:4] == [0.05, 0.1, 0.2, 0.4]
+    assert max(sleeps) == 0.5
@@ -0,0 +1,76 @@
+"""
+Description:
+Retry policy: error classification, retries with recovery, and errors that are never retried.
+"""
+import pytest
+
+lpgbt_retry = pytest.importorskip("mtd_sw.controllers.lpgbt_retry")
+
+
+class NackError(RuntimeError):
+    pass
+
+
+def flaky(errors):
+    """
+    Function raising the given errors one per call, then returning "ok"
+    """
+    errors = list(errors)
+    calls = []
+
+    def function(*args, **kwargs):
+        calls.append((args, kwargs))
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+    return function, calls
+
+
+@pytest.mark.parametrize("error, kind", [
+    (TimeoutError("slow"), lpgbt_retry.TIMEOUT),
+    (ConnectionError("reset by peer"), lpgbt_retry.LINK),
+    (NackError("slave 0x60"), lpgbt_retry.NACK),
+    (RuntimeError("I2C transaction timed out"), lpgbt_retry.TIMEOUT),
+    (RuntimeError("uHAL exception"), lpgbt_retry.LINK),
+    (RuntimeError("something else"), None),
+    (ValueError("timeout out of range"), None),
+    (KeyError("link"), None),
+])
+def test_classify(error, kind):
+    assert lpgbt_retry.classify(error) == kind
+
+
+def test_retries_then_succeeds_with_recovery():
+    recovered = []
+    policy = lpgbt_retry.RetryPolicy(base_delay=0, recovery={lpgbt_retry.TIMEOUT: lambda: recovered.append(1)})
+    function, calls = flaky([TimeoutError(), TimeoutError()])
+    assert policy.wrap(function, op="test")(1, reg=2) == "ok"
+    assert calls == [((1,), {"reg": 2})]*3
+    assert recovered == [1, 1]
+
+
+def test_exhausted_after_max_attempts():
+    policy = lpgbt_retry.RetryPolicy(max_attempts=3, base_delay=0)
+    function, calls = flaky([NackError("x")]*5)
+    with pytest.raises(lpgbt_retry.RetryExhausted) as info:
+        policy.call(function, op="i2c_read")
+    assert len(calls) == 3
+    assert (info.value.kind, info.value.attempts) == (lpgbt_retry.NACK, 3)
+
+
+def test_bugs_and_excluded_kinds_are_not_retried():
+    policy = lpgbt_retry.RetryPolicy(base_delay=0, retry_on=(lpgbt_retry.TIMEOUT,))
+    for error in (TypeError("bad argument"), NackError("x")):
+        function, calls = flaky([error])
+        with pytest.raises(type(error)):
+            policy.call(function)
+        assert len(calls) == 1
+
+
+def test_failing_recovery_does_not_stop_the_retries():
+    def broken():
+        raise RuntimeError("reset failed")
+    policy = lpgbt_retry.RetryPolicy(base_delay=0, recovery={lpgbt_retry.LINK: broken})
+    function, calls = flaky([ConnectionError()])
+    assert policy.call(function) == "ok"
+    assert len(calls) == 2
@@ -0,0 +1,60 @@
+"""
+Description:
+Metrics registry: Prometheus text rendering, gauges and the timed wrapper.
+"""
+import math
+
+import pytest
+
+from mtd_sw.utils import metrics
+
+
+def test_metric_is_abstract():
+    with pytest.raises(TypeError):
+        metrics.Metric("x", "help")
+
+
+def test_render_counter_gauge_histogram():
+    registry = metrics.MetricsRegistry()
+    counter = registry.counter("etl_test_total", "Test counter")
+    counter.inc(chip="0x60")
+    counter.inc(2, chip="0x60")
+    gauge = registry.gauge("etl_test_depth", "Test gauge")
+    gauge.set_function(lambda: 4, master=1)
+    histogram = registry.histogram("etl_test_seconds", "Test histogram", buckets=(0.1, 1))
+    histogram.observe(0.5)
+    text = registry.render()
+    assert "# TYPE etl_test_total counter" in text
+    assert 'etl_test_total{chip="0x60"} 3.0' in text
+    assert 'etl_test_depth{master="1"} 4.0' in text
+    assert 'etl_test_seconds_bucket{le="0.1"} 0' in text
+    assert 'etl_test_seconds_bucket{le="+Inf"} 1' in text
+    assert registry.counter("etl_test_total", "again") is counter
+    with pytest.raises(TypeError):
+        registry.gauge("etl_test_seconds", "wrong kind")
+
+
+def test_gauge_names_and_remove():
+    registry = metrics.MetricsRegistry()
+    with pytest.raises(ValueError):
+        registry.gauge("etl_pixels_total", "gauges do not take the counter suffix")
+    gauge = registry.gauge("etl_pixels", "Pixels")
+    gauge.set(3, chip="a")
+    gauge.set_function(lambda: 1/0, chip="b")
+    assert math.isnan(dict((key, value) for _, key, value in gauge.samples())[(("chip", "b"),)])
+    gauge.remove(chip="b")
+    assert [key for _, key, _ in gauge.samples()] == [(("chip", "a"),)]
+
+
+def test_timed_counts_errors():
+    registry = metrics.MetricsRegistry()
+    calls = registry.counter("etl_calls_total", "")
+    errors = registry.counter("etl_errors_total", "")
+    latency = registry.histogram("etl_latency_seconds", "")
+
+    def fail():
+        raise OSError("nack")
+    with pytest.raises(OSError):
+        metrics.timed(fail, calls, latency, errors, op="read")()
+    assert metrics.timed(lambda x: x, calls, latency, errors, op="read")(5) == 5
+    assert calls.value(op="read") == 2 and errors.value(op="read") == 1
@@ -0,0 +1,81 @@
+"""
+Description:
+DAQ pipeline: blocks cut on event boundaries, every consumer sees every hit, and stage
+errors are raised by run().
+"""
+import io
+
+import numpy as np
+import pytest
+
+from mtd_sw.daq import pipeline
+from mtd_sw.daq.etroc_decoder import encode_header, encode_hit, encode_trailer
+
+
+def make_frames(n_events):
+    frames = []
+    for event in range(n_events):
+        frames.append(encode_header(event % 256, event))
+        frames += [encode_hit(event % 16, hit, event % 1024, 1, 2) for hit in range(event % 5)]
+        frames.append(encode_trailer(0x11, event % 5))
+    return np.array(frames, dtype=np.uint64)
+
+
+class Collector:
+    def __init__(self):
+        self.blocks = []
+
+    def consume(self, block):
+        self.blocks.append(block)
+
+
+@pytest.mark.parametrize("layout", ["packed40", "u64"])
+def test_events_are_never_split(layout):
+    frames = make_frames(300)
+    first, second = Collector(), Collector()
+    pipeline.Pipeline(pipeline.replay_source(frames, block_frames=37, layout=layout),
+                      [first.consume, second.consume], layout=layout, queue_blocks=2).run()
+    for collector in (first, second):
+        blocks = collector.blocks
+        assert [block.index for block in blocks] == list(range(len(blocks)))
+        assert (np.concatenate([block.frames for block in blocks]) == frames).all()
+        for block in blocks:
+            # every block starts with a header and holds whole events
+            assert block.decoded.kind[0] == 0
+            assert len(block.decoded.headers) == len(block.decoded.trailers)
+        assert sum(len(block.decoded.hits) for block in blocks) == sum(event % 5 for event in range(300))
+
+
+def test_stream_source_keeps_partial_frames():
+    data = b"".join(int(frame).to_bytes(5, "big") for frame in make_frames(20))
+
+    class ShortReads(io.RawIOBase):
+        def __init__(self):
+            self.position = 0
+
+        def read(self, n):
+            chunk = data[self.position:self.position + min(n, 7)]
+            self.position += len(chunk)
+            return chunk
+    blocks = list(pipeline.stream_source(ShortReads(), block_bytes=23))
+    assert all(len(block) % 5 == 0 for block in blocks)
+    assert b"".join(blocks) == data
+
+
+def test_consumer_error_stops_the_pipeline():
+    def broken(block):
+        raise RuntimeError("disk full")
+    with pytest.raises(RuntimeError, match="disk full"):
+        pipeline.Pipeline(pipeline.replay_source(make_frames(1000), block_frames=10, repeat=50),
+                          [broken, Collector().consume], queue_blocks=1, name="test-fail").run()
+    assert not [key for _, key, _ in pipeline.STAGE_QUEUE.samples() if ("pipeline", "test-fail") in key]
+
+
+def test_consumers_of_one_class_get_their_own_stage():
+    first, second = Collector(), Collector()
+    pipeline.Pipeline(pipeline.replay_source(make_frames(50), block_frames=10), [first.consume, second.consume],
+                      name="test-stages").run()
+    labels = {"pipeline": "test-stages"}
+    blocks = len(first.blocks)
+    assert pipeline.STAGE_BLOCKS.value(stage="0:Collector.consume", **labels) == blocks
+    assert pipeline.STAGE_BLOCKS.value(stage="1:Collector.consume", **labels) == blocks
@@ -0,0 +1,101 @@
+"""
+Description:
+Raw data files: index built while writing, lookups, and recovery of a file left behind by
+a crashed writer.
+"""
+import os
+
+import numpy as np
+import pytest
+
+from mtd_sw.daq import raw_file
+from mtd_sw.daq.etroc_decoder import encode_filler, encode_header, encode_hit, encode_trailer
+
+
+def make_events(n_events, chips=(0x11, 0x22)):
+    """
+    Frames of n_events events (with fillers between some of them) and their expected index
+    """
+    frames, records = [], []
+    for event in range(n_events):
+        chip = chips[event % len(chips)]
+        start = len(frames)
+        frames.append(encode_header(event % 256, 3*event % 4096))
+        frames += [encode_hit(event % 16, 1, event % 1024, 2, 3) for _ in range(event % 4)]
+        frames.append(encode_trailer(chip, event % 4))
+        records.append((start, len(frames) - start, event % 256, 3*event % 4096, chip))
+        if event % 3 == 0:
+            frames.append(encode_filler(0, 0))
+    return np.array(frames, dtype=np.uint64), np.array(records, dtype=raw_file.INDEX_DTYPE)
+
+
+def write(path, frames, splits):
+    with raw_file.RawFileWriter(str(path)) as writer:
+        for block in np.split(frames, splits):
+            writer.append(block)
+    return str(path)
+
+
+def test_index_across_appends(tmp_path):
+    frames, expected = make_events(40)
+    # blocks end inside events, so events are indexed across appends
+    path = write(tmp_path/"run.raw", frames, [5, 6, 50, 101])
+    raw = raw_file.RawFile(path)
+    assert (raw.index == expected).all()
+    assert (raw.frames & raw_file.FRAME_MASK == frames).all()
+    event = raw.find(l1counter=7, chip_id=0x22)
+    assert event.tolist() == [7]
+    start, n = int(expected["offset"][7]), int(expected["n_frames"][7])
+    assert (raw.event_frames(7) == frames[start:start + n]).all()
+    assert raw.byte_offset(7) == raw_file.HEADER_SIZE + 8*start
+    chip = expected[expected["chip_id"] == 0x11]
+    assert (raw.chip_frames(0x11) == np.concatenate([frames[o:o + n] for o, n in zip(chip["offset"], chip["n_frames"])])).all()
+
+
+def crash(path, n_records, lost_records):
+    """
+    Leaves the file as a writer killed mid-write would: a torn body word, the last index
+    records missing and a torn index record
+    """
+    with open(path, "ab") as f:
+        f.write(b"\x01\x02\x03")
+    keep = (n_records - lost_records)*raw_file.INDEX_DTYPE.itemsize
+    os.truncate(raw_file.index_path(path), keep + 5)
+
+
+def test_reader_indexes_what_the_index_file_is_missing(tmp_path):
+    frames, expected = make_events(30)
+    path = write(tmp_path/"run.raw", frames, [40])
+    crash(path, len(expected), lost_records=4)
+    raw = raw_file.RawFile(path)
+    assert (raw.index == expected).all()
+    assert os.path.getsize(raw_file.index_path(path)) % raw_file.INDEX_DTYPE.itemsize == 5    # files untouched
+
+
+def test_writer_recovers_and_continues(tmp_path):
+    frames, expected = make_events(30)
+    # the crash happens inside an event, the reopened writer completes it
+    cut = int(expected["offset"][20]) + 1
+    path = write(tmp_path/"run.raw", frames[:cut], [])
+    crash(path, 20, lost_records=3)
+    with raw_file.RawFileWriter(path) as writer:
+        assert writer.frames == cut
+        writer.append(frames[cut:])
+    assert (raw_file.RawFile(path).index == expected).all()
+    assert os.path.getsize(raw_file.index_path(path)) == len(expected)*raw_file.INDEX_DTYPE.itemsize
+
+
+def test_index_pointing_past_the_body_is_rebuilt(tmp_path):
+    frames, expected = make_events(10)
+    path = write(tmp_path/"run.raw", frames, [])
+    os.truncate(path, raw_file.HEADER_SIZE + 8*int(expected["offset"][8]))
+    assert (raw_file.RawFile(path).index == expected[:8]).all()
+    raw_file.recover(path)
+    assert (raw_file.RawFile(path).index == expected[:8]).all()
+
+
+def test_not_a_raw_file(tmp_path):
+    path = tmp_path/"other.raw"
+    path.write_bytes(b"\0"*(raw_file.HEADER_SIZE + 16))
+    with pytest.raises(ValueError):
+        raw_file.recover(str(path))
@@ -0,0 +1,81 @@
+"""
+Description:
+Time-walk calibration: per-pixel polynomial fits recovered from simulated hits, streaming
+updates and merges equal to one fit, save/load.
+"""
+import numpy as np
+import pytest
+
+from mtd_sw.daq import timewalk
+from mtd_sw.daq.etroc_decoder import HIT_DTYPE
+
+
+def simulate(rng, n, coefficients, chip_of_hit=None, jitter=0.0):
+    """
+    Hits whose TOA follows coefficients[chip, row, col] (lowest power first, in TOT/512)
+    """
+    hits = np.zeros(n, dtype=HIT_DTYPE)
+    hits["row"], hits["col"] = rng.integers(0, 16, n), rng.integers(0, 16, n)
+    hits["tot"] = rng.integers(20, 500, n)
+    chip = np.zeros(n, dtype=np.int64) if chip_of_hit is None else chip_of_hit
+    c = coefficients[chip, hits["row"], hits["col"]]
+    x = hits["tot"]/timewalk.TOT_SCALE
+    toa = sum(c[:, k]*x**k for k in range(c.shape[1])) + jitter*rng.standard_normal(n)
+    hits["toa"] = np.round(toa)
+    return hits, toa
+
+
+def test_fit_recovers_per_pixel_walk():
+    rng = np.random.default_rng(1)
+    truth = np.empty((2, 16, 16, 3))
+    truth[..., 0] = rng.uniform(300, 500, (2, 16, 16))
+    truth[..., 1] = rng.uniform(-300, -100, (2, 16, 16))
+    truth[..., 2] = rng.uniform(50, 150, (2, 16, 16))
+    chips = rng.integers(0, 2, 200000)
+    hits, _ = simulate(rng, len(chips), truth, chips)
+    calibration = timewalk.TimeWalkCalibration(n_chips=2, degree=2)
+    calibration.update(hits, chips)
+    coefficients = calibration.fit()
+    # TOA is rounded to integers, so the fit is only exact to the rounding noise
+    assert np.abs(coefficients[..., 0] - truth[..., 0]).max() < 1
+    assert np.abs(calibration.apply(hits, chips)).max() < 2
+    assert (calibration.residual_rms() < 0.5).all()
+    assert calibration.hits.sum() == len(hits)
+
+
+def test_streaming_and_merge_equal_one_update():
+    rng = np.random.default_rng(2)
+    truth = np.zeros((1, 16, 16, 4))
+    truth[..., 0], truth[..., 1] = 400, -200
+    hits, _ = simulate(rng, 50000, truth, jitter=3)
+    whole = timewalk.TimeWalkCalibration(degree=3)
+    whole.update(hits)
+    first, second = timewalk.TimeWalkCalibration(degree=3), timewalk.TimeWalkCalibration(degree=3)
+    first.update(hits[:20000])
+    second.update(hits[20000:30000])
+    second.update(hits[30000:])
+    first.merge(second)
+    np.testing.assert_allclose(first.moments, whole.moments)
+    np.testing.assert_allclose(first.cross, whole.cross)
+    np.testing.assert_allclose(first.fit(), whole.fit())
+
+
+def test_pixels_without_enough_hits_stay_uncalibrated(tmp_path):
+    rng = np.random.default_rng(3)
+    truth = np.zeros((1, 16, 16, 2))
+    truth[..., 0] = 300
+    hits, _ = simulate(rng, 3000, truth)
+    hits = hits[(hits["row"] != 4) | (hits["col"] != 5)]
+    calibration = timewalk.TimeWalkCalibration(degree=1, min_hits=5)
+    calibration.update(hits)
+    calibration.update(hits[:0])
+    coefficients = calibration.fit()
+    assert np.isnan(coefficients[0, 4, 5]).all()
+    assert np.isnan(calibration.walk(np.array([(0, 0, 0, 0, 0, 4, 5, 0, 100, 0)], dtype=HIT_DTYPE))).all()
+    path = str(tmp_path/"walk.npz")
+    calibration.save(path)
+    loaded = timewalk.TimeWalkCalibration.load(path)
+    assert (loaded.degree, loaded.min_hits) == (1, 5)
+    np.testing.assert_array_equal(loaded.coefficients, coefficients)
+    np.testing.assert_array_equal(loaded.moments, calibration.moments)
+    assert loaded.apply(hits)[:10] == pytest.approx(calibration.apply(hits)[:10])
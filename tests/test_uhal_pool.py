@@ -0,0 +1,33 @@
+"""
+Description:
+Shared lpgbt_chip objects: created once per key, and a slow connection setup does not
+block lookups of other chips.
+"""
+import threading
+
+import pytest
+
+uhal_pool = pytest.importorskip("mtd_sw.controllers.uhal_pool")
+
+
+def test_slow_construction_does_not_block_other_keys(monkeypatch):
+    release = threading.Event()
+    created = []
+
+    class SlowChip:
+        def __init__(self, name, connection, link, **kwargs):
+            created.append(link)
+            if link == 1:
+                release.wait(5)
+
+    monkeypatch.setattr(uhal_pool, "lpgbt_chip", SlowChip)
+    monkeypatch.setattr(uhal_pool, "_lpgbts", {})
+    monkeypatch.setattr(uhal_pool, "_lpgbt_key_locks", {})
+    slow = threading.Thread(target=uhal_pool.shared_lpgbt, args=("A", "/tmp/c.xml", 1))
+    slow.start()
+    fast = uhal_pool.shared_lpgbt("B", "/tmp/c.xml", 2)
+    assert not release.is_set() and slow.is_alive()
+    release.set()
+    slow.join()
+    assert uhal_pool.shared_lpgbt("B", "file:///tmp/c.xml", 2) is fast
+    assert sorted(created) == [1, 2]